@@ -1,21 +1,23 @@
 from .utils import *
+from collections import OrderedDict
+import tiledb
 allowed_attributes={}
 allowed_attributes['bigwig']={'dtype':'float32',
                                          'opener':open_bigwig_for_parsing,
                                          'parser':parse_bigwig_chrom_vals,
                                          'store_summits':False}
-allowed_attributes['bed_no_summit']={'dtype':'int',
+allowed_attributes['bed_no_summit']={'dtype':'uint8',
                                'opener':open_csv_for_parsing,
                                'parser':parse_narrowPeak_chrom_vals,
                                'store_summits':False,
                                'summit_from_peak_center':False}
-allowed_attributes['bed_summit_from_peak_center']={'dtype':'int',
+allowed_attributes['bed_summit_from_peak_center']={'dtype':'uint8',
                                'opener':open_csv_for_parsing,
                                'parser':parse_narrowPeak_chrom_vals,
                                'store_summits':True,
                                'summit_indicator':2,
                                'summit_from_peak_center':True}
-allowed_attributes['bed_summit_from_last_col']={'dtype':'int',
+allowed_attributes['bed_summit_from_last_col']={'dtype':'uint8',
                                'opener':open_csv_for_parsing,
                                'parser':parse_narrowPeak_chrom_vals,
                                'store_summits':True,
@@ -50,6 +52,104 @@ def get_encode_config():
     attrib_info['ambig_peak']=allowed_attributes['bed_no_summit']
     return attrib_info 
 
+#where an attribute is stored: 
+#dense -- an attribute of the main dense array
+#separate -- its own single-attribute dense array, <array_name>.<attribute>, which can be updated without rewriting the other attributes
+#sparse -- runs of constant non-zero values in its own sparse array, <array_name>.<attribute>, for mostly-zero attributes (peaks, 5' counts) 
+allowed_storage=['dense','separate','sparse']
+
+#tileDB filters that can be chained into a per-attribute filter pipeline with filters=<filter>[:<level>],<filter>[:<level>],...
+#e.g. filters=bitshuffle,zstd:3 ; the filters are applied in order when writing. Only the compressors accept a level. 
+allowed_filters={'none':'NoOpFilter',
+                 'gzip':'GzipFilter',
+                 'zstd':'ZstdFilter',
+                 'lz4':'LZ4Filter',
+                 'bzip2':'Bzip2Filter',
+                 'rle':'RleFilter',
+                 'bitshuffle':'BitShuffleFilter',
+                 'byteshuffle':'ByteShuffleFilter',
+                 'delta':'DeltaFilter',
+                 'double_delta':'DoubleDeltaFilter',
+                 'bit_width_reduction':'BitWidthReductionFilter'}
+compression_filters=['gzip','zstd','lz4','bzip2','rle','delta','double_delta']
+default_filters='gzip'
+
+def parse_filters(filter_spec,field_name=None):
+    '''
+    validates a filter pipeline specification and returns it as a list of (filter name, level or None) 
+    '''
+    pipeline=[]
+    for token in filter_spec.split(','):
+        tokens=token.strip().split(':')
+        name=tokens[0]
+        if name not in allowed_filters:
+            raise Exception("unsupported filter:"+str(name)+" for attribute:"+str(field_name)+"; must be one of "+str(sorted(allowed_filters.keys())))
+        level=None
+        if len(tokens)>1:
+            assert name in compression_filters, "filter:"+str(name)+" for attribute:"+str(field_name)+" does not accept a level"
+            level=int(tokens[1])
+        pipeline.append((name,level))
+    return pipeline
+
+def get_filter_list(filter_spec):
+    '''
+    returns the tiledb.FilterList for a filter pipeline specification such as "bitshuffle,zstd:3" 
+    '''
+    filters=[]
+    for name,level in parse_filters(filter_spec):
+        filter_class=getattr(tiledb,allowed_filters[name],None)
+        if filter_class is None:
+            raise Exception("filter:"+str(name)+" is not supported by the installed version of tiledb")
+        if level is None:
+            filters.append(filter_class())
+        else:
+            filters.append(filter_class(level=level))
+    return tiledb.FilterList(filters)
+
+def get_attribute_filters(attribute_info,attribute):
+    return attribute_info[attribute].get('filters',default_filters)
+
+#storage dtypes that can be selected with dtype=<dtype>. Peak attributes must use an integer dtype (they only hold 0, 1 and the summit indicator);
+#bigwig attributes stored with an integer dtype are quantized to round(value*scale), which requires scale=<scale>.
+#tileDB has no half precision type, so compact signal storage uses a scaled integer dtype (i.e. dtype=int16 scale=100) 
+allowed_dtypes=['uint8','int8','uint16','int16','uint32','int32','int64','float32','float64']
+
+def check_attribute_dtype(field_name,cur_attribute_info):
+    dtype=np.dtype(cur_attribute_info['dtype'])
+    is_integer=np.issubdtype(dtype,np.integer)
+    if cur_attribute_info['parser'] is parse_narrowPeak_chrom_vals:
+        assert is_integer, "attribute:"+str(field_name)+" stores peaks and must have an integer dtype"
+        assert 'scale' not in cur_attribute_info, "scale is only supported for bigwig attributes, not for attribute:"+str(field_name)
+    elif is_integer:
+        assert 'scale' in cur_attribute_info, "bigwig attribute:"+str(field_name)+" with integer dtype:"+str(dtype)+" requires scale=<scale>"
+    else:
+        assert 'scale' not in cur_attribute_info, "scale requires an integer dtype for attribute:"+str(field_name)
+
+def parse_attribute_options(field_name,option_tokens):
+    '''
+    optional columns after the attribute type in the attribute config file are of the form key=value 
+    '''
+    options={}
+    for token in option_tokens:
+        if token.strip()=='':
+            continue
+        key,value=token.strip().split('=',1)
+        if key=='storage':
+            assert value in allowed_storage, "unsupported storage:"+str(value)+" for attribute:"+str(field_name)+"; must be one of "+str(allowed_storage)
+            options['storage']=value
+        elif key=='dtype':
+            assert value in allowed_dtypes, "unsupported dtype:"+str(value)+" for attribute:"+str(field_name)+"; must be one of "+str(allowed_dtypes)
+            options['dtype']=value
+        elif key=='scale':
+            options['scale']=float(value)
+            assert options['scale'] > 0, "scale must be positive for attribute:"+str(field_name)
+        elif key=='filters':
+            parse_filters(value,field_name)
+            options['filters']=value
+        else:
+            raise Exception("unsupported option:"+str(key)+" for attribute:"+str(field_name))
+    return options
+
 def get_attribute_info_from_file(attribute_config_file):
     config_metadata=open(attribute_config_file,'r').read().strip().split('\n')
     attrib_info={}
@@ -57,9 +157,40 @@ def get_attribute_info_from_file(attribute_config_file):
         tokens=line.split('\t')
         field_name=tokens[0]
         field_type=tokens[1]
-        attrib_info[field_name]=allowed_attributes[field_type]
+        attrib_info[field_name]=dict(allowed_attributes[field_type])
+        attrib_info[field_name].update(parse_attribute_options(field_name,tokens[2:]))
+        check_attribute_dtype(field_name,attrib_info[field_name])
     return attrib_info
 
+def get_attribute_scale(attribute_info,attribute):
+    '''
+    values of the attribute are stored as round(value*scale); None if the attribute is stored unscaled  
+    '''
+    return attribute_info[attribute].get('scale')
+
+def get_attribute_storage(attribute_info,attribute):
+    return attribute_info[attribute].get('storage','dense')
+
+def get_attribute_array_name(array_name,attribute_info,attribute):
+    '''
+    path of the tileDB array that stores the attribute 
+    '''
+    if get_attribute_storage(attribute_info,attribute) in ['separate','sparse']:
+        return array_name.rstrip('/')+'.'+attribute
+    return array_name
+
+def group_attributes_by_array(array_name,attribute_info,attributes):
+    '''
+    returns an ordered dictionary of array path -> attributes stored in that array, starting with the main array
+    '''
+    arrays=OrderedDict([(array_name,[])])
+    for attribute in attributes:
+        cur_array_name=get_attribute_array_name(array_name,attribute_info,attribute)
+        if cur_array_name not in arrays:
+            arrays[cur_array_name]=[]
+        arrays[cur_array_name].append(attribute)
+    return arrays
+
 def get_attribute_info(attribute_config,attribute_config_file):
     assert (attribute_config is None) or (attribute_config_file is None)
     if attribute_config_file is not None:
@@ -1,13 +1,109 @@
+import atexit
+import os
+import threading
+import time
 import tiledb
 import numpy as np
-from .core import CoordsToVals
+from .core import CoordsToVals, get_new_coors_around_center
+from ....dbingest.sparse_storage import read_sparse_attribute
+from ....utils import merge_intervals
+
+class TiledbArrayPool(object):
+    def __init__(self, reopen_interval=None):
+        '''
+        arrays opened for reading once per process and kept open, keyed by path, so that batches do not re-read the schema, fragment 
+        metadata and array metadata of every array they touch. The pool is emptied the first time it is used in a new process (i.e. a keras 
+        worker forked after the arrays were opened), as tileDB contexts and array handles cannot be shared across a fork. 
+        reopen_interval: an array that has been open for longer than this many seconds is reopened before it is read, so that reads see the 
+        fragments written since it was opened (i.e. by an ingest that is still running). None keeps every array open at the version it was opened at. 
+        '''
+        self.reopen_interval=reopen_interval
+        self.lock=threading.Lock()
+        self.pid=None
+
+    def get(self, tiledb_path):
+        with self.lock:
+            if self.pid!=os.getpid():
+                #inherited from the parent process: don't close the parent's handles 
+                self.pid=os.getpid()
+                self.ctx=tiledb.Ctx()
+                self.arrays={}
+            if tiledb_path not in self.arrays:
+                self.arrays[tiledb_path]=[tiledb.open(tiledb_path, mode='r', ctx=self.ctx),time.time()]
+            elif (self.reopen_interval is not None) and (time.time()-self.arrays[tiledb_path][1] > self.reopen_interval):
+                self.arrays[tiledb_path][0].reopen()
+                self.arrays[tiledb_path][1]=time.time()
+            return self.arrays[tiledb_path][0]
+
+    def close(self):
+        with self.lock:
+            if self.pid==os.getpid():
+                for cur_array,opened_at in self.arrays.values():
+                    cur_array.close()
+                self.arrays={}
+
+#arrays shared by every tiledb CoordsToVals of the process that is not given its own pool; closed before the interpreter tears down tiledb 
+tiledb_array_pool=TiledbArrayPool()
+atexit.register(tiledb_array_pool.close)
+
+def plan_window_ranges(starts, width):
+    '''
+    sorts the windows [start, start+width) and merges overlapping windows into disjoint ranges, so that a multi-range query reads every 
+    base (and decompresses every tile) shared by several windows once. Returns the sorted (start, end) ranges and a (windows x width) array 
+    with the row of each base of each window (in the original order of starts) in the concatenated result of the ranges 
+    '''
+    ranges=merge_intervals(starts,starts+width)
+    range_starts=np.array([start for start,end in ranges],dtype=np.int64)
+    range_ends=np.array([end for start,end in ranges],dtype=np.int64)
+    range_rows=np.cumsum(range_ends-range_starts)-(range_ends-range_starts)
+    window_ranges=np.searchsorted(range_starts,starts,side='right')-1
+    window_rows=range_rows[window_ranges]+starts-range_starts[window_ranges]
+    return ranges,window_rows[:,None]+np.arange(width)
+
+def get_task_ranges(task_indices):
+    '''
+    returns the (inclusive) multi_index ranges of the runs of consecutive tasks in task_indices, and the column of each task of task_indices 
+    in the result of a query of these ranges 
+    '''
+    tasks=np.unique(task_indices)
+    run_firsts=np.flatnonzero(np.append(True,np.diff(tasks) > 1))
+    run_lasts=np.append(run_firsts[1:]-1,len(tasks)-1)
+    return [slice(int(tasks[first]),int(tasks[last])) for first,last in zip(run_firsts,run_lasts)],np.searchsorted(tasks,task_indices)
+
+def read_dense_windows(cur_array, attributes, starts, width, task_ranges=None):
+    '''
+    reads the windows [start, start+width) of a dense array (of the tasks in the inclusive task_ranges, for arrays with a task axis) 
+    with a single multi-range query. returns a dictionary attribute -> (windows x width [x tasks]) array 
+    '''
+    ranges,window_rows=plan_window_ranges(starts,width)
+    #multi_index ranges are inclusive 
+    coordinate_ranges=[slice(start,end-1) for start,end in ranges]
+    if task_ranges is None:
+        range_vals=cur_array.query(attrs=attributes).multi_index[coordinate_ranges]
+    else:
+        range_vals=cur_array.query(attrs=attributes).multi_index[coordinate_ranges,task_ranges]
+    return dict([(attribute,range_vals[attribute][window_rows]) for attribute in attributes])
+
+def read_sparse_windows(cur_array, attribute, starts, width, task_start, task_end):
+    '''
+    reads the windows [start, start+width) of tasks [task_start, task_end) of an attribute stored with storage=sparse, expanding the 
+    runs of each merged range once. returns a (windows x width x tasks) array 
+    '''
+    ranges,window_rows=plan_window_ranges(starts,width)
+    range_vals=np.concatenate([read_sparse_attribute(cur_array,attribute,start,end,task_start,task_end) for start,end in ranges])
+    return range_vals[window_rows]
+
 
 class BasicTiledbProfileCoordsToVals(CoordsToVals):
-    def __init__(self, tiledb_paths, pos_label_source_attribute, neg_label_source_attribute=None, center_size_to_use=None, **kwargs):
+    def __init__(self, tiledb_paths, pos_label_source_attribute, neg_label_source_attribute=None, center_size_to_use=None, array_pool=None, **kwargs):
         '''
         tiledb_paths can be a single string or a list of strings or a dictionary mapping from  mode name to string. 
+        array_pool is the TiledbArrayPool that keeps the arrays open (the pool shared by the process if None) 
         '''
         self.tiledb_paths=tiledb_paths
+        self.array_pool=array_pool if array_pool is not None else tiledb_array_pool
+        #if provided, only the center_size_to_use bases around the center of each coordinate are read 
+        self.center_size_to_use=center_size_to_use
         #identify the data type of tiledb_paths 
         self.type_tiledb_paths=type(self.tiledb_paths)
         #identify the corresponding function to use for querying tiledb 
@@ -60,23 +156,187 @@ class BasicTiledbProfileCoordsToVals(CoordsToVals):
         returns nparray of values associated with coordinates
         '''
         assert len(coords)>0        
-        self.ctx = tiledb.Ctx()
+        if self.center_size_to_use is not None:
+            coords=get_new_coors_around_center(coords,self.center_size_to_use)
         return self.call_function(coords)
 
     def query_tiledb(self,cur_tiledb_path,coords):
         '''
         queries tiledb database for a specific batch of coordinates for a single dataset/task. 
+        the coordinates on each chromosome are read with one multi-range query 
         '''
-        labels=np.zeros((len(coords),coords[0].end-coords[0].start))
-        for i in range(len(coords)):
-            coord=coords[i]
-            #open the tiledb for access in a pre-defined context 
-            with tiledb.DenseArray('.'.join([cur_tiledb_path,coord.chrom]), mode='r',ctx=self.ctx) as cur_array:
-                if coord.isplusstrand:
-                    #query positive strand (or non-stranded entity)
-                    cur_vals=cur_array[coord.start:coord.end][self.pos_label_source_attribute]
-                else:
-                    #query negative strand , make sure to reverse the values
-                    cur_vals=cur_array[coord.start:coord.end][self.neg_label_source_attribute][::-1]
-            labels[i]=cur_vals
+        width=coords[0].end-coords[0].start
+        labels=np.zeros((len(coords),width))
+        chroms=np.array([coord.chrom for coord in coords])
+        starts=np.array([coord.start for coord in coords],dtype=np.int64)
+        plus_strand=np.array([coord.isplusstrand for coord in coords])
+        #positive strand (or non-stranded entity) and negative strand values may come from different attributes 
+        neg_label_source_attribute=self.neg_label_source_attribute if self.neg_label_source_attribute is not None else self.pos_label_source_attribute
+        for chrom in np.unique(chroms):
+            on_chrom=chroms==chrom
+            cur_array=self.array_pool.get('.'.join([cur_tiledb_path,chrom]))
+            attributes=list(dict.fromkeys([self.pos_label_source_attribute,neg_label_source_attribute]))
+            cur_vals=read_dense_windows(cur_array,attributes,starts[on_chrom],width)
+            for attribute,strand_mask in [(self.pos_label_source_attribute,on_chrom & plus_strand),(neg_label_source_attribute,on_chrom & ~plus_strand)]:
+                labels[strand_mask]=self.descale(cur_array,attribute,cur_vals[attribute][strand_mask[on_chrom]])
+        #make sure to reverse the values of the negative strand 
+        labels[~plus_strand]=labels[~plus_strand,::-1]
         return labels
+
+    def descale(self,cur_array,attribute,vals):
+        '''
+        attributes ingested with a scale (quantized signal) are stored as round(value*scale)
+        '''
+        scale_key='_'.join(['scale',attribute])
+        if scale_key in cur_array.meta:
+            return vals/cur_array.meta[scale_key]
+        return vals
+
+
+class GenomeWideArrayIndex(object):
+    def __init__(self, tiledb_path, cur_array):
+        '''
+        index of an array written by dbingest, which stores every chromosome along one global genome_coordinate axis and every task 
+        along the task axis: the global offset of each chromosome, the index of each task, and the storage and scale of each attribute,
+        read once from the metadata of cur_array, the main array opened for reading. The index is only valid for the version of the array 
+        that cur_array was opened at (its timestamp_range) 
+        '''
+        self.tiledb_path=tiledb_path
+        self.timestamp_range=cur_array.timestamp_range
+        #array metadata values are only valid while the array is open 
+        array_meta=dict([(key,cur_array.meta[key]) for key in cur_array.meta.keys() if not key.startswith('covered_')])
+        self.chroms=[array_meta['_'.join(['chrom',str(i)])] for i in range(array_meta['num_chroms'])]
+        self.chrom_offsets=dict([(self.chroms[i],array_meta['_'.join(['offset',str(i)])]) for i in range(len(self.chroms))])
+        self.chrom_sizes=dict([(self.chroms[i],array_meta['_'.join(['size',str(i)])]) for i in range(len(self.chroms))])
+        self.tasks=[array_meta['_'.join(['task',str(i)])] for i in range(array_meta['num_tasks'])]
+        self.task_indices=dict([(task,i) for i,task in enumerate(self.tasks)])
+        self.storage=dict([(key[len('storage_'):],array_meta[key]) for key in array_meta if key.startswith('storage_')])
+        self.scale=dict([(key[len('scale_'):],array_meta[key]) for key in array_meta if key.startswith('scale_')])
+
+    def get_attribute_array_name(self, attribute):
+        '''
+        attributes with storage=separate or storage=sparse are stored in their own array, <tiledb_path>.<attribute> 
+        '''
+        if self.storage.get(attribute,'dense')=='dense':
+            return self.tiledb_path
+        return self.tiledb_path.rstrip('/')+'.'+attribute
+
+    def get_task_indices(self, tasks):
+        '''
+        tasks is a list of task names or indices; None selects every task 
+        '''
+        if tasks is None:
+            return np.arange(len(self.tasks))
+        return np.array([self.task_indices[task] if isinstance(task,str) else int(task) for task in tasks],dtype=np.int64)
+
+    def get_global_starts(self, coords):
+        '''
+        returns the global genome_coordinate index of the start of each coordinate. Coordinates must lie within their chromosome, 
+        as the global axis runs on into the next chromosome 
+        '''
+        chroms,chrom_codes=np.unique(np.array([coord.chrom for coord in coords]),return_inverse=True)
+        for chrom in chroms:
+            if chrom not in self.chrom_offsets:
+                raise Exception("chromosome:"+str(chrom)+" is not in the array:"+str(self.tiledb_path))
+        chrom_offsets=np.array([self.chrom_offsets[chrom] for chrom in chroms],dtype=np.int64)
+        chrom_sizes=np.array([self.chrom_sizes[chrom] for chrom in chroms],dtype=np.int64)
+        starts=np.array([coord.start for coord in coords],dtype=np.int64)
+        ends=np.array([coord.end for coord in coords],dtype=np.int64)
+        out_of_bounds=(starts < 0) | (ends > chrom_sizes[chrom_codes])
+        if out_of_bounds.any():
+            coord=coords[int(np.argmax(out_of_bounds))]
+            raise Exception("coordinate "+str(coord.chrom)+":"+str(coord.start)+"-"+str(coord.end)+" is outside of the chromosome, which has size:"+str(self.chrom_sizes[coord.chrom]))
+        return chrom_offsets[chrom_codes]+starts
+
+#array path -> GenomeWideArrayIndex, so the metadata of an array is read once per process, and again whenever the array is reopened at a 
+#newer version (i.e. after tasks were appended to it) 
+genome_wide_array_indices={}
+
+def get_genome_wide_array_index(tiledb_path, array_pool=tiledb_array_pool):
+    cur_array=array_pool.get(tiledb_path)
+    if (tiledb_path not in genome_wide_array_indices) or (genome_wide_array_indices[tiledb_path].timestamp_range!=cur_array.timestamp_range):
+        genome_wide_array_indices[tiledb_path]=GenomeWideArrayIndex(tiledb_path,cur_array)
+    return genome_wide_array_indices[tiledb_path]
+
+
+class GenomeWideTiledbCoordsToVals(CoordsToVals):
+    def __init__(self, tiledb_path, attributes, tasks=None, mode_name=None, center_size_to_use=None, neg_strand_attributes=None, array_pool=None):
+        '''
+        reads attributes of the genome-wide arrays written by dbingest (see GenomeWideArrayIndex) for the tasks listed in tasks 
+        (task names or indices; all tasks if None). attributes is an attribute name, a list of attribute names or a dictionary mapping 
+        output names to attribute names. A single attribute is returned as a (batch, width, tasks) array, or a dictionary mode_name -> array 
+        if mode_name is provided; a list or dictionary of attributes is returned as a dictionary of output name -> (batch, width, tasks) array.
+        neg_strand_attributes optionally maps output names to the attribute to read instead for coordinates on the negative strand (i.e. to 
+        swap the plus and minus strand count tracks). If center_size_to_use is provided, only that many bases around the center of each 
+        coordinate are read. The arrays are kept open in array_pool (the pool shared by the process if None) 
+        '''
+        self.tiledb_path=tiledb_path
+        self.array_pool=array_pool if array_pool is not None else tiledb_array_pool
+        if isinstance(attributes,str):
+            self.attributes={attributes:attributes}
+        elif isinstance(attributes,dict):
+            self.attributes=attributes
+        else:
+            self.attributes=dict([(attribute,attribute) for attribute in attributes])
+        self.single_attribute=isinstance(attributes,str)
+        self.neg_strand_attributes=neg_strand_attributes if neg_strand_attributes is not None else {}
+        self.tasks=tasks
+        self.mode_name=mode_name
+        self.center_size_to_use=center_size_to_use
+
+    def __call__(self, coords):
+        '''
+        coords is a list of named tuples : .chrom, .start, .end, .isplusstrand, all of the same width. Values of coordinates on the 
+        negative strand are reversed along the width.
+        '''
+        assert len(coords)>0
+        if self.center_size_to_use is not None:
+            coords=get_new_coors_around_center(coords,self.center_size_to_use)
+        widths=set([coord.end-coord.start for coord in coords])
+        assert len(widths)==1, "all coordinates must have the same width, but widths are "+str(widths)
+        array_index=get_genome_wide_array_index(self.tiledb_path,self.array_pool)
+        task_indices=array_index.get_task_indices(self.tasks)
+        attributes=list(dict.fromkeys(list(self.attributes.values())+list(self.neg_strand_attributes.values())))
+        attribute_vals=self.query_tiledb(array_index,array_index.get_global_starts(coords),widths.pop(),task_indices,attributes)
+        minus_strand=np.array([not coord.isplusstrand for coord in coords])
+        vals={}
+        for name,attribute in self.attributes.items():
+            vals[name]=np.array(attribute_vals[attribute])
+            if name in self.neg_strand_attributes:
+                vals[name][minus_strand]=attribute_vals[self.neg_strand_attributes[name]][minus_strand]
+            vals[name][minus_strand]=vals[name][minus_strand,::-1]
+        if self.single_attribute is False:
+            return vals
+        vals=vals[list(self.attributes.keys())[0]]
+        if self.mode_name is None:
+            return vals
+        return {self.mode_name: vals}
+
+    def query_tiledb(self, array_index, global_starts, width, task_indices, attributes):
+        '''
+        reads the attributes for all the selected tasks and coordinates with one multi-range query per array: one for all the attributes 
+        stored in the main array, and one for each attribute stored in its own array. returns a dictionary of attribute -> 
+        (batch, width, tasks) array 
+        '''
+        attribute_arrays={}
+        for attribute in attributes:
+            attribute_arrays.setdefault(array_index.get_attribute_array_name(attribute),[]).append(attribute)
+        task_ranges,task_columns=get_task_ranges(task_indices)
+        task_start=int(task_indices.min())
+        task_end=int(task_indices.max())+1
+        attribute_vals={}
+        for array_name,array_attributes in attribute_arrays.items():
+            cur_array=self.array_pool.get(array_name)
+            if array_index.storage.get(array_attributes[0],'dense')=='sparse':
+                #sparse arrays store a single attribute 
+                vals=read_sparse_windows(cur_array,array_attributes[0],global_starts,width,task_start,task_end)
+                attribute_vals[array_attributes[0]]=vals[:,:,task_indices-task_start]
+                continue
+            array_vals=read_dense_windows(cur_array,array_attributes,global_starts,width,task_ranges)
+            for attribute in array_attributes:
+                attribute_vals[attribute]=array_vals[attribute][:,:,task_columns]
+        for attribute in attributes:
+            if attribute in array_index.scale:
+                #attributes ingested with a scale (quantized signal) are stored as round(value*scale)
+                attribute_vals[attribute]=attribute_vals[attribute]/array_index.scale[attribute]
+        return attribute_vals
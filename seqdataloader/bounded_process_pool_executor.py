@@ -1,4 +1,5 @@
 import multiprocessing
+import threading
 import concurrent.futures
 
 name = 'bounded_pool_executor'
@@ -24,4 +25,26 @@ class BoundedProcessPoolExecutor(_BoundedPoolExecutor, concurrent.futures.Proces
     def __init__(self, max_workers=None,mp_context=None, initializer=None, initargs=()):
         super().__init__(max_workers,mp_context,initializer,initargs)
         self.semaphore = multiprocessing.BoundedSemaphore(max_workers)
-                                                                                                        
+
+
+class BoundedThreadPoolExecutor(_BoundedPoolExecutor, concurrent.futures.ThreadPoolExecutor):
+    def __init__(self, max_workers=None, initializer=None, initargs=()):
+        super().__init__(max_workers,initializer=initializer,initargs=initargs)
+        self.semaphore = threading.BoundedSemaphore(max_workers)
+
+
+class SerialExecutor(concurrent.futures.Executor):
+    '''
+    runs every submitted function immediately in the calling thread, and returns a future that is already done
+    '''
+    def __init__(self, initializer=None, initargs=()):
+        if initializer is not None:
+            initializer(*initargs)
+
+    def submit(self, fn, *args, **kwargs):
+        future = concurrent.futures.Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+        return future
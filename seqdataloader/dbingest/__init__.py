@@ -4,12 +4,19 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 import math
+import copy
 import psutil
-from multiprocessing import Pool, Process, Queue
+import multiprocessing
+from multiprocessing import Process, Queue
+import queue
+import threading
+import traceback
+import concurrent.futures
 import os
 import signal
-import tiledb
+import time
 import pickle
+import tiledb
 import argparse
 import pandas as pd
 import numpy as np
@@ -18,8 +25,14 @@ from ..attrib_config import *
 from ..queue_config import * 
 from ..utils import *
 from ..tdb_config import * 
-import gc
-import time
+from ..bounded_process_pool_executor import BoundedProcessPoolExecutor, BoundedThreadPoolExecutor, SerialExecutor
+from .shared_memory_ring import *
+from .manifest import *
+from .sparse_storage import *
+from .consolidate import consolidate
+from .memory_monitor import *
+from .telemetry import *
+from .work_queue import *
 import sys
 
 def args_object_from_args_dict(args_dict):
@@ -27,14 +40,34 @@ def args_object_from_args_dict(args_dict):
     args_object=argparse.Namespace()
     #set the defaults
     vars(args_object)['overwrite']=False
+    vars(args_object)['resume']=False
+    vars(args_object)['append']=False
+    vars(args_object)['update_attributes']=None
+    vars(args_object)['max_tasks']=None
+    vars(args_object)['chroms_to_keep']=None
+    vars(args_object)['chroms_to_exclude']=None
+    vars(args_object)['regions']=None
+    vars(args_object)['region_padding']=0
     vars(args_object)['coord_tile_size']=10000
-    vars(args_boject)['task_tile_size']=1
+    vars(args_object)['task_tile_size']=1
     vars(args_object)['attribute_config']=None
     vars(args_object)['attribute_config_file']=None
     vars(args_object)['write_chunk']=30000000
     vars(args_object)['threads']=1
+    vars(args_object)['executor']='process'
     vars(args_object)['max_queue_size']=30
     vars(args_object)['max_mem_g']=100
+    vars(args_object)['bigwig_cache_size']=64
+    vars(args_object)['consolidate']=False
+    vars(args_object)['telemetry_file']=None
+    vars(args_object)['num_writers']=1
+    vars(args_object)['work_dir']=None
+    vars(args_object)['worker']=False
+    vars(args_object)['finalize']=False
+    vars(args_object)['claim_batch']=16
+    vars(args_object)['release_incomplete']=False
+    vars(args_object)['consolidation_fragment_size_mb']=None
+    vars(args_object)['consolidation_memory_budget_mb']=None
     for key in args_dict:
         vars(args_object)[key]=args_dict[key]
     #set any defaults that are unset 
@@ -46,20 +79,101 @@ def parse_args():
     parser.add_argument("--tiledb_metadata",help="each row is a dataset, each column corresponds to an attribute")
     parser.add_argument("--array_name")
     parser.add_argument("--overwrite",default=False,action="store_true") 
+    parser.add_argument("--resume",default=False,action="store_true",help="resume an interrupted ingest into an existing array, skipping the (task, chunk, attribute) units recorded in its ingest manifest. Combine with --overwrite to resume an interrupted update")
+    parser.add_argument("--append",default=False,action="store_true",help="add the rows of --tiledb_metadata whose dataset is not yet in the existing array as new tasks, leaving the existing tasks untouched")
+    parser.add_argument("--update_attributes",nargs="+",default=None,help="update only these attributes (columns of --tiledb_metadata) in an existing array. Only these attributes are parsed, and attributes configured with storage=separate are written without reading or rewriting any other attribute")
+    parser.add_argument("--max_tasks",type=int,default=None,help="size of the task axis to reserve when creating a new array, so that tasks can later be added with --append. Defaults to the number of rows in --tiledb_metadata")
     parser.add_argument("--chrom_sizes",help="2 column tsv-separated file. Column 1 = chromsome name; Column 2 = chromosome size")
+    parser.add_argument("--chroms_to_keep",nargs="+",default=None,help="only ingest these chromosomes. The array still spans every chromosome in --chrom_sizes")
+    parser.add_argument("--chroms_to_exclude",nargs="+",default=None,help="do not ingest these chromosomes")
+    parser.add_argument("--regions",default=None,help="bed file of the regions to ingest (i.e. peaks); only these regions, padded by --region_padding and extended to whole coordinate tiles, are parsed and written. The regions covered are recorded in the covered_start/covered_end metadata of the array")
+    parser.add_argument("--region_padding",type=int,default=0,help="number of bases to add on both sides of each region in --regions")
     parser.add_argument("--coord_tile_size",type=int,default=10000,help="coordinate axis tile size")
     parser.add_argument("--task_tile_size",type=int,default=1,help="task axis tile size")
     parser.add_argument("--attribute_config",default=None,help="the following are supported: encode_pipeline, encode_pipeline_with_controls, generic_bigwig")
     parser.add_argument("--attribute_config_file",default=None,help="file with 2 columns; first column indicates attribute name; 2nd column indicates attribute type, which is one of bigwig, bed_no_summit, bed_summit_from_peak_center, bed_summit_from_last_col")
-    parser.add_argument("--write_chunk",type=int,default=30000000,help="number of bases to write to disk in one tileDB DenseArray write operation")
+    parser.add_argument("--write_chunk",type=int,default=30000000,help="maximum number of bases to write to disk in one tileDB DenseArray write operation; reduced to fit within --max_mem_g")
     parser.add_argument("--threads",type=int,default=1,help="number of chunks to process in parallel")
-    parser.add_argument("--max_queue_size",type=int,default=30)
-    parser.add_argument("--max_mem_g",type=int,default=100,help="maximum memory usage in Gigabytes")
+    parser.add_argument("--executor",default="process",choices=["process","thread","serial"],help="process: decode chunks in --threads worker processes and write them in --num_writers writer processes. thread: use threads of the ingest process instead, which share open files and slabs without pickling any messages. serial: decode every chunk in the main thread, and write it in --num_writers writer threads")
+    parser.add_argument("--num_writers",type=int,default=1,help="number of array writer processes. Blocks of tasks x chunk are assigned round-robin to the writers, so each writer owns a disjoint set of array regions")
+    parser.add_argument("--max_queue_size",type=int,default=30,help="number of shared memory slabs (each holding write_chunk bases for every attribute) in flight between the workers and the array writer")
+    parser.add_argument("--max_mem_g",type=int,default=100,help="maximum memory of the ingest processes (parent, workers and array writer) in Gigabytes. Write chunks are shrunk below --write_chunk if needed to fit the shared memory slabs in this budget, and new blocks are not submitted while the ingest processes use more")
+    parser.add_argument("--bigwig_cache_size",type=int,default=64,help="number of open bigwig handles each worker keeps cached across chunks")
+    parser.add_argument("--telemetry_file",default=None,help="JSON-lines file to record the time spent parsing, queueing and writing every block of tasks x chunk. Defaults to <array_name>.ingest_telemetry.jsonl")
+    parser.add_argument("--consolidate",default=False,action="store_true",help="consolidate and vacuum the fragments written by this ingest once it is complete (see db_consolidate)")
+    parser.add_argument("--consolidation_fragment_size_mb",type=int,default=None,help="with --consolidate, target maximum size of each consolidated fragment in MB")
+    parser.add_argument("--consolidation_memory_budget_mb",type=int,default=None,help="with --consolidate, total memory budget for consolidation in MB")
+    parser.add_argument("--work_dir",default=None,help="directory on a filesystem shared by all hosts for a distributed ingest. With the usual ingest arguments, the array is created and the work plan is written to this directory instead of being processed; see --worker and --finalize")
+    parser.add_argument("--worker",default=False,action="store_true",help="claim and ingest units of the work plan in --work_dir until none are left. Only --threads, --num_writers, --max_queue_size, --max_mem_g and --bigwig_cache_size are read from the command line, everything else comes from the plan")
+    parser.add_argument("--finalize",default=False,action="store_true",help="check that every unit of the work plan in --work_dir has been written, then register the tasks and (with --consolidate) consolidate the array")
+    parser.add_argument("--claim_batch",type=int,default=16,help="with --worker, number of units claimed at a time")
+    parser.add_argument("--release_incomplete",default=False,action="store_true",help="with --finalize, remove the claims of units that were not written (i.e. by workers that died), so that new workers pick them up")
     return parser.parse_args()
     
     
-def init_worker():
-    signal.signal(signal.SIGINT, signal.SIG_IGN)
+def init_worker(worker_write_queues=None,worker_slab_ring=None,ignore_sigint=True):
+    if ignore_sigint is True:
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+    global write_queues
+    global slab_ring
+    write_queues=worker_write_queues
+    slab_ring=worker_slab_ring
+
+def get_adaptive_write_chunk(args,attribute_dtypes,task_tile_size,coord_tile_size):
+    '''
+    largest write chunk (at most --write_chunk bases, in whole coordinate tiles) for which the max_queue_size shared memory slabs, 
+    the parsing buffers of the workers and one copy of a block in each writer (read back when updating, or runs when writing sparse attributes) 
+    fit in mem_budget_fraction of max_mem_g 
+    '''
+    block_bytes_per_base=task_tile_size*sum([np.dtype(dtype).itemsize for dtype in attribute_dtypes.values()])
+    bytes_per_base=(args.max_queue_size+args.num_writers)*block_bytes_per_base+args.threads*worker_bytes_per_base
+    max_write_chunk=int(args.max_mem_g*(10**9)*mem_budget_fraction/bytes_per_base)
+    write_chunk=max([coord_tile_size,(min([args.write_chunk,max_write_chunk])//coord_tile_size)*coord_tile_size])
+    print("write chunk:"+str(write_chunk)+" bases ("+str(bytes_per_base)+" bytes per base across "+str(len(attribute_dtypes))+" attributes, "+str(args.max_queue_size)+" slabs and "+str(args.threads)+" workers)")
+    if write_chunk > max_write_chunk:
+        print("WARNING: a single coordinate tile per slab exceeds max_mem_g; reduce --max_queue_size or --task_tile_size")
+    return write_chunk
+
+class WriterThread(threading.Thread):
+    '''
+    array writer running in a thread of the ingest process (--executor thread or serial), with the exitcode of a Process 
+    '''
+    def __init__(self,target,args):
+        threading.Thread.__init__(self,target=target,args=args,daemon=True)
+        self.exitcode=None
+
+    def run(self):
+        try:
+            threading.Thread.run(self)
+            self.exitcode=0
+        except BaseException:
+            traceback.print_exc()
+            self.exitcode=1
+
+def start_array_writers(args,writer_args):
+    '''
+    starts one array writer for each list of arguments to write_array in writer_args, in a process or a thread depending on --executor 
+    '''
+    array_writers=[]
+    for cur_writer_args in writer_args:
+        if args.executor=='process':
+            array_writers.append(Process(target=write_array,args=cur_writer_args))
+        else:
+            array_writers.append(WriterThread(target=write_array,args=cur_writer_args))
+        array_writers[-1].start()
+    return array_writers
+
+def get_executor(args,write_queues,slab_ring):
+    '''
+    worker processes get the write queues and slabs when they are started; worker threads (and the serial executor) share them with the 
+    ingest process, so they are set once here 
+    '''
+    if args.executor=='process':
+        return BoundedProcessPoolExecutor(max_workers=args.threads,initializer=init_worker,initargs=(write_queues,slab_ring))
+    init_worker(write_queues,slab_ring,ignore_sigint=False)
+    if args.executor=='thread':
+        return BoundedThreadPoolExecutor(max_workers=args.threads)
+    return SerialExecutor()
 
 def kill_child_processes(parent_pid, sig=signal.SIGTERM):
     try:
@@ -80,10 +194,12 @@ def create_new_array(tdb_Context,
                      attribute_config_file,
                      compressor='gzip',
                      compression_level=-1,
-                     var=False):
+                     var=False,
+                     attribute_info=None):
     '''
     Creates an empty tileDB array
     size= tuple(num_indices,num_tasks)
+    attribute_info overrides attribute_config/attribute_config_file if provided 
     '''
     coord_tile_size=min(size[0],coord_tile_size)
     task_tile_size=max([1,min(size[1],task_tile_size)])
@@ -100,23 +216,38 @@ def create_new_array(tdb_Context,
     tiledb_dom = tiledb.Domain(tiledb_dim_coords,tiledb_dim_tasks,ctx=tdb_Context)
 
     #generate the attribute information
-    attribute_info=get_attribute_info(attribute_config,attribute_config_file)
-    attribs=[]
-    for key in attribute_info:
-        attribs.append(tiledb.Attr(
-            name=key,
-            var=var,
-            filters=tiledb.FilterList([tiledb.GzipFilter()]),
-            dtype=attribute_info[key]['dtype']))
-    
-    tiledb_schema = tiledb.ArraySchema(
-        domain=tiledb_dom,
-        attrs=tuple(attribs),
-        cell_order='row-major',
-        tile_order='row-major')
-    
-    tiledb.DenseArray.create(array_out_name, tiledb_schema)
-    print("created empty array on disk")
+    if attribute_info is None:
+        attribute_info=get_attribute_info(attribute_config,attribute_config_file)
+    #attributes with storage=separate are stored in their own array with the same domain 
+    attribute_arrays=group_attributes_by_array(array_out_name,attribute_info,list(attribute_info.keys()))
+    if len(attribute_arrays[array_out_name])==0:
+        raise Exception("at least one attribute must be stored in the main array:"+str(array_out_name))
+    for cur_array_name in attribute_arrays:
+        if (cur_array_name!=array_out_name) and (get_attribute_storage(attribute_info,attribute_arrays[cur_array_name][0])=='sparse'):
+            key=attribute_arrays[cur_array_name][0]
+            create_sparse_attribute_array(cur_array_name,
+                                          tiledb_dom,
+                                          key,
+                                          attribute_info[key]['dtype'],
+                                          get_filter_list(get_attribute_filters(attribute_info,key)))
+            print("created empty sparse array on disk:"+str(cur_array_name))
+            continue
+        attribs=[]
+        for key in attribute_arrays[cur_array_name]:
+            attribs.append(tiledb.Attr(
+                name=key,
+                var=var,
+                filters=get_filter_list(get_attribute_filters(attribute_info,key)),
+                dtype=attribute_info[key]['dtype']))
+
+        tiledb_schema = tiledb.ArraySchema(
+            domain=tiledb_dom,
+            attrs=tuple(attribs),
+            cell_order='row-major',
+            tile_order='row-major')
+
+        tiledb.DenseArray.create(cur_array_name, tiledb_schema)
+        print("created empty array on disk:"+str(cur_array_name))
     return
     
     
@@ -153,14 +284,9 @@ def open_data_for_parsing(row,attribute_info):
 def ingest(args):
     if type(args)==type({}):
         args=args_object_from_args_dict(args)
-    if args.write_chunk > max_write_chunk:
-        print("WARNING: You have specified a write_chunk size of"+str(args.write_chunk)+" but the maximum supported with python serialization is:"+str(max_write_chunk)+". It will be reset to "+str(max_write_chunk))
-        args.write_chunk=max_write_chunk
-
-    #create a queue to write the array
-    global write_queue
-    write_queue=Queue(maxsize=args.max_queue_size)
-
+    #memory of the ingest processes, used for backpressure and reported per stage 
+    memory_monitor=MemoryMonitor(interval=mem_sample_interval).start()
+    memory_monitor.set_stage('planning')
     #config
     tdb_Config=tiledb.Config(tdb_config_params)
     tdb_write_Context=tiledb.Ctx(config=tdb_Config)   
@@ -172,9 +298,16 @@ def ingest(args):
     attribute_config=args.attribute_config
     attribute_config_file=args.attribute_config_file
     updating=False
+    created=False
 
     attribute_info=get_attribute_info(args.attribute_config,args.attribute_config_file)
     tiledb_metadata=pd.read_csv(args.tiledb_metadata,header=0,sep='\t')
+    if args.update_attributes is not None:
+        #only parse & write the attributes that are being updated
+        for attribute in args.update_attributes:
+            assert attribute in attribute_info, "attribute:"+str(attribute)+" is not in the attribute config"
+            assert attribute in tiledb_metadata.columns, "attribute:"+str(attribute)+" is not a column of --tiledb_metadata"
+        tiledb_metadata=tiledb_metadata[['dataset']+list(args.update_attributes)]
     num_tasks=tiledb_metadata.shape[0]
     print("num_tasks:"+str(num_tasks))
     
@@ -184,16 +317,36 @@ def ingest(args):
     chrom_indices,num_indices=transform_chrom_size_to_indices(chrom_sizes)
     print("num_indices:"+str(num_indices))
     array_out_name=args.array_name
-    if tiledb.object_type(array_out_name) == "array":
-        if overwrite==False:
+    if args.append is True:
+        if tiledb.object_type(array_out_name) != "array":
+            raise Exception("array:"+str(array_out_name)+" does not exist; --append adds tasks to an existing array")
+        tiledb_metadata=get_tasks_to_append(array_out_name,tiledb_metadata,tdb_read_Context)
+        num_tasks=tiledb_metadata.shape[0]
+        print("appending "+str(num_tasks)+" new tasks to the existing array: "+str(array_out_name))
+        if num_tasks==0:
+            print("all datasets are already in the array, nothing to append")
+            memory_monitor.stop()
+            return
+    elif tiledb.object_type(array_out_name) == "array":
+        if args.update_attributes is not None:
+            print("updating the attributes: "+",".join(args.update_attributes)+" in the existing array: "+str(array_out_name))
+            tiledb_metadata=get_tasks_to_update(array_out_name,tiledb_metadata,tdb_read_Context)
+            updating=True
+        elif args.resume is True:
+            print("resuming ingest into the existing array: "+str(array_out_name))
+            updating=overwrite
+        elif overwrite==False:
             raise Exception("array:"+str(array_out_name) + "already exists; use the --overwrite flag to overwrite it. Exiting")
         else:
             print("warning: the array: "+str(array_out_name)+" already exists. You provided the --overwrite flag, so it will be updated/overwritten")
             updating=True
+    elif args.update_attributes is not None:
+        raise Exception("array:"+str(array_out_name)+" does not exist; --update_attributes updates an existing array")
     else:
         #create the array:
+        created=True
         create_new_array(tdb_Context=tdb_write_Context,
-                         size=(num_indices,num_tasks-1),
+                         size=(num_indices,max([num_tasks,args.max_tasks if args.max_tasks is not None else 0])-1),
                          attribute_config=attribute_config,
                          attribute_config_file=attribute_config_file,
                          array_out_name=array_out_name,
@@ -219,135 +372,672 @@ def ingest(args):
                 cur_array.meta['_'.join(['chrom',str(chrom_index)])]=metadata_dict['chroms'][chrom_index]
                 cur_array.meta['_'.join(['size',str(chrom_index)])]=metadata_dict['sizes'][chrom_index]
                 cur_array.meta['_'.join(['offset',str(chrom_index)])]=metadata_dict['offsets'][chrom_index]                                
+            for attribute in attribute_info:
+                cur_array.meta['_'.join(['storage',attribute])]=get_attribute_storage(attribute_info,attribute)
+                if get_attribute_scale(attribute_info,attribute) is not None:
+                    #readers divide the stored values by the scale
+                    cur_array.meta['_'.join(['scale',attribute])]=get_attribute_scale(attribute_info,attribute)
         print("created tiledb metadata")
-    pool=Pool(processes=args.threads,initializer=init_worker)
-    print("made pool") 
-    pool_inputs=[] 
-    for task_index,task_row in tiledb_metadata.iterrows():
-        dataset=task_row['dataset']
-        #read in filenames for bigwigs
-        data_dict=open_data_for_parsing(task_row,attribute_info)
-        for start_chunk_index in range(0,num_indices,args.write_chunk):
-            end_chunk_index=start_chunk_index+min([num_indices,args.write_chunk])
-            #convert global indices to chrom+pos indices
-            chunk_chrom_coords=transform_indices_to_chrom_coords(start_chunk_index,end_chunk_index,chrom_indices)
-            if chunk_chrom_coords is None:
-                raise Exception("failed to tranform indices:"+str(start_chunk_index)+"-"+str(end_chunk_index)+ " to chrom coords;"+str(chrom_indices))
-            for coord_set in chunk_chrom_coords:
-                pool_inputs.append((task_index,data_dict,attribute_info,coord_set,args))
-    pool_feed_chunk_start=0
-    pool_feed_chunk_max=len(pool_inputs)
-    chunks_to_process=len(pool_inputs)
-    array_writer=Process(target=write_array,args=([args,updating,chunks_to_process]))
-    try:
-        array_writer.start()
-    except Exception as e:
-        raise e
+    #tasks are written in blocks aligned to the task tiles of the array, so each block write fills whole tiles 
+    array_schema=tiledb.ArraySchema.load(array_out_name,ctx=tdb_read_Context)
+    task_tile_size=array_schema.domain.dim('task').tile
+    coord_tile_size=array_schema.domain.dim('genome_coordinate').tile
+    covered_intervals=get_covered_intervals(args,chrom_indices,num_indices,coord_tile_size)
+    if created is True:
+        record_covered_intervals(array_out_name,covered_intervals,tdb_write_Context,created=True)
+    task_blocks=get_task_blocks(list(tiledb_metadata.index),task_tile_size)
+    print("writing "+str(num_tasks)+" tasks in "+str(len(task_blocks))+" blocks of up to "+str(task_tile_size)+" tasks")
+    #when updating, the slabs only hold the attributes provided in tiledb_metadata
+    slab_attributes=[attribute for attribute in attribute_info if (updating is False) or (attribute in tiledb_metadata.columns)]
+    attribute_dtypes=get_array_attribute_dtypes(array_out_name,attribute_info,slab_attributes,tdb_read_Context)
+    #record the units that have been written, so that an interrupted ingest can be resumed 
+    manifest=IngestManifest(array_out_name)
+    if args.resume is True:
+        manifest.load()
+        #the units recorded in the manifest were planned with its chunk size (manifests that do not record it were planned with --write_chunk)
+        write_chunk=manifest.write_chunk if manifest.write_chunk is not None else args.write_chunk
+        print("resuming with the write chunk of the interrupted ingest:"+str(write_chunk))
+    elif created is True:
+        write_chunk=get_adaptive_write_chunk(args,attribute_dtypes,task_tile_size,coord_tile_size)
+        manifest.reset(write_chunk)
+    else:
+        #--append, --update_attributes and --overwrite keep the units of the tasks and attributes they do not rewrite, and plan their chunks 
+        #with the write chunk of the manifest, so that the array can still be resumed 
+        manifest.load()
+        if manifest.write_chunk is None:
+            manifest.write_chunk=get_adaptive_write_chunk(args,attribute_dtypes,task_tile_size,coord_tile_size)
+        write_chunk=manifest.write_chunk
+        print("writing with the write chunk of the ingest manifest:"+str(write_chunk))
+        manifest.discard(dict([(tiledb_metadata['dataset'].loc[task_index],get_task_attributes(tiledb_metadata.loc[task_index],attribute_info,updating)) for task_index in tiledb_metadata.index]))
+    #write chunks are aligned to the coordinate tiles of the array; consecutive small contigs are merged into one chunk 
+    chunks=plan_write_chunks(chrom_indices,num_indices,write_chunk,coord_tile_size,covered_intervals)
+    if len(chunks)==0:
+        raise Exception("none of --regions are on the chromosomes to ingest")
+    print("planned "+str(len(chunks))+" write chunks")
+    block_plan=plan_task_blocks(tiledb_metadata,attribute_info,task_blocks,chunks,manifest,updating)
+    blocks_to_process=len(block_plan)
+    print("blocks to process:"+str(blocks_to_process)+"/"+str(len(task_blocks)*len(chunks)))
+    #every slab holds the longest chunk 
+    slot_entries=max([chunk[1]-chunk[0] for chunk in chunks])
+    if args.work_dir is not None:
+        write_work_plan(args.work_dir,{'args':args,
+                                       'updating':updating,
+                                       'attribute_info':attribute_info,
+                                       'attribute_dtypes':attribute_dtypes,
+                                       'tiledb_metadata':tiledb_metadata,
+                                       'task_tile_size':int(task_tile_size),
+                                       'slot_entries':int(slot_entries),
+                                       'covered_intervals':covered_intervals,
+                                       'block_plan':block_plan})
+        memory_monitor.stop()
+        print("wrote the work plan of "+str(blocks_to_process)+" units to:"+str(args.work_dir)+"; run db_ingest --worker --work_dir "+str(args.work_dir)+" on any number of hosts, then db_ingest --finalize --work_dir "+str(args.work_dir))
+        return
+    telemetry_path=args.telemetry_file if args.telemetry_file is not None else get_telemetry_path(array_out_name)
+    telemetry=TelemetryLog(telemetry_path,mode='a' if args.resume is True else 'w')
+    telemetry.record('run',
+                     array_name=array_out_name,
+                     num_tasks=int(num_tasks),
+                     blocks=blocks_to_process,
+                     write_chunk=int(write_chunk),
+                     task_tile_size=int(task_tile_size),
+                     coord_tile_size=int(coord_tile_size),
+                     threads=args.threads,
+                     max_queue_size=args.max_queue_size,
+                     num_writers=args.num_writers,
+                     attributes=list(attribute_dtypes.keys()))
+    #the writers append their own events, so the file is reopened to record the end of the run 
+    telemetry.close()
+    scheduler_stats=run_block_plan(args,updating,tiledb_metadata,attribute_info,attribute_dtypes,task_tile_size,slot_entries,block_plan,manifest,telemetry_path,memory_monitor)
+    telemetry=TelemetryLog(telemetry_path)
+    telemetry.record('scheduler',**scheduler_stats)
+    telemetry.close()
+    print("telemetry written to:"+str(telemetry_path))
+    summarize_telemetry(telemetry_path)
+    if args.update_attributes is None:
+        record_covered_intervals(array_out_name,covered_intervals,tdb_write_Context)
+    if args.append is True:
+        #the new tasks are only registered once all of their data has been written 
+        register_appended_tasks(array_out_name,tiledb_metadata,tdb_write_Context)
+    if args.consolidate is True:
+        memory_monitor.set_stage('consolidation')
+        consolidate({'array_name':array_out_name,
+                     'fragment_size_mb':args.consolidation_fragment_size_mb,
+                     'memory_budget_mb':args.consolidation_memory_budget_mb})
+    memory_monitor.stop()
+    memory_monitor.report()
+    print('done!') 
 
+def run_block_plan(args,updating,tiledb_metadata,attribute_info,attribute_dtypes,task_tile_size,slot_entries,block_plan,manifest,telemetry_path,memory_monitor):
+    '''
+    decodes the blocks of tasks x chunk in block_plan with args.threads workers and writes them to the array with args.num_writers writers.
+    block_plan can be any iterable of blocks (i.e. the units claimed by a distributed worker), the writers are told how many blocks they
+    were sent once it is exhausted. returns the scheduler stats 
+    '''
+    #create a queue for each array writer; writer threads pass messages without pickling them 
+    queue_class=Queue if args.executor=='process' else queue.Queue
+    write_queues=[queue_class(maxsize=args.max_queue_size) for writer_index in range(args.num_writers)]
+    #workers decode chunks directly into shared memory slabs; only the slab index is passed through the write queue
+    slab_ring=SharedMemoryRing(num_slots=args.max_queue_size,
+                               slot_entries=slot_entries,
+                               attribute_dtypes=attribute_dtypes,
+                               slot_columns=task_tile_size)
+    print("allocated "+str(slab_ring.num_slots)+" shared memory slabs, Gigs:"+str(round(slab_ring.total_bytes()/(10**9),2)))
+    #the i'th block of the plan is written by writer i % num_writers. The read-back of a block when updating and the deletion of its 
+    #sparse runs only touch the block's own tasks x chunk region, so concurrent writers never read or write the same cells 
+    writer_args=[]
+    for writer_index in range(args.num_writers):
+        #each writer appends to the manifest through its own file handle, also when the writers are threads of one process 
+        writer_args.append([args,updating,write_queues[writer_index],slab_ring,copy.copy(manifest),dict(tiledb_metadata['dataset']),attribute_info,telemetry_path,writer_index])
+    memory_monitor.set_stage('ingest')
+    array_writers=start_array_writers(args,writer_args)
+    if args.executor=='process':
+        memory_monitor.set_writer_pids([array_writer.pid for array_writer in array_writers])
+    executor=get_executor(args,write_queues,slab_ring)
+    print("made pool") 
     try:
-        while pool_feed_chunk_start < pool_feed_chunk_max:
-            pool_feed_chunk_end=min([pool_feed_chunk_start+queue_feed_chunk_size,pool_feed_chunk_max])
-            #only do mapping if queue size is not exceeded & total memory consumption is not exceeded
-            write_queue_size=write_queue.qsize()
-            mem_used=psutil.virtual_memory().used / (10**9)
-            print("mapping to pool, queue size:"+str(write_queue_size))
-            print("mapping to pool, mem used:"+str(mem_used))
-            while (write_queue_size >=args.max_queue_size) or (mem_used >=args.max_mem_g):
-                time.sleep(10)
-            print("sending to pool:"+str(pool_feed_chunk_start)+"-"+str(pool_feed_chunk_end)+"/"+str(chunks_to_process))
-            pool.map(process_chunk,pool_inputs[pool_feed_chunk_start:pool_feed_chunk_end])
-            pool_feed_chunk_start+=queue_feed_chunk_size
-            time.sleep(60)
-        pool.close()
+        scheduler_stats=schedule_chunks(generate_block_inputs(tiledb_metadata,attribute_info,block_plan,args),
+                        executor,
+                        slab_ring,
+                        array_writers,
+                        memory_monitor,
+                        args)
+        #the writers exit once they have written the number of blocks they were sent, as messages from different worker processes 
+        #can reach a queue in any order 
+        for writer_index in range(args.num_writers):
+            write_queues[writer_index].put((len(range(writer_index,scheduler_stats['blocks'],args.num_writers)),0,time.time()))
+        print("shutting down pool")
+        executor.shutdown(wait=True)
+        #wait until we're done writing to the tiledb array
+        for array_writer in array_writers:
+            array_writer.join()
+            if array_writer.exitcode != 0:
+                raise Exception("array writer exited with code:"+str(array_writer.exitcode))
+        print("array_writer.join() is complete")
     except KeyboardInterrupt:
         kill_child_processes(os.getpid())
-        pool.terminate()
+        executor.shutdown(wait=False,cancel_futures=True)
+        memory_monitor.stop()
         raise
     except Exception as e:
         print(e)
         kill_child_processes(os.getpid())
+        executor.shutdown(wait=False,cancel_futures=True)
+        memory_monitor.stop()
         raise 
-        
-    #wait until we're done writing to the tiledb array
-    array_writer.join()
-    print("array_writer.join() is complete")
-    print("shutting down pool")
-    pool.join()
-    print('done!') 
+    finally:
+        slab_ring.close()
+        slab_ring.unlink()
+    return scheduler_stats
+
+#settings of a distributed worker that are specific to its host; all other settings come from the work plan 
+worker_host_options=['threads','executor','num_writers','max_queue_size','max_mem_g','bigwig_cache_size']
+
+def generate_claimed_blocks(work_dir,block_plan,claim_batch,worker_id):
+    '''
+    yields the blocks of the work plan claimed by this worker, claiming claim_batch units at a time 
+    '''
+    for batch in claim_units(work_dir,len(block_plan),claim_batch,worker_id):
+        print("worker "+worker_id+" claimed units "+",".join([str(unit_index) for unit_index in batch]))
+        for unit_index in batch:
+            yield block_plan[unit_index]
+
+def ingest_worker(args):
+    '''
+    claims units of the work plan in args.work_dir, args.claim_batch at a time, and writes them to the array until every unit has been claimed.
+    the units written are recorded in the worker's own manifest, so that workers on different hosts never append to the same file 
+    '''
+    if type(args)==type({}):
+        args=args_object_from_args_dict(args)
+    work_plan=load_work_plan(args.work_dir)
+    worker_args=work_plan['args']
+    for option in worker_host_options:
+        vars(worker_args)[option]=vars(args)[option]
+    worker_id=get_worker_id()
+    memory_monitor=MemoryMonitor(interval=mem_sample_interval).start()
+    memory_monitor.set_stage('ingest')
+    manifest=IngestManifest(worker_args.array_name,path=get_worker_manifest_path(args.work_dir,worker_id))
+    telemetry_path=get_worker_telemetry_path(args.work_dir,worker_id)
+    telemetry=TelemetryLog(telemetry_path,mode='w')
+    telemetry.record('run',
+                     array_name=worker_args.array_name,
+                     worker=worker_id,
+                     threads=worker_args.threads,
+                     max_queue_size=worker_args.max_queue_size,
+                     num_writers=worker_args.num_writers)
+    telemetry.close()
+    #the units are claimed as the pipeline pulls them, so the workers, writers and slabs are set up once for all the units of the worker 
+    scheduler_stats=run_block_plan(worker_args,
+                                   work_plan['updating'],
+                                   work_plan['tiledb_metadata'],
+                                   work_plan['attribute_info'],
+                                   work_plan['attribute_dtypes'],
+                                   work_plan['task_tile_size'],
+                                   work_plan['slot_entries'],
+                                   generate_claimed_blocks(args.work_dir,work_plan['block_plan'],args.claim_batch,worker_id),
+                                   manifest,
+                                   telemetry_path,
+                                   memory_monitor)
+    units_written=scheduler_stats['blocks']
+    telemetry=TelemetryLog(telemetry_path)
+    telemetry.record('scheduler',**scheduler_stats)
+    telemetry.close()
+    print("worker "+worker_id+" wrote "+str(units_written)+" units; no unclaimed units are left")
+    if units_written > 0:
+        summarize_telemetry(telemetry_path)
+    memory_monitor.stop()
+    memory_monitor.report()
+
+def finalize_ingest(args):
+    '''
+    checks that every unit of the work plan in args.work_dir is recorded in the manifest of a worker, merges the worker manifests into 
+    the manifest of the array (so the array can later be resumed or updated like any other), registers appended tasks and consolidates
+    '''
+    if type(args)==type({}):
+        args=args_object_from_args_dict(args)
+    work_plan=load_work_plan(args.work_dir)
+    plan_args=work_plan['args']
+    tiledb_metadata=work_plan['tiledb_metadata']
+    manifest=load_worker_manifests(args.work_dir,plan_args.array_name)
+    incomplete_units=[]
+    for unit_index,(block_tasks,chunk) in enumerate(work_plan['block_plan']):
+        for task_index in block_tasks:
+            attributes=get_task_attributes(tiledb_metadata.loc[task_index],work_plan['attribute_info'],work_plan['updating'])
+            if not manifest.is_complete(tiledb_metadata['dataset'].loc[task_index],chunk[0],chunk[1],attributes):
+                incomplete_units.append(unit_index)
+                break
+    if len(incomplete_units) > 0:
+        for unit_index in incomplete_units:
+            print("unit "+str(unit_index)+" was not written; claimed by:"+str(get_claim_owner(args.work_dir,unit_index)))
+            if args.release_incomplete is True:
+                release_claim(args.work_dir,unit_index)
+        if args.release_incomplete is True:
+            print("released the claims of the incomplete units; run more workers, then finalize again")
+        raise Exception(str(len(incomplete_units))+" of "+str(len(work_plan['block_plan']))+" units of the work plan have not been written")
+    IngestManifest(plan_args.array_name).record_units(manifest.completed)
+    print("all "+str(len(work_plan['block_plan']))+" units of the work plan have been written")
+    tdb_Context=tiledb.Ctx(config=tiledb.Config(tdb_config_params))
+    if plan_args.update_attributes is None:
+        record_covered_intervals(plan_args.array_name,work_plan['covered_intervals'],tdb_Context)
+    if plan_args.append is True:
+        register_appended_tasks(plan_args.array_name,tiledb_metadata,tdb_Context)
+    if args.consolidate is True:
+        consolidate({'array_name':plan_args.array_name,
+                     'fragment_size_mb':args.consolidation_fragment_size_mb,
+                     'memory_budget_mb':args.consolidation_memory_budget_mb})
+    print('done!')
+
+def get_covered_intervals(args,chrom_indices,num_indices,coord_tile_size):
+    '''
+    returns the merged (start_index, end_index) intervals of the coordinate axis selected by --chroms_to_keep, --chroms_to_exclude and 
+    --regions, or None to ingest the whole coordinate axis 
+    '''
+    if (args.chroms_to_keep is None) and (args.chroms_to_exclude is None) and (args.regions is None):
+        return None
+    chroms=get_chroms_to_ingest(chrom_indices,args.chroms_to_keep,args.chroms_to_exclude)
+    regions=None
+    if args.regions is not None:
+        regions=pd.read_csv(args.regions,header=None,sep='\t',usecols=[0,1,2],comment='#')
+        print("loaded "+str(regions.shape[0])+" regions from:"+str(args.regions))
+    covered_intervals=get_ingest_intervals(chrom_indices,coord_tile_size,chroms,regions,args.region_padding)
+    covered_bases=sum([end-start for start,end in covered_intervals])
+    print("ingesting "+str(covered_bases)+" of "+str(num_indices)+" bases ("+str(round(100*covered_bases/num_indices,2))+"%) in "+str(len(covered_intervals))+" intervals")
+    return covered_intervals
+
+def record_covered_intervals(array_out_name,covered_intervals,tdb_Context,created=False):
+    '''
+    records the intervals of the coordinate axis that hold data as the covered_start and covered_end (int64 arrays of start and end indices)
+    metadata of the array. Arrays without these keys hold data everywhere: they are recorded when a restricted ingest creates the array, 
+    merged with the intervals of later restricted ingests into it, and removed by an ingest of the whole coordinate axis (covered_intervals=None).
+    The intervals are shared by all tasks and attributes, so they are not recorded for --update_attributes, which only rewrites some of them
+    '''
+    with tiledb.DenseArray(array_out_name,ctx=tdb_Context,mode='r') as cur_array:
+        #array metadata values are only valid while the array is open 
+        array_meta=dict([(key,np.array(cur_array.meta[key])) for key in ['covered_start','covered_end'] if key in cur_array.meta])
+    if 'covered_start' not in array_meta:
+        if (created is False) or (covered_intervals is None):
+            return
+    elif covered_intervals is not None:
+        covered_intervals=merge_intervals(np.append(array_meta['covered_start'],[start for start,end in covered_intervals]).astype(np.int64),
+                                          np.append(array_meta['covered_end'],[end for start,end in covered_intervals]).astype(np.int64))
+    with tiledb.DenseArray(array_out_name,ctx=tdb_Context,mode='w') as cur_array:
+        if covered_intervals is None:
+            del cur_array.meta['covered_start']
+            del cur_array.meta['covered_end']
+            print("the whole coordinate axis of "+str(array_out_name)+" is now covered")
+            return
+        cur_array.meta['covered_start']=np.array([start for start,end in covered_intervals],dtype=np.int64)
+        cur_array.meta['covered_end']=np.array([end for start,end in covered_intervals],dtype=np.int64)
+    print("recorded "+str(len(covered_intervals))+" covered intervals in the metadata of:"+str(array_out_name))
+
+def get_array_attribute_dtypes(array_out_name,attribute_info,attributes,tdb_Context):
+    '''
+    returns an ordered dictionary of attribute -> dtype of the attribute in the array that stores it.
+    The arrays are the source of truth, so that an array created with a different dtype (or scale) than the current attribute config 
+    is either written with its own dtype or rejected.
+    '''
+    with tiledb.DenseArray(array_out_name,ctx=tdb_Context,mode='r') as cur_array:
+        array_meta=dict(cur_array.meta.items())
+    attribute_dtypes=OrderedDict()
+    attribute_arrays=group_attributes_by_array(array_out_name,attribute_info,attributes)
+    for cur_array_name in attribute_arrays:
+        if tiledb.object_type(cur_array_name) != "array":
+            raise Exception("array:"+str(cur_array_name)+" does not exist; it should store the attributes configured with storage=separate")
+        array_schema=tiledb.ArraySchema.load(cur_array_name,ctx=tdb_Context)
+        for attribute in attribute_arrays[cur_array_name]:
+            attribute_dtypes[attribute]=array_schema.attr(attribute).dtype
+            stored_scale=array_meta.get('_'.join(['scale',attribute]))
+            if stored_scale != get_attribute_scale(attribute_info,attribute):
+                raise Exception("attribute:"+str(attribute)+" is stored with scale:"+str(stored_scale)+" in array:"+str(array_out_name)+", but the attribute config has scale:"+str(get_attribute_scale(attribute_info,attribute)))
+    return OrderedDict([(attribute,attribute_dtypes[attribute]) for attribute in attributes])
+
+def get_tasks_to_append(array_out_name,tiledb_metadata,tdb_Context):
+    '''
+    returns the rows of tiledb_metadata whose dataset is not yet stored in the array, indexed by the task index they will be written to 
+    '''
+    with tiledb.DenseArray(array_out_name,ctx=tdb_Context,mode='r') as cur_array:
+        num_existing_tasks=cur_array.meta['num_tasks']
+        existing_tasks=set([cur_array.meta['_'.join(['task',str(task_index)])] for task_index in range(num_existing_tasks)])
+        max_task_index=cur_array.schema.domain.dim('task').domain[1]
+    new_tasks=tiledb_metadata[~tiledb_metadata['dataset'].isin(existing_tasks)].copy()
+    print("skipping "+str(tiledb_metadata.shape[0]-new_tasks.shape[0])+" datasets that are already in the array")
+    new_tasks.index=range(num_existing_tasks,num_existing_tasks+new_tasks.shape[0])
+    if (new_tasks.shape[0] > 0) and (new_tasks.index[-1] > max_task_index):
+        raise Exception("the array:"+str(array_out_name)+" has room for "+str(max_task_index+1)+" tasks, and cannot hold "+str(new_tasks.shape[0])+" more tasks in addition to the "+str(num_existing_tasks)+" existing ones. Use --max_tasks to reserve a larger task axis when creating the array")
+    return new_tasks
+
+def get_tasks_to_update(array_out_name,tiledb_metadata,tdb_Context):
+    '''
+    returns the rows of tiledb_metadata indexed by the task index their dataset is stored at in the array, so that a metadata sheet 
+    with a subset of the tasks, or with the tasks in a different order, updates the right tasks 
+    '''
+    with tiledb.DenseArray(array_out_name,ctx=tdb_Context,mode='r') as cur_array:
+        task_indices=dict([(cur_array.meta['_'.join(['task',str(task_index)])],task_index) for task_index in range(cur_array.meta['num_tasks'])])
+    unknown_tasks=[dataset for dataset in tiledb_metadata['dataset'] if dataset not in task_indices]
+    if len(unknown_tasks) > 0:
+        raise Exception("the datasets:"+",".join([str(dataset) for dataset in unknown_tasks])+" are not tasks of the array:"+str(array_out_name)+"; use --append to add new tasks")
+    if tiledb_metadata['dataset'].duplicated().any():
+        raise Exception("--tiledb_metadata lists the datasets:"+",".join(tiledb_metadata['dataset'][tiledb_metadata['dataset'].duplicated()].astype(str))+" more than once")
+    tasks_to_update=tiledb_metadata.copy()
+    tasks_to_update.index=[task_indices[dataset] for dataset in tiledb_metadata['dataset']]
+    return tasks_to_update
+
+def register_appended_tasks(array_out_name,tiledb_metadata,tdb_Context):
+    with tiledb.DenseArray(array_out_name,ctx=tdb_Context,mode='w') as cur_array:
+        for task_index,dataset in tiledb_metadata['dataset'].items():
+            cur_array.meta['_'.join(['task',str(task_index)])]=dataset
+        cur_array.meta['num_tasks']=int(tiledb_metadata.index[-1])+1
+    print("registered "+str(tiledb_metadata.shape[0])+" appended tasks in the array metadata")
+
+def get_task_blocks(task_indices,task_tile_size):
+    '''
+    groups the task indices into blocks aligned to the task tiles of the array 
+    '''
+    task_blocks=[]
+    for task_index in sorted(task_indices):
+        if (len(task_blocks) > 0) and (task_blocks[-1][0]//task_tile_size == task_index//task_tile_size):
+            task_blocks[-1].append(task_index)
+        else:
+            task_blocks.append([task_index])
+    return task_blocks
+
+def get_contiguous_task_runs(block_tasks):
+    '''
+    splits a sorted list of task indices into runs of consecutive indices, returns a list of (first task, last task + 1) 
+    '''
+    runs=[]
+    for task_index in block_tasks:
+        if (len(runs) > 0) and (runs[-1][1]==task_index):
+            runs[-1][1]=task_index+1
+        else:
+            runs.append([task_index,task_index+1])
+    return runs
+
+def get_task_attributes(task_row,attribute_info,updating):
+    '''
+    attributes written for a task: all attributes for a new array (missing ones are filled in), only the provided ones when updating 
+    '''
+    if updating is False:
+        return list(attribute_info.keys())
+    return [col for col in task_row.index if (col in attribute_info) and isinstance(task_row[col],str)]
+
+def plan_task_blocks(tiledb_metadata,attribute_info,task_blocks,chunks,manifest,updating):
+    '''
+    returns a list of (block_tasks, chunk) to process, leaving out the tasks whose units for the chunk are already recorded in the manifest
+    '''
+    block_plan=[]
+    for block_tasks in task_blocks:
+        task_attributes=[get_task_attributes(tiledb_metadata.loc[task_index],attribute_info,updating) for task_index in block_tasks]
+        for chunk in chunks:
+            remaining_tasks=[task_index for task_index,attributes in zip(block_tasks,task_attributes)
+                             if not manifest.is_complete(tiledb_metadata['dataset'].loc[task_index],chunk[0],chunk[1],attributes)]
+            if len(remaining_tasks) > 0:
+                block_plan.append((remaining_tasks,chunk))
+    return block_plan
+
+def generate_block_inputs(tiledb_metadata,attribute_info,block_plan,args):
+    '''
+    lazily yields (block_tasks, inputs to process_chunk for each task in the block) for every block of tasks x chunk in the plan;
+    the data files for a task are opened when its first chunk is scheduled
+    '''
+    data_dicts={}
+    for block_tasks,chunk in block_plan:
+        for task_index in block_tasks:
+            if task_index not in data_dicts:
+                #read in filenames for bigwigs
+                data_dicts[task_index]=open_data_for_parsing(tiledb_metadata.loc[task_index],attribute_info)
+        #the chromosome coordinates of each chunk are the same for every task 
+        yield block_tasks,[(task_index,data_dicts[task_index],attribute_info,chunk,args) for task_index in block_tasks]
+
+def check_pending_chunks(pending,array_writers,worker_cache_stats):
+    '''
+    drops completed chunks from the pending set, re-raising any exception from the workers, and makes sure no writer has failed
+    (a writer exits with code 0 once it has written all of its blocks).
+    each worker reports the hit/miss counters of its bigwig handle cache, these are stored in worker_cache_stats 
+    '''
+    for future in [future for future in pending if future.done()]:
+        pending.remove(future)
+        cache_stats=future.result()
+        worker_cache_stats[cache_stats['worker']]=cache_stats
+    for array_writer in array_writers:
+        if array_writer.exitcode not in [None,0]:
+            raise Exception("array writer exited with code:"+str(array_writer.exitcode))
+
+def schedule_chunks(block_inputs,executor,slab_ring,array_writers,memory_monitor,args):
+    '''
+    streams chunks to the worker pool, keeping at most max_queue_size blocks of tasks x chunk (one per shared memory slab) in flight.
+    a new block is submitted as soon as the writer acknowledges an earlier one, provided the memory of the ingest processes is below max_mem_g. 
+    '''
+    pending=set()
+    worker_cache_stats={}
+    blocks_submitted=0
+    #seconds spent waiting for memory to drop below max_mem_g, and for the writer to release a slab 
+    scheduler_stats={'memory_wait':0,'slab_wait':0}
+    for block_tasks,chunk_inputs in block_inputs:
+        #if we are over the memory budget, wait for the writer to drain the chunks in flight
+        step_start=time.perf_counter()
+        mem_used=memory_monitor.mem_used_g()
+        while (mem_used >= args.max_mem_g) and (slab_ring.in_flight() > 0):
+            print("mem used:"+str(round(mem_used,2))+" exceeds max_mem_g, waiting for writer; blocks in flight:"+str(slab_ring.in_flight()))
+            slab_ring.collect_acks(timeout=ack_timeout)
+            check_pending_chunks(pending,array_writers,worker_cache_stats)
+            mem_used=memory_monitor.sample()
+        scheduler_stats['memory_wait']+=time.perf_counter()-step_start
+        step_start=time.perf_counter()
+        slot=None
+        while slot is None:
+            slot=slab_ring.acquire(timeout=ack_timeout)
+            check_pending_chunks(pending,array_writers,worker_cache_stats)
+        scheduler_stats['slab_wait']+=time.perf_counter()-step_start
+        #each task in the block decodes into its own column of the slab, and is sent to the writer that owns the block 
+        writer_index=blocks_submitted % len(array_writers)
+        for chunk_input in chunk_inputs:
+            pending.add(executor.submit(process_chunk,chunk_input+(slot,block_tasks,writer_index)))
+        blocks_submitted+=1
+        print("submitted block "+str(blocks_submitted)+"; blocks in flight:"+str(slab_ring.in_flight())+"; mem used:"+str(round(mem_used,2)))
+    while len(pending) > 0:
+        concurrent.futures.wait(pending,timeout=ack_timeout,return_when=concurrent.futures.FIRST_EXCEPTION)
+        check_pending_chunks(pending,array_writers,worker_cache_stats)
+    hits,misses=sum_cache_stats(worker_cache_stats)
+    print("bigwig handle cache across "+str(len(worker_cache_stats))+" workers: hits:"+str(hits)+" misses:"+str(misses))
+    scheduler_stats['blocks']=blocks_submitted
+    scheduler_stats['bigwig_cache_hits']=hits
+    scheduler_stats['bigwig_cache_misses']=misses
+    return scheduler_stats
 
 def process_chunk(inputs):
     try:
         task_index=inputs[0]
         data_dict=inputs[1]
         attribute_info=inputs[2]
-        coord_set=inputs[3]
+        chunk=inputs[3]
         args=inputs[4]
+        slot=inputs[5]
+        block_tasks=inputs[6]
+        writer_index=inputs[7]
 
-        attribute_config=args.attribute_config
-        dict_to_write=OrderedDict()
-        chrom=coord_set[0]
-        start_pos=coord_set[1]
-        end_pos=coord_set[2]
-        start_index=coord_set[3]
-        end_index=coord_set[4] 
-        for attribute in data_dict:
-            cur_parser=attribute_info[attribute]['parser']
-            cur_vals=cur_parser([data_dict[attribute],chrom,start_pos,end_pos,attribute_info[attribute]])
-            dict_to_write[attribute]=cur_vals[-1] #the last entry in the tuple is the actual numpy array of values; the first entries store start and end blocks
-        payload=pickle.dumps([task_index,start_index,end_index,dict_to_write],pickle.HIGHEST_PROTOCOL)
-        write_queue.put(payload)
-        gc.collect()
+        start_index=chunk[0]
+        end_index=chunk[1]
+        bigwig_handle_cache.max_size=args.bigwig_cache_size
+        #decode every attribute directly into this task's column of the shared memory slab reserved by the scheduler 
+        #block_tasks can skip tasks that were already written when resuming, but always lies within one task tile 
+        column=task_index-block_tasks[0]
+        timings={'parse_time':{},'fill_time':0,'started_at':time.time()}
+        slot_views=slab_ring.views(slot,end_index-start_index)
+        for attribute in slot_views:
+            step_start=time.perf_counter()
+            if attribute in data_dict:
+                cur_parser=attribute_info[attribute]['parser']
+                #a chunk can span several contigs, parse each of them separately into its rows of the slab 
+                for chrom,start_pos,end_pos,piece_start_index,piece_end_index in chunk[2]:
+                    piece_rows=slice(piece_start_index-start_index,piece_end_index-start_index)
+                    cur_parser([data_dict[attribute],chrom,start_pos,end_pos,attribute_info[attribute],slot_views[attribute][piece_rows,column]])
+                timings['parse_time'][attribute]=time.perf_counter()-step_start
+            else:
+                #attribute is not provided for this task, use a nan array (or 0 array for integer attributes) 
+                slot_views[attribute][:,column]=get_fill_value(slot_views[attribute].dtype)
+                timings['fill_time']+=time.perf_counter()-step_start
+        del slot_views
+        step_start=time.perf_counter()
+        message=(task_index,start_index,end_index,slot,list(data_dict.keys()),block_tasks,timings)
+        if args.executor=='process':
+            #the message is pickled here rather than in the background thread of the queue, so that serialization can be timed 
+            message=pickle.dumps(message)
+        write_queues[writer_index].put((message,time.perf_counter()-step_start,time.time()))
+        return bigwig_handle_cache.stats()
     except: 
-        kill_child_processes(os.getpid())
+        if multiprocessing.parent_process() is not None:
+            kill_child_processes(os.getpid())
         raise
 
-def write_array(args, updating, chunks_to_process):    
+def get_write_timestamp(last_timestamp,writer_index,num_writers):
+    '''
+    timestamp (ms) of the next fragment of a writer: later than its last fragment, and never used by another writer.
+    writer processes forked from the ingest process generate the same sequence of fragment uuids, so two fragments
+    written in the same ms by different writers would otherwise get the same name 
+    '''
+    timestamp=max(int(time.time()*1000),last_timestamp+1)
+    return timestamp+(writer_index-timestamp)%num_writers
+
+def write_array(args, updating, write_queue, slab_ring, manifest, datasets, attribute_info, telemetry_path, writer_index=0):    
     try:
+        telemetry=TelemetryLog(telemetry_path)
         #config
         tdb_Config=tiledb.Config(tdb_config_params)
         tdb_write_Context=tiledb.Ctx(config=tdb_Config)   
-        
-        if updating is True:
-            tdb_read_Context=tiledb.Ctx(config=tdb_Config)
-            cur_array_toread=tiledb.DenseArray(args.array_name,ctx=tdb_read_Context,mode='r')
-        cur_array_towrite=tiledb.DenseArray(args.array_name,ctx=tdb_write_Context,mode='w')
-        chunks_processed=0
-        while chunks_processed < chunks_to_process:
-            while write_queue.empty() is True:
-                time.sleep(10)
-            processed_chunk=write_queue.get()
-            processed_chunk_unpickled=pickle.loads(processed_chunk)
-            task_index=processed_chunk_unpickled[0]
-            start_index=processed_chunk_unpickled[1]
-            end_index=processed_chunk_unpickled[2]
-            dict_to_write=processed_chunk_unpickled[3]
+        tdb_read_Context=tiledb.Ctx(config=tdb_Config)
+        #array path -> (array to read when updating, all attributes stored in the array)
+        #only the arrays that store one of the attributes in the slabs are opened for reading; every write opens its array 
+        #with the timestamp of the fragment (see get_write_timestamp) 
+        target_arrays=OrderedDict()
+        sparse_arrays=set()
+        for cur_array_name,cur_attributes in group_attributes_by_array(args.array_name,attribute_info,list(slab_ring.attribute_offsets.keys())).items():
+            if (cur_array_name!=args.array_name) and (get_attribute_storage(attribute_info,cur_attributes[0])=='sparse'):
+                sparse_arrays.add(cur_array_name)
+                target_arrays[cur_array_name]=(None,cur_attributes)
+                continue
+            cur_array_toread=None
             if updating is True:
-                #we are only updating some attributes in the array
-                cur_vals=cur_array_toread[start_index:end_index,task_index]            
-                #print("got cur vals for task "+str(task_index)+" for "+str(start_index)+":"+str(end_index))
-                for key in dict_to_write:
-                    cur_vals[key]=dict_to_write[key]
-                dict_to_write=cur_vals
-                print("updated data dict for writing:"+args.array_name) 
-            else:
-                #we are writing for the first time, make sure all attributes are provided, if some are not, use a nan array
-                required_attrib=list(get_attribute_info(args.attribute_config,args.attribute_config_file).keys())
-                #print(str(required_attrib))
-                for attrib in required_attrib:
-                    if attrib not in dict_to_write:
-                        print("augmenting")
-                        dict_to_write[attrib]=np.full(end_index-start_index,np.nan)
-            #write in chunks
-            cur_array_towrite[start_index:end_index,task_index]=dict_to_write
-            print('Gigs:', round(psutil.virtual_memory().used / (10**9), 2))
-            gc.collect()
-            chunks_processed+=1
-            print("wrote to disk "+str(task_index)+" for "+str(start_index)+":"+str(end_index)+";"+str(chunks_processed)+"/"+str(chunks_to_process))
-        assert chunks_processed >=chunks_to_process
+                cur_array_toread=tiledb.DenseArray(cur_array_name,ctx=tdb_read_Context,mode='r')
+            target_arrays[cur_array_name]=(cur_array_toread,[attr.name for attr in tiledb.ArraySchema.load(cur_array_name,ctx=tdb_read_Context)])
+        write_timestamp=0
+        blocks_processed=0
+        #the number of blocks sent to this writer, which is only known once the scheduler has submitted every block 
+        blocks_to_process=None
+        #slot -> {task index : (attributes parsed for the task, worker timings)} for the blocks that are still being decoded by the workers 
+        partial_blocks={}
+        while (blocks_to_process is None) or (blocks_processed < blocks_to_process):
+            message,serialize_time,enqueued_at=write_queue.get()
+            if type(message)==int:
+                blocks_to_process=message
+                continue
+            received_at=time.time()
+            step_start=time.perf_counter()
+            if type(message)==bytes:
+                message=pickle.loads(message)
+            task_index,start_index,end_index,slot,parsed_attributes,block_tasks,timings=message
+            timings['serialize_time']=serialize_time+time.perf_counter()-step_start
+            timings['queue_wait']=received_at-enqueued_at
+            timings['received_at']=received_at
+            if slot not in partial_blocks:
+                partial_blocks[slot]={}
+            partial_blocks[slot][task_index]=(parsed_attributes,timings)
+            if len(partial_blocks[slot]) < len(block_tasks):
+                continue
+            block_messages=partial_blocks.pop(slot)
+            block_parsed_attributes=dict([(cur_task,block_messages[cur_task][0]) for cur_task in block_messages])
+            block_timings=[block_messages[cur_task][1] for cur_task in block_messages]
+            write_time=OrderedDict()
+            read_back_time=0
+            bytes_written=0
+            #the slab views are handed to tileDB without copying; attributes missing for a task were filled by the worker
+            slot_views=slab_ring.views(slot,end_index-start_index)
+            for first_task,last_task in get_contiguous_task_runs(block_tasks):
+                run_tasks=range(first_task,last_task)
+                #attributes written for each task: all attributes for a new array, only the parsed ones when updating 
+                task_attributes=dict([(cur_task,block_parsed_attributes[cur_task] if updating is True else list(slot_views.keys())) for cur_task in run_tasks])
+                for cur_array_name in target_arrays:
+                    cur_array_toread,array_attributes=target_arrays[cur_array_name]
+                    if not any([attribute in task_attributes[cur_task] for attribute in array_attributes for cur_task in run_tasks]):
+                        #none of the attributes stored in this array changed 
+                        continue
+                    if cur_array_name in sparse_arrays:
+                        #only the runs of the tasks whose attribute changed are replaced; the other tasks keep their runs 
+                        attribute=array_attributes[0]
+                        for first_sparse_task,last_sparse_task in get_contiguous_task_runs([cur_task for cur_task in run_tasks if attribute in task_attributes[cur_task]]):
+                            if updating is True:
+                                write_timestamp=get_write_timestamp(write_timestamp,writer_index,args.num_writers)
+                                delete_sparse_runs(cur_array_name,tdb_write_Context,start_index,end_index,first_sparse_task,last_sparse_task,write_timestamp)
+                            #the new runs get a later timestamp than the delete 
+                            write_timestamp=get_write_timestamp(write_timestamp,writer_index,args.num_writers)
+                            step_start=time.perf_counter()
+                            with tiledb.open(cur_array_name,mode='w',ctx=tdb_write_Context,timestamp=write_timestamp) as cur_sparse_array:
+                                num_runs=write_sparse_runs(cur_sparse_array,attribute,slot_views[attribute],start_index,block_tasks[0],range(first_sparse_task,last_sparse_task))
+                            write_time[cur_array_name]=write_time.get(cur_array_name,0)+time.perf_counter()-step_start
+                            #value, run end and the two coordinates of every run 
+                            bytes_written+=num_runs*(slot_views[attribute].dtype.itemsize+12)
+                        continue
+                    #attributes that are not replaced for every task of the run are read back, so that the other tasks keep their current values
+                    attributes_to_read=[attribute for attribute in array_attributes if not all([attribute in task_attributes[cur_task] for cur_task in run_tasks])]
+                    if len(attributes_to_read) > 0:
+                        step_start=time.perf_counter()
+                        cur_vals=cur_array_toread.query(attrs=attributes_to_read)[start_index:end_index,first_task:last_task]
+                        read_back_time+=time.perf_counter()-step_start
+                    dict_to_write=OrderedDict()
+                    for attribute in array_attributes:
+                        if attribute in attributes_to_read:
+                            for cur_task in run_tasks:
+                                if attribute in task_attributes[cur_task]:
+                                    cur_vals[attribute][:,cur_task-first_task]=slot_views[attribute][:,cur_task-block_tasks[0]]
+                            dict_to_write[attribute]=cur_vals[attribute]
+                        else:
+                            dict_to_write[attribute]=slot_views[attribute][:,first_task-block_tasks[0]:last_task-block_tasks[0]]
+                    #write the whole block of tasks in a single 2-D write 
+                    write_timestamp=get_write_timestamp(write_timestamp,writer_index,args.num_writers)
+                    step_start=time.perf_counter()
+                    with tiledb.DenseArray(cur_array_name,ctx=tdb_write_Context,mode='w',timestamp=write_timestamp) as cur_array_towrite:
+                        cur_array_towrite[start_index:end_index,first_task:last_task]=dict_to_write
+                    write_time[cur_array_name]=write_time.get(cur_array_name,0)+time.perf_counter()-step_start
+                    bytes_written+=sum([dict_to_write[attribute].nbytes for attribute in dict_to_write])
+                    del dict_to_write
+                    if len(attributes_to_read) > 0:
+                        print("read back "+",".join(attributes_to_read)+" to update:"+cur_array_name) 
+                        del cur_vals
+                for cur_task in run_tasks:
+                    manifest.record(datasets[cur_task],start_index,end_index,task_attributes[cur_task])
+            del slot_views
+            slab_ring.release(slot)
+            finished_at=time.time()
+            num_bases=end_index-start_index
+            parse_time={}
+            for cur_timings in block_timings:
+                for attribute,attribute_parse_time in cur_timings['parse_time'].items():
+                    parse_time[attribute]=parse_time.get(attribute,0)+attribute_parse_time
+            telemetry.record('block',
+                             writer=writer_index,
+                             tasks=[int(block_tasks[0]),int(block_tasks[-1])],
+                             start_index=int(start_index),
+                             end_index=int(end_index),
+                             bases=int(num_bases),
+                             num_tasks=len(block_tasks),
+                             parse_time=parse_time,
+                             fill_time=sum([cur_timings['fill_time'] for cur_timings in block_timings]),
+                             serialize_time=sum([cur_timings['serialize_time'] for cur_timings in block_timings]),
+                             queue_wait=sum([cur_timings['queue_wait'] for cur_timings in block_timings]),
+                             block_assembly_wait=max([cur_timings['received_at'] for cur_timings in block_timings])-min([cur_timings['received_at'] for cur_timings in block_timings]),
+                             read_back_time=read_back_time,
+                             write_time=write_time,
+                             bytes_written=int(bytes_written),
+                             bases_per_sec=num_bases*len(block_tasks)/(finished_at-min([cur_timings['started_at'] for cur_timings in block_timings])),
+                             writer_mem_g=get_process_mem_g())
+            blocks_processed+=1
+            print("writer "+str(writer_index)+" wrote to disk tasks "+str(block_tasks[0])+"-"+str(block_tasks[-1])+" for "+str(start_index)+":"+str(end_index)+"; blocks written:"+str(blocks_processed))
         print("closing arrays")
-        if updating is True:
-            cur_array_toread.close()
-        cur_array_towrite.close()
+        for cur_array_name in target_arrays:
+            cur_array_toread,array_attributes=target_arrays[cur_array_name]
+            if cur_array_toread is not None:
+                cur_array_toread.close()
+        manifest.close()
+        telemetry.close()
         return 
 
     except KeyboardInterrupt:
@@ -356,13 +1046,20 @@ def write_array(args, updating, chunks_to_process):
         raise
     except Exception as e:
         print(e)
-        kill_child_processes(os.getpid())
-        raise Exception(e.message) 
+        #a writer thread must not kill the children of the ingest process
+        if multiprocessing.parent_process() is not None:
+            kill_child_processes(os.getpid())
+        raise
 
     
 def main():
     args=parse_args()
-    ingest(args)
+    if args.worker is True:
+        ingest_worker(args)
+    elif args.finalize is True:
+        finalize_ingest(args)
+    else:
+        ingest(args)
         
 if __name__=="__main__":
     main() 
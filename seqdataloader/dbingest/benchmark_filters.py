@@ -0,0 +1,174 @@
+## benchmarks tileDB filter pipelines on a sample region of the data to be ingested. For each attribute and each pipeline,
+## the sample is written to a single-attribute array and the compression ratio, write throughput and random-read latency are reported
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import argparse
+import os
+import re
+import shutil
+import tempfile
+import time
+from urllib.parse import urlparse
+import tiledb
+import pandas as pd
+import numpy as np
+from ..attrib_config import *
+from ..tdb_config import *
+from .consolidate import measure_read_latency
+
+default_pipelines=['gzip',
+                   'zstd:1',
+                   'zstd:3',
+                   'lz4',
+                   'byteshuffle,zstd:3',
+                   'bitshuffle,zstd:3',
+                   'bitshuffle,lz4',
+                   'rle',
+                   'delta,zstd:3']
+
+def args_object_from_args_dict(args_dict):
+    #create an argparse.Namespace from the dictionary of inputs
+    args_object=argparse.Namespace()
+    #set the defaults
+    vars(args_object)['attribute_config']=None
+    vars(args_object)['attribute_config_file']=None
+    vars(args_object)['chrom']=None
+    vars(args_object)['start']=0
+    vars(args_object)['end']=None
+    vars(args_object)['pipelines']=default_pipelines
+    vars(args_object)['coord_tile_size']=10000
+    vars(args_object)['task_tile_size']=1
+    vars(args_object)['write_chunk']=1000000
+    vars(args_object)['num_test_reads']=100
+    vars(args_object)['test_read_width']=1000
+    vars(args_object)['out_dir']=None
+    vars(args_object)['out_tsv']=None
+    for key in args_dict:
+        vars(args_object)[key]=args_dict[key]
+    args=args_object
+    return args
+
+def parse_args():
+    parser=argparse.ArgumentParser(description="compare tileDB filter pipelines on a sample region of the datasets to ingest")
+    parser.add_argument("--tiledb_metadata",help="each row is a dataset, each column corresponds to an attribute")
+    parser.add_argument("--attribute_config",default=None,help="the following are supported: encode_pipeline, encode_pipeline_with_controls, generic_bigwig")
+    parser.add_argument("--attribute_config_file",default=None,help="file with 2 columns; first column indicates attribute name; 2nd column indicates attribute type, which is one of bigwig, bed_no_summit, bed_summit_from_peak_center, bed_summit_from_last_col")
+    parser.add_argument("--chrom",required=True,help="chromosome of the sample region")
+    parser.add_argument("--start",type=int,default=0,help="start of the sample region")
+    parser.add_argument("--end",type=int,required=True,help="end of the sample region")
+    parser.add_argument("--pipelines",nargs="+",default=default_pipelines,help="filter pipelines to compare, in the format of the filters= option of the attribute config file, i.e. bitshuffle,zstd:3")
+    parser.add_argument("--coord_tile_size",type=int,default=10000,help="coordinate axis tile size")
+    parser.add_argument("--task_tile_size",type=int,default=1,help="task axis tile size")
+    parser.add_argument("--write_chunk",type=int,default=1000000,help="number of bases to write in one tileDB write operation")
+    parser.add_argument("--num_test_reads",type=int,default=100,help="number of random reads used to measure read latency; 0 to skip")
+    parser.add_argument("--test_read_width",type=int,default=1000,help="number of bases in each random read (all tasks are read)")
+    parser.add_argument("--out_dir",default=None,help="directory in which the benchmark arrays are created (and removed); a temporary directory by default")
+    parser.add_argument("--out_tsv",default=None,help="optional file to store the results")
+    return parser.parse_args()
+
+def parse_sample(tiledb_metadata,attribute_info,attribute,chrom,start,end):
+    '''
+    returns a (end-start) x num_tasks array with the values of the attribute in the sample region
+    '''
+    dtype=np.dtype(attribute_info[attribute]['dtype'])
+    sample=np.full((end-start,tiledb_metadata.shape[0]),get_fill_value(dtype),dtype=dtype)
+    for task_index,(row_index,row) in enumerate(tiledb_metadata.iterrows()):
+        fname=row[attribute]
+        if pd.isna(fname):
+            continue
+        handle=attribute_info[attribute]['opener'](fname,parallel=True)
+        sample[:,task_index]=attribute_info[attribute]['parser']([handle,chrom,start,end,attribute_info[attribute]])[-1]
+    return sample
+
+def get_attribute_data_size(array_name,tdb_Context):
+    '''
+    returns the bytes of the attribute data files of the fragments of the array (a<i>.tdb and their _var and _validity files), so that
+    the schema, array metadata and fragment metadata of small sample arrays do not count against the filters 
+    '''
+    total_size=0
+    for fragment in tiledb.array_fragments(array_name,ctx=tdb_Context):
+        fragment_dir=urlparse(fragment.uri).path
+        for fname in os.listdir(fragment_dir):
+            if re.match(r'^a[0-9]+(_var|_validity)?\.tdb$',fname):
+                total_size+=os.path.getsize(os.path.join(fragment_dir,fname))
+    return total_size
+
+def benchmark_pipeline(array_name,attribute,sample,filter_spec,args,tdb_Context):
+    '''
+    writes the sample to a new single-attribute array compressed with the filter pipeline, and returns the compression ratio,
+    write throughput (MB of uncompressed data / second) and mean random-read latency (seconds)
+    '''
+    num_entries,num_tasks=sample.shape
+    tiledb_dom=tiledb.Domain(tiledb.Dim(name='genome_coordinate',domain=(0,num_entries-1),tile=min([num_entries,args.coord_tile_size]),dtype='uint32'),
+                             tiledb.Dim(name='task',domain=(0,num_tasks-1),tile=max([1,min([num_tasks,args.task_tile_size])]),dtype='uint32'),
+                             ctx=tdb_Context)
+    tiledb_schema=tiledb.ArraySchema(domain=tiledb_dom,
+                                     attrs=(tiledb.Attr(name=attribute,filters=get_filter_list(filter_spec),dtype=sample.dtype),),
+                                     cell_order='row-major',
+                                     tile_order='row-major')
+    tiledb.DenseArray.create(array_name,tiledb_schema)
+    start_time=time.time()
+    with tiledb.DenseArray(array_name,ctx=tdb_Context,mode='w') as cur_array:
+        for chunk_start in range(0,num_entries,args.write_chunk):
+            chunk_end=min([num_entries,chunk_start+args.write_chunk])
+            cur_array[chunk_start:chunk_end,0:num_tasks]={attribute:np.ascontiguousarray(sample[chunk_start:chunk_end])}
+    write_time=time.time()-start_time
+    compression_ratio=sample.nbytes/get_attribute_data_size(array_name,tdb_Context)
+    write_throughput=(sample.nbytes/(10**6))/write_time
+    read_latency=measure_read_latency(array_name,tdb_Context,args.num_test_reads,args.test_read_width)
+    return compression_ratio,write_throughput,read_latency
+
+def benchmark_filters(args):
+    if type(args)==type({}):
+        args=args_object_from_args_dict(args)
+    assert (args.chrom is not None) and (args.end is not None), "the sample region must be provided with --chrom, --start and --end"
+    tiledb_metadata=pd.read_csv(args.tiledb_metadata,header=0,sep='\t')
+    attribute_info=get_attribute_info(args.attribute_config,args.attribute_config_file)
+    for filter_spec in args.pipelines:
+        parse_filters(filter_spec)
+    tdb_Context=tiledb.Ctx(config=tiledb.Config(tdb_config_params))
+    out_dir=args.out_dir
+    if out_dir is None:
+        out_dir=tempfile.mkdtemp(prefix='benchmark_filters.')
+    elif not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    try:
+        results=[]
+        for attribute in attribute_info:
+            if attribute not in tiledb_metadata.columns:
+                continue
+            sample=parse_sample(tiledb_metadata,attribute_info,attribute,args.chrom,args.start,args.end)
+            print("parsed sample of attribute:"+str(attribute)+" ("+str(round(sample.nbytes/(10**6),2))+" MB)")
+            for pipeline_index,filter_spec in enumerate(args.pipelines):
+                array_name=os.path.join(out_dir,'.'.join([attribute,str(pipeline_index)]))
+                shutil.rmtree(array_name,ignore_errors=True)
+                try:
+                    compression_ratio,write_throughput,read_latency=benchmark_pipeline(array_name,attribute,sample,filter_spec,args,tdb_Context)
+                except tiledb.TileDBError as e:
+                    #e.g. a filter that does not support the attribute dtype
+                    print("filter pipeline:"+str(filter_spec)+" failed for attribute:"+str(attribute)+":"+str(e))
+                    compression_ratio,write_throughput,read_latency=np.nan,np.nan,np.nan
+                finally:
+                    shutil.rmtree(array_name,ignore_errors=True)
+                results.append({'attribute':attribute,
+                                'dtype':str(sample.dtype),
+                                'filters':filter_spec,
+                                'compression_ratio':compression_ratio,
+                                'write_MB_per_s':write_throughput,
+                                'read_latency_ms':read_latency*1000 if read_latency is not None else np.nan})
+    finally:
+        if args.out_dir is None:
+            shutil.rmtree(out_dir,ignore_errors=True)
+    results=pd.DataFrame(results,columns=['attribute','dtype','filters','compression_ratio','write_MB_per_s','read_latency_ms'])
+    print(results.to_string(index=False,float_format=lambda x: str(round(x,2))))
+    if args.out_tsv is not None:
+        results.to_csv(args.out_tsv,sep='\t',index=False)
+    return results
+
+def main():
+    args=parse_args()
+    benchmark_filters(args)
+
+if __name__=="__main__":
+    main()
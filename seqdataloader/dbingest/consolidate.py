@@ -0,0 +1,156 @@
+## consolidates and vacuums the fragments of a dbingest array (and its separate attribute arrays),
+## reporting the fragment counts and read latency before and after
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import argparse
+import time
+import tiledb
+import numpy as np
+from ..tdb_config import *
+
+def args_object_from_args_dict(args_dict):
+    #create an argparse.Namespace from the dictionary of inputs
+    args_object=argparse.Namespace()
+    #set the defaults
+    vars(args_object)['fragment_size_mb']=None
+    vars(args_object)['memory_budget_mb']=None
+    vars(args_object)['amplification']=None
+    vars(args_object)['skip_vacuum']=False
+    vars(args_object)['num_test_reads']=100
+    vars(args_object)['test_read_width']=1000
+    for key in args_dict:
+        vars(args_object)[key]=args_dict[key]
+    args=args_object
+    return args
+
+def parse_args():
+    parser=argparse.ArgumentParser(description="consolidate and vacuum the fragments of an array created with db_ingest")
+    parser.add_argument("--array_name")
+    parser.add_argument("--fragment_size_mb",type=int,default=None,help="target maximum size of each consolidated fragment in MB. By default fragments are merged without a size limit")
+    parser.add_argument("--memory_budget_mb",type=int,default=None,help="total memory budget for consolidation in MB. By default the tileDB default is used")
+    parser.add_argument("--amplification",type=float,default=None,help="let tileDB select the fragments to merge, with this maximum ratio of the size of a consolidated fragment to the total size of the fragments it replaces. Empty cells count towards the size of dense fragments, so the fragments of different chunks and task blocks are only merged with 2.0 or more. By default all fragments of the array are consolidated")
+    parser.add_argument("--skip_vacuum",default=False,action="store_true",help="keep the consolidated fragments on disk")
+    parser.add_argument("--num_test_reads",type=int,default=100,help="number of random reads used to measure read latency before and after consolidation; 0 to skip")
+    parser.add_argument("--test_read_width",type=int,default=1000,help="number of bases in each random read (all tasks are read)")
+    return parser.parse_args()
+
+def get_arrays_to_consolidate(array_name,tdb_Context):
+    '''
+    the main array and any array that stores a separate or sparse attribute
+    '''
+    array_names=[array_name]
+    with tiledb.DenseArray(array_name,ctx=tdb_Context,mode='r') as cur_array:
+        for key,value in cur_array.meta.items():
+            if key.startswith('storage_') and (value in ['separate','sparse']):
+                array_names.append(array_name.rstrip('/')+'.'+key[len('storage_'):])
+    return array_names
+
+def get_num_fragments(array_name,tdb_Context):
+    return len(tiledb.array_fragments(array_name,ctx=tdb_Context))
+
+def measure_read_latency(array_name,tdb_Context,num_test_reads,test_read_width,seed=1234):
+    '''
+    returns the mean latency (in seconds) of num_test_reads reads of test_read_width bases x all tasks at random positions within the
+    non-empty domain of the array. The same positions are used before and after consolidation
+    '''
+    if num_test_reads==0:
+        return None
+    with tiledb.open(array_name,ctx=tdb_Context,mode='r') as cur_array:
+        nonempty_domain=cur_array.nonempty_domain()
+        if nonempty_domain is None:
+            return None
+        (coord_start,coord_end),(task_start,task_end)=nonempty_domain
+        width=min([test_read_width,int(coord_end)-int(coord_start)+1])
+        read_starts=np.random.RandomState(seed).randint(int(coord_start),int(coord_end)-width+2,size=num_test_reads)
+        start_time=time.time()
+        for read_start in read_starts:
+            cur_array[read_start:read_start+width,int(task_start):int(task_end)+1]
+        return (time.time()-start_time)/num_test_reads
+
+def get_consolidation_config(fragment_size_mb,memory_budget_mb,amplification):
+    config_params=dict(tdb_config_params)
+    config_params['sm.consolidation.mode']='fragments'
+    if amplification is not None:
+        config_params['sm.consolidation.amplification']=str(amplification)
+    if fragment_size_mb is not None:
+        config_params['sm.consolidation.max_fragment_size']=str(int(fragment_size_mb*(10**6)))
+    if memory_budget_mb is not None:
+        config_params['sm.mem.total_budget']=str(int(memory_budget_mb*(10**6)))
+        config_params['sm.consolidation.buffer_size']=str(int(memory_budget_mb*(10**6)/10))
+    return tiledb.Config(config_params)
+
+def consolidate_array(array_name,
+                      fragment_size_mb=None,
+                      memory_budget_mb=None,
+                      amplification=None,
+                      vacuum=True,
+                      num_test_reads=100,
+                      test_read_width=1000):
+    '''
+    consolidates the fragments (and fragment & array metadata) of the array, then vacuums the consolidated fragments.
+    Unless an amplification is given, all fragments are consolidated: every chunk x task block written by dbingest is its own fragment,
+    and tileDB does not merge fragments whose union holds more empty cells than the amplification allows.
+    returns a dictionary with the number of fragments and the mean read latency before and after consolidation
+    '''
+    tdb_Config=get_consolidation_config(fragment_size_mb,memory_budget_mb,amplification)
+    tdb_Context=tiledb.Ctx(config=tdb_Config)
+    report={'array':array_name}
+    report['fragments_before']=get_num_fragments(array_name,tdb_Context)
+    report['read_latency_before']=measure_read_latency(array_name,tdb_Context,num_test_reads,test_read_width)
+    start_time=time.time()
+    for mode in ['fragments','fragment_meta','array_meta']:
+        mode_Config=get_consolidation_config(fragment_size_mb,memory_budget_mb,amplification)
+        mode_Config['sm.consolidation.mode']=mode
+        if (mode=='fragments') and (amplification is None):
+            fragment_uris=[fragment.uri for fragment in tiledb.array_fragments(array_name,ctx=tdb_Context)]
+            if len(fragment_uris) > 1:
+                tiledb.consolidate(array_name,ctx=tdb_Context,config=mode_Config,fragment_uris=fragment_uris)
+        else:
+            tiledb.consolidate(array_name,ctx=tdb_Context,config=mode_Config)
+        if vacuum is True:
+            mode_Config['sm.vacuum.mode']=mode
+            tiledb.vacuum(array_name,ctx=tdb_Context,config=mode_Config)
+    report['consolidation_time']=time.time()-start_time
+    report['fragments_after']=get_num_fragments(array_name,tdb_Context)
+    report['read_latency_after']=measure_read_latency(array_name,tdb_Context,num_test_reads,test_read_width)
+    return report
+
+def format_latency(latency):
+    if latency is None:
+        return 'NA'
+    return str(round(latency*1000,2))+' ms'
+
+def print_consolidation_report(reports):
+    print('\t'.join(['array','fragments_before','fragments_after','read_latency_before','read_latency_after','consolidation_time']))
+    for report in reports:
+        print('\t'.join([str(report['array']),
+                         str(report['fragments_before']),
+                         str(report['fragments_after']),
+                         format_latency(report['read_latency_before']),
+                         format_latency(report['read_latency_after']),
+                         str(round(report['consolidation_time'],2))+' s']))
+
+def consolidate(args):
+    if type(args)==type({}):
+        args=args_object_from_args_dict(args)
+    tdb_Context=tiledb.Ctx(config=tiledb.Config(tdb_config_params))
+    reports=[]
+    for array_name in get_arrays_to_consolidate(args.array_name,tdb_Context):
+        print("consolidating:"+str(array_name))
+        reports.append(consolidate_array(array_name,
+                                         fragment_size_mb=args.fragment_size_mb,
+                                         memory_budget_mb=args.memory_budget_mb,
+                                         amplification=args.amplification,
+                                         vacuum=(args.skip_vacuum is False),
+                                         num_test_reads=args.num_test_reads,
+                                         test_read_width=args.test_read_width))
+    print_consolidation_report(reports)
+    return reports
+
+def main():
+    args=parse_args()
+    consolidate(args)
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,103 @@
+## sidecar manifest of the (task, coordinate range, attribute) units that have been written to a dbingest array,
+## used to resume an interrupted ingest without reprocessing the units that already made it to disk
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import os
+
+def get_manifest_path(array_name):
+    return array_name.rstrip('/')+'.ingest_manifest.tsv'
+
+class IngestManifest(object):
+    def __init__(self,array_name,path=None):
+        '''
+        each line of the manifest is: dataset, start_index, end_index, attribute
+        the first line records the write chunk size that the units were planned with.
+        path defaults to the manifest next to the array (distributed workers each keep their own)
+        '''
+        self.path=path if path is not None else get_manifest_path(array_name)
+        self.completed=set()
+        self.write_chunk=None
+        self.outf=None
+
+    def load(self):
+        '''
+        reads the units completed by previous runs
+        '''
+        if not os.path.exists(self.path):
+            print("no ingest manifest found at:"+str(self.path))
+            return self
+        lines=open(self.path,'r').readlines()
+        if (len(lines) > 0) and (not lines[-1].endswith('\n')):
+            #a partially written last line means the process died while recording the unit, so it is not complete. It is cut off,
+            #so that the units recorded by this run start on a new line 
+            with open(self.path,'r+') as outf:
+                outf.truncate(os.path.getsize(self.path)-len(lines[-1].encode()))
+            lines=lines[:-1]
+        for line in lines:
+            tokens=line.rstrip('\n').split('\t')
+            if tokens[0]=='#write_chunk':
+                self.write_chunk=int(tokens[1])
+                continue
+            if len(tokens)!=4:
+                continue
+            self.completed.add((tokens[0],int(tokens[1]),int(tokens[2]),tokens[3]))
+        print("loaded "+str(len(self.completed))+" completed units from ingest manifest:"+str(self.path))
+        return self
+
+    def reset(self,write_chunk):
+        '''
+        starts a new manifest, discarding the units recorded by previous runs
+        '''
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.completed=set()
+        self.write_chunk=write_chunk
+        with open(self.path,'w') as outf:
+            outf.write('\t'.join(['#write_chunk',str(write_chunk)])+'\n')
+        return self
+
+    def discard(self,task_attributes):
+        '''
+        removes the units of the given dataset -> attributes, which are about to be rewritten, and rewrites the manifest with the 
+        remaining units (and the write chunk, which must be set)
+        '''
+        self.completed=set([unit for unit in self.completed if unit[3] not in task_attributes.get(unit[0],[])])
+        with open(self.path+'.tmp','w') as outf:
+            outf.write('\t'.join(['#write_chunk',str(self.write_chunk)])+'\n')
+            outf.write(''.join(['\t'.join([str(token) for token in unit])+'\n' for unit in sorted(self.completed)]))
+            outf.flush()
+            os.fsync(outf.fileno())
+        os.replace(self.path+'.tmp',self.path)
+        return self
+
+    def is_complete(self,dataset,start_index,end_index,attributes):
+        for attribute in attributes:
+            if (dataset,start_index,end_index,attribute) not in self.completed:
+                return False
+        return True
+
+    def record(self,dataset,start_index,end_index,attributes):
+        '''
+        appends the units to the manifest once they have been written to the array, and syncs the manifest to disk
+        '''
+        if self.outf is None:
+            self.outf=open(self.path,'a')
+        self.outf.write(''.join(['\t'.join([str(dataset),str(start_index),str(end_index),attribute])+'\n' for attribute in attributes]))
+        self.outf.flush()
+        os.fsync(self.outf.fileno())
+
+    def record_units(self,units):
+        '''
+        appends (dataset, start_index, end_index, attribute) units, i.e. the units recorded by distributed workers 
+        '''
+        with open(self.path,'a') as outf:
+            outf.write(''.join(['\t'.join([str(token) for token in unit])+'\n' for unit in sorted(units)]))
+            outf.flush()
+            os.fsync(outf.fileno())
+        self.completed.update(units)
+
+    def close(self):
+        if self.outf is not None:
+            self.outf.close()
+            self.outf=None
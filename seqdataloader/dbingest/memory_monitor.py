@@ -0,0 +1,97 @@
+## memory accounting for dbingest: the memory of the ingest process tree (the parent, the array writers and the workers),
+## rather than the memory used by the whole machine, which includes other jobs on shared nodes and in containers
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import threading
+import psutil
+import os
+from collections import OrderedDict
+
+def get_process_mem_bytes(process):
+    '''
+    proportional set size of the process where available (shared memory slabs are split between the processes that map them,
+    so they are not counted once per worker), resident set size otherwise
+    '''
+    try:
+        return process.memory_full_info().pss
+    except (AttributeError,psutil.AccessDenied):
+        return process.memory_info().rss
+
+def get_process_mem_g(pid=None):
+    return get_process_mem_bytes(psutil.Process(pid))/(10**9)
+
+class MemoryMonitor(object):
+    def __init__(self,interval=1.0):
+        '''
+        samples the memory of this process and all of its descendants every interval seconds in a background thread,
+        keeping the peak memory of each stage of the ingest for the parent, the array writers and the workers
+        '''
+        self.interval=interval
+        self.process=psutil.Process(os.getpid())
+        self.writer_pids=set()
+        self.stage=None
+        self.current_g=0
+        #stage -> {'total','parent','writer','workers'} peak Gigabytes
+        self.peaks=OrderedDict()
+        self.lock=threading.Lock()
+        self.stopped=threading.Event()
+        self.thread=None
+
+    def sample(self):
+        usage={'parent':get_process_mem_bytes(self.process)/(10**9),'writer':0,'workers':0}
+        for child in self.process.children(recursive=True):
+            try:
+                child_mem_g=get_process_mem_bytes(child)/(10**9)
+            except psutil.NoSuchProcess:
+                continue
+            if child.pid in self.writer_pids:
+                usage['writer']+=child_mem_g
+            else:
+                usage['workers']+=child_mem_g
+        usage['total']=usage['parent']+usage['writer']+usage['workers']
+        with self.lock:
+            self.current_g=usage['total']
+            if self.stage is not None:
+                stage_peaks=self.peaks[self.stage]
+                for key in usage:
+                    stage_peaks[key]=max([stage_peaks[key],usage[key]])
+        return usage['total']
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def start(self):
+        self.thread=threading.Thread(target=self.run,daemon=True)
+        self.thread.start()
+        return self
+
+    def set_stage(self,stage):
+        with self.lock:
+            self.stage=stage
+            if stage not in self.peaks:
+                self.peaks[stage]={'total':0,'parent':0,'writer':0,'workers':0}
+        self.sample()
+
+    def set_writer_pids(self,pids):
+        self.writer_pids=set(pids)
+
+    def mem_used_g(self):
+        '''
+        memory of the process tree at the last sample
+        '''
+        with self.lock:
+            return self.current_g
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.sample()
+
+    def report(self):
+        print('\t'.join(['stage','peak_total_g','peak_parent_g','peak_writer_g','peak_workers_g']))
+        for stage in self.peaks:
+            stage_peaks=self.peaks[stage]
+            print('\t'.join([stage]+[str(round(stage_peaks[key],2)) for key in ['total','parent','writer','workers']]))
@@ -0,0 +1,319 @@
+## plans a dbingest run before it starts: a short calibration run parses a sample region of the first few datasets and writes it
+## with the configured dtypes and filters, then the per-base costs are projected to the whole genome and all datasets to choose
+## --threads, --num_writers, --task_tile_size, --coord_tile_size, --max_queue_size and --write_chunk, and to estimate the disk footprint,
+## peak memory and duration of the ingest. The tuned settings are printed as a db_ingest command, and optionally run.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import argparse
+import json
+import math
+import os
+import shutil
+import tempfile
+import time
+import psutil
+import pyBigWig
+import tiledb
+import pandas as pd
+import numpy as np
+from collections import OrderedDict
+from ..attrib_config import *
+from ..queue_config import *
+from ..tdb_config import *
+from ..utils import *
+from . import ingest, get_adaptive_write_chunk
+from .benchmark_filters import parse_sample, benchmark_pipeline
+from .memory_monitor import get_process_mem_g
+from .sparse_storage import get_nonzero_runs
+
+#the db_ingest options that are tuned
+tuned_options=['threads','num_writers','task_tile_size','coord_tile_size','max_queue_size','write_chunk']
+
+def args_object_from_args_dict(args_dict):
+    #create an argparse.Namespace from the dictionary of inputs
+    args_object=argparse.Namespace()
+    #set the defaults
+    vars(args_object)['attribute_config']=None
+    vars(args_object)['attribute_config_file']=None
+    vars(args_object)['array_name']=None
+    vars(args_object)['sample_chrom']=None
+    vars(args_object)['sample_size']=1000000
+    vars(args_object)['calibration_tasks']=4
+    vars(args_object)['cores']=None
+    vars(args_object)['max_mem_g']=None
+    vars(args_object)['target_tile_mb']=1
+    vars(args_object)['out_json']=None
+    vars(args_object)['apply']=False
+    #the current settings, compared against the tuned ones (db_ingest defaults)
+    vars(args_object)['threads']=1
+    vars(args_object)['num_writers']=1
+    vars(args_object)['task_tile_size']=1
+    vars(args_object)['coord_tile_size']=10000
+    vars(args_object)['max_queue_size']=30
+    vars(args_object)['write_chunk']=30000000
+    for key in args_dict:
+        vars(args_object)[key]=args_dict[key]
+    args=args_object
+    return args
+
+def parse_args():
+    parser=argparse.ArgumentParser(description="estimate the disk footprint, peak memory and duration of a db_ingest run from a short calibration run, and tune its settings")
+    parser.add_argument("--tiledb_metadata",help="each row is a dataset, each column corresponds to an attribute")
+    parser.add_argument("--chrom_sizes",help="2 column tsv-separated file. Column 1 = chromsome name; Column 2 = chromosome size")
+    parser.add_argument("--attribute_config",default=None,help="the following are supported: encode_pipeline, encode_pipeline_with_controls, generic_bigwig")
+    parser.add_argument("--attribute_config_file",default=None,help="file with 2 columns; first column indicates attribute name; 2nd column indicates attribute type, which is one of bigwig, bed_no_summit, bed_summit_from_peak_center, bed_summit_from_last_col")
+    parser.add_argument("--array_name",default=None,help="array to ingest into; only used in the printed db_ingest command and with --apply")
+    parser.add_argument("--sample_chrom",default=None,help="chromosome of the calibration region. By default any chromosome in --chrom_sizes")
+    parser.add_argument("--sample_size",type=int,default=1000000,help="number of bases in the calibration region, which is the window with the highest coverage in the first bigwig (or the middle of the chromosome if no bigwig is ingested)")
+    parser.add_argument("--calibration_tasks",type=int,default=4,help="number of datasets (rows of --tiledb_metadata) parsed in the calibration run")
+    parser.add_argument("--cores",type=int,default=None,help="number of cores available to the ingest. Defaults to the cores this process may run on")
+    parser.add_argument("--max_mem_g",type=int,default=None,help="memory available to the ingest in Gigabytes. Defaults to 90%% of the memory currently available")
+    parser.add_argument("--target_tile_mb",type=float,default=1,help="maximum uncompressed size of a tile of one attribute in MB")
+    parser.add_argument("--out_json",default=None,help="optional file to store the tuned settings and estimates")
+    parser.add_argument("--apply",default=False,action="store_true",help="run db_ingest into --array_name with the tuned settings")
+    parser.add_argument("--threads",type=int,default=1,help="current setting of db_ingest --threads, to compare against the tuned settings")
+    parser.add_argument("--num_writers",type=int,default=1,help="current setting of db_ingest --num_writers")
+    parser.add_argument("--task_tile_size",type=int,default=1,help="current setting of db_ingest --task_tile_size")
+    parser.add_argument("--coord_tile_size",type=int,default=10000,help="current setting of db_ingest --coord_tile_size")
+    parser.add_argument("--max_queue_size",type=int,default=30,help="current setting of db_ingest --max_queue_size")
+    parser.add_argument("--write_chunk",type=int,default=30000000,help="current setting of db_ingest --write_chunk; also the largest write chunk considered when tuning")
+    return parser.parse_args()
+
+def get_available_cores():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count()
+
+def get_sample_bigwig(tiledb_metadata,attribute_info):
+    '''
+    returns the path of the first bigwig in tiledb_metadata, or None if no bigwig attribute is ingested 
+    '''
+    for attribute in attribute_info:
+        if (attribute not in tiledb_metadata.columns) or (attribute_info[attribute]['parser'] is not parse_bigwig_chrom_vals):
+            continue
+        fnames=tiledb_metadata[attribute].dropna()
+        if fnames.shape[0] > 0:
+            return fnames.iloc[0]
+    return None
+
+def get_sample_region(chrom_sizes,sample_chrom,sample_size,sample_bigwig=None):
+    '''
+    the calibration region is the window of sample_size bases with the highest coverage in sample_bigwig, on sample_chrom or (by default) 
+    on any chromosome, so that it does not fall in a centromere or another region without data. The coverage is read from the zoom 
+    level summaries of the bigwig. Without a bigwig, the region is taken from the middle of the chromosome, since the ends are usually 
+    unmappable (and empty)
+    '''
+    chroms=[sample_chrom] if sample_chrom is not None else list(chrom_sizes[0])
+    sizes=dict(zip(chrom_sizes[0],chrom_sizes[1].astype(int)))
+    if sample_bigwig is None:
+        chrom=chroms[0]
+        window=min([sample_size,sizes[chrom]])
+        start=(sizes[chrom]-window)//2
+        return chrom,start,start+window
+    #(coverage, window size, region) of the best window; a window of the full sample size is preferred over a shorter chromosome with the same coverage 
+    best=None
+    bw=pyBigWig.open(sample_bigwig)
+    bw_chroms=bw.chroms()
+    for chrom in chroms:
+        if chrom not in bw_chroms:
+            continue
+        window=min([sample_size,sizes[chrom]])
+        num_windows=sizes[chrom]//window
+        coverage=[value if value is not None else 0 for value in bw.stats(chrom,0,num_windows*window,type='coverage',nBins=num_windows)]
+        window_index=int(np.argmax(coverage))
+        if (best is None) or ((coverage[window_index],window) > best[0:2]):
+            best=(coverage[window_index],window,(chrom,window_index*window,(window_index+1)*window))
+    bw.close()
+    if best is None:
+        raise Exception("none of the chromosomes:"+",".join([str(chrom) for chrom in chroms[:10]])+" are in the bigwig:"+str(sample_bigwig))
+    return best[2]
+
+def calibrate(tiledb_metadata,attribute_info,chrom,start,end,coord_tile_size,out_dir,tdb_Context):
+    '''
+    parses the sample region of each attribute for the datasets in tiledb_metadata, and writes it to a single-attribute array with the
+    configured dtype, filters and coord_tile_size. returns attribute -> costs:
+    open_s_per_dataset (seconds to open the data file of a dataset, i.e. to build the index of a peak file, once per worker), 
+    parse_s_per_base (seconds to parse one base of one dataset), bytes_per_base (bytes stored per base of one dataset before compression),
+    compression_ratio and write_s_per_byte (seconds to compress and write one uncompressed byte)
+    '''
+    calibration=OrderedDict()
+    for attribute in attribute_info:
+        if attribute not in tiledb_metadata.columns:
+            continue
+        num_datasets=int(tiledb_metadata[attribute].notna().sum())
+        if num_datasets==0:
+            continue
+        #the data files are opened (and cached) by parsing a single base, so that opening them is not counted as a per-base cost 
+        step_start=time.perf_counter()
+        parse_sample(tiledb_metadata,attribute_info,attribute,chrom,start,start+1)
+        open_time=time.perf_counter()-step_start
+        step_start=time.perf_counter()
+        sample=parse_sample(tiledb_metadata,attribute_info,attribute,chrom,start,end)
+        parse_time=time.perf_counter()-step_start
+        bytes_per_base=sample.dtype.itemsize
+        if get_attribute_storage(attribute_info,attribute)=='sparse':
+            #value, run end and the two coordinates of every run
+            num_runs=sum([get_nonzero_runs(sample[:,task_index],start,coord_tile_size)[0].shape[0] for task_index in range(sample.shape[1])])
+            bytes_per_base=num_runs*(sample.dtype.itemsize+12)/sample.size
+        array_name=os.path.join(out_dir,attribute)
+        #a single write of the whole sample, without read latency measurements
+        benchmark_args=argparse.Namespace(coord_tile_size=coord_tile_size,task_tile_size=sample.shape[1],write_chunk=sample.shape[0],num_test_reads=0,test_read_width=0)
+        compression_ratio,write_throughput,read_latency=benchmark_pipeline(array_name,attribute,sample,get_attribute_filters(attribute_info,attribute),benchmark_args,tdb_Context)
+        shutil.rmtree(array_name,ignore_errors=True)
+        if get_attribute_storage(attribute_info,attribute)=='sparse':
+            compression_ratio=1
+        calibration[attribute]={'dtype':str(sample.dtype),
+                                'storage':get_attribute_storage(attribute_info,attribute),
+                                'open_s_per_dataset':open_time/num_datasets,
+                                'parse_s_per_base':parse_time/(num_datasets*(end-start)),
+                                'bytes_per_base':bytes_per_base,
+                                'compression_ratio':compression_ratio,
+                                'write_s_per_byte':1/(write_throughput*(10**6))}
+        print("calibrated attribute:"+str(attribute)+" on "+str(num_datasets)+" datasets x "+str(end-start)+" bases")
+    return calibration
+
+def get_num_blocks(genome_size,num_tasks,settings):
+    return math.ceil(genome_size/settings['write_chunk'])*math.ceil(num_tasks/settings['task_tile_size'])
+
+def estimate_ingest(calibration,attribute_dtypes,task_fractions,genome_size,num_tasks,settings,process_mem_g):
+    '''
+    projects the calibration to the whole genome and all datasets for the given settings.
+    Parsing and writing are pipelined, so the ingest takes as long as the slower of the two
+    '''
+    parse_seconds=sum([calibration[attribute]['parse_s_per_base']*task_fractions[attribute] for attribute in calibration])*genome_size*num_tasks
+    #every worker opens the data files of the datasets it parses (once, as they are cached) 
+    parse_seconds+=sum([calibration[attribute].get('open_s_per_dataset',0)*task_fractions[attribute] for attribute in calibration])*num_tasks*settings['threads']
+    write_seconds=sum([calibration[attribute]['bytes_per_base']*calibration[attribute]['write_s_per_byte'] for attribute in calibration])*genome_size*num_tasks
+    disk_bytes=sum([calibration[attribute]['bytes_per_base']/calibration[attribute]['compression_ratio'] for attribute in calibration])*genome_size*num_tasks
+    block_bytes_per_base=settings['task_tile_size']*sum([np.dtype(dtype).itemsize for dtype in attribute_dtypes.values()])
+    slab_bytes=(settings['max_queue_size']+settings['num_writers'])*block_bytes_per_base*settings['write_chunk']
+    worker_bytes=settings['threads']*worker_bytes_per_base*settings['write_chunk']
+    parse_wall=parse_seconds/settings['threads']
+    write_wall=write_seconds/settings['num_writers']
+    estimates=OrderedDict()
+    estimates['disk_g']=disk_bytes/(10**9)
+    estimates['peak_mem_g']=(slab_bytes+worker_bytes)/(10**9)+(settings['threads']+settings['num_writers']+1)*process_mem_g
+    estimates['parse_cpu_h']=parse_seconds/3600
+    estimates['write_cpu_h']=write_seconds/3600
+    estimates['ingest_h']=max([parse_wall,write_wall])/3600
+    #fraction of the cores doing useful work; the side of the pipeline that is not the bottleneck idles part of the time
+    estimates['core_utilization']=(parse_seconds+write_seconds)/(max([parse_wall,write_wall])*(settings['threads']+settings['num_writers']))
+    estimates['bottleneck']='parse' if parse_wall >= write_wall else 'write'
+    estimates['blocks']=get_num_blocks(genome_size,num_tasks,settings)
+    return estimates
+
+def tune_settings(calibration,attribute_dtypes,task_fractions,genome_size,num_tasks,cores,max_mem_g,target_tile_mb,max_write_chunk):
+    '''
+    one core is left to the parent process, and the rest are split between workers and writers so that neither side of the pipeline idles.
+    a block of tasks x chunk has one task per worker, there are two blocks in flight for each block being parsed,
+    tiles are kept below target_tile_mb, and the write chunk is the largest that fits in max_mem_g while leaving
+    at least two blocks per slab to balance the load
+    '''
+    parse_seconds=sum([calibration[attribute]['parse_s_per_base']*task_fractions[attribute] for attribute in calibration])
+    write_seconds=sum([calibration[attribute]['bytes_per_base']*calibration[attribute]['write_s_per_byte'] for attribute in calibration])
+    num_writers=1
+    threads=max([1,cores-2])
+    #move cores from the workers to the writers for as long as that shortens the slower side of the pipeline
+    while (threads > 1) and (max([parse_seconds/(threads-1),write_seconds/(num_writers+1)]) < max([parse_seconds/threads,write_seconds/num_writers])):
+        num_writers+=1
+        threads-=1
+    settings=OrderedDict()
+    settings['threads']=threads
+    settings['num_writers']=num_writers
+    settings['task_tile_size']=max([1,min([num_tasks,threads])])
+    max_itemsize=max([np.dtype(dtype).itemsize for dtype in attribute_dtypes.values()])
+    coord_tile_size=int(target_tile_mb*(10**6)/(settings['task_tile_size']*max_itemsize))//1000*1000
+    settings['coord_tile_size']=min([10000,max([1000,coord_tile_size])])
+    settings['max_queue_size']=2*math.ceil(threads/settings['task_tile_size'])+num_writers
+    budget_args=argparse.Namespace(write_chunk=max_write_chunk,max_queue_size=settings['max_queue_size'],threads=threads,num_writers=num_writers,max_mem_g=max_mem_g)
+    write_chunk=get_adaptive_write_chunk(budget_args,attribute_dtypes,settings['task_tile_size'],settings['coord_tile_size'])
+    task_blocks=math.ceil(num_tasks/settings['task_tile_size'])
+    balanced_write_chunk=(genome_size*task_blocks//(2*settings['max_queue_size']))//settings['coord_tile_size']*settings['coord_tile_size']
+    settings['write_chunk']=max([settings['coord_tile_size'],min([write_chunk,balanced_write_chunk])])
+    return settings
+
+def get_current_settings(args,attribute_dtypes,max_mem_g):
+    settings=OrderedDict([(option,vars(args)[option]) for option in tuned_options])
+    #db_ingest shrinks the write chunk to fit the memory budget
+    budget_args=argparse.Namespace(max_mem_g=max_mem_g,**settings)
+    settings['write_chunk']=get_adaptive_write_chunk(budget_args,attribute_dtypes,settings['task_tile_size'],settings['coord_tile_size'])
+    return settings
+
+def format_value(value):
+    if type(value) in [float,np.float64]:
+        return str(round(value,2))
+    return str(value)
+
+def get_ingest_command(args,settings,max_mem_g):
+    tokens=['db_ingest','--tiledb_metadata',args.tiledb_metadata,'--chrom_sizes',args.chrom_sizes,'--array_name',str(args.array_name)]
+    if args.attribute_config_file is not None:
+        tokens+=['--attribute_config_file',args.attribute_config_file]
+    else:
+        tokens+=['--attribute_config',str(args.attribute_config)]
+    for option in tuned_options:
+        tokens+=['--'+option,str(settings[option])]
+    tokens+=['--max_mem_g',str(max_mem_g)]
+    return ' '.join(tokens)
+
+def plan_ingest(args):
+    if type(args)==type({}):
+        args=args_object_from_args_dict(args)
+    tiledb_metadata=pd.read_csv(args.tiledb_metadata,header=0,sep='\t')
+    chrom_sizes=pd.read_csv(args.chrom_sizes,header=None,sep='\t')
+    attribute_info=get_attribute_info(args.attribute_config,args.attribute_config_file)
+    attribute_dtypes=OrderedDict([(attribute,attribute_info[attribute]['dtype']) for attribute in attribute_info])
+    genome_size=int(chrom_sizes[1].sum())
+    num_tasks=tiledb_metadata.shape[0]
+    task_fractions=dict([(attribute,tiledb_metadata[attribute].notna().mean() if attribute in tiledb_metadata.columns else 0) for attribute in attribute_info])
+    cores=args.cores if args.cores is not None else get_available_cores()
+    max_mem_g=args.max_mem_g if args.max_mem_g is not None else int(0.9*psutil.virtual_memory().available/(10**9))
+    chrom,start,end=get_sample_region(chrom_sizes,args.sample_chrom,args.sample_size,get_sample_bigwig(tiledb_metadata.head(args.calibration_tasks),attribute_info))
+    print("calibrating on "+str(chrom)+":"+str(start)+"-"+str(end)+" for "+str(min([num_tasks,args.calibration_tasks]))+" datasets")
+    tdb_Context=tiledb.Ctx(config=tiledb.Config(tdb_config_params))
+    out_dir=tempfile.mkdtemp(prefix='db_plan_ingest.')
+    try:
+        calibration=calibrate(tiledb_metadata.head(args.calibration_tasks),attribute_info,chrom,start,end,args.coord_tile_size,out_dir,tdb_Context)
+    finally:
+        shutil.rmtree(out_dir,ignore_errors=True)
+    #memory of a process before it holds any slab or parsing buffer (the workers and writers are forked from the parent)
+    process_mem_g=get_process_mem_g()
+    print('\t'.join(['attribute','dtype','storage','open_ms_per_dataset','parse_us_per_base','bytes_per_base','compression_ratio','write_MB_per_s']))
+    for attribute,costs in calibration.items():
+        print('\t'.join([attribute,costs['dtype'],costs['storage'],format_value(costs['open_s_per_dataset']*1000),format_value(costs['parse_s_per_base']*(10**6)),format_value(costs['bytes_per_base']),
+                         format_value(costs['compression_ratio']),format_value(1/(costs['write_s_per_byte']*(10**6)))]))
+    current=get_current_settings(args,attribute_dtypes,max_mem_g)
+    tuned=tune_settings(calibration,attribute_dtypes,task_fractions,genome_size,num_tasks,cores,max_mem_g,args.target_tile_mb,args.write_chunk)
+    current_estimates=estimate_ingest(calibration,attribute_dtypes,task_fractions,genome_size,num_tasks,current,process_mem_g)
+    tuned_estimates=estimate_ingest(calibration,attribute_dtypes,task_fractions,genome_size,num_tasks,tuned,process_mem_g)
+    print("genome:"+str(genome_size)+" bases, datasets:"+str(num_tasks)+", cores:"+str(cores)+", max_mem_g:"+str(max_mem_g))
+    print('\t'.join(['','current','tuned']))
+    for key in list(current.keys())+list(current_estimates.keys()):
+        current_value=current[key] if key in current else current_estimates[key]
+        tuned_value=tuned[key] if key in tuned else tuned_estimates[key]
+        print('\t'.join([key,format_value(current_value),format_value(tuned_value)]))
+    if current_estimates['peak_mem_g'] > max_mem_g:
+        print("WARNING: the current settings are estimated to exceed max_mem_g")
+    print(get_ingest_command(args,tuned,max_mem_g))
+    plan={'settings':tuned,'max_mem_g':max_mem_g,'estimates':tuned_estimates,'calibration':calibration}
+    if args.out_json is not None:
+        with open(args.out_json,'w') as outf:
+            json.dump(plan,outf,indent=2,default=float)
+    if args.apply is True:
+        assert args.array_name is not None, "--apply requires --array_name"
+        ingest_args=dict([('tiledb_metadata',args.tiledb_metadata),
+                          ('chrom_sizes',args.chrom_sizes),
+                          ('array_name',args.array_name),
+                          ('attribute_config',args.attribute_config),
+                          ('attribute_config_file',args.attribute_config_file),
+                          ('max_mem_g',max_mem_g)]+list(tuned.items()))
+        ingest(ingest_args)
+    return plan
+
+def main():
+    args=parse_args()
+    plan_ingest(args)
+
+if __name__=="__main__":
+    main()
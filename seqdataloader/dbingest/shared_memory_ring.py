@@ -0,0 +1,104 @@
+## shared-memory ring buffer used to hand parsed chunks from the dbingest workers to the array writer
+## without pickling the (potentially 30M-base) numpy arrays through a multiprocessing.Queue
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from multiprocessing import Queue
+import queue
+from multiprocessing import shared_memory
+from collections import OrderedDict
+import numpy as np
+from ..utils import get_fill_value
+
+#byte alignment of each attribute inside a slab
+slab_alignment=64
+
+def round_up(value,multiple):
+    '''
+    round value up to the nearest multiple of "multiple"
+    '''
+    return ((value+multiple-1)//multiple)*multiple
+
+class SharedMemoryRing(object):
+    def __init__(self, num_slots, slot_entries, attribute_dtypes, slot_columns=1):
+        '''
+        Allocates num_slots shared memory slabs. Each slab holds a (slot_entries x slot_columns) row-major block
+        for every attribute in attribute_dtypes (an ordered dictionary mapping attribute name -> numpy dtype),
+        i.e. one column per task in a block of tasks that is written to tileDB in a single 2-D write. 
+        The scheduler acquires a free slab for every block it submits, the workers decode directly into its columns,
+        and the writer acknowledges the block by releasing the slab once it has been written to tileDB.
+        '''
+        self.num_slots=num_slots
+        self.slot_entries=slot_entries
+        self.slot_columns=slot_columns
+        self.attribute_offsets=OrderedDict()
+        slot_bytes=0
+        for attribute in attribute_dtypes:
+            dtype=np.dtype(attribute_dtypes[attribute])
+            slot_bytes=round_up(slot_bytes,slab_alignment)
+            self.attribute_offsets[attribute]=(slot_bytes,dtype.str)
+            slot_bytes+=slot_entries*slot_columns*dtype.itemsize
+        self.slot_bytes=max([1,slot_bytes])
+        self.slabs=[shared_memory.SharedMemory(create=True,size=self.slot_bytes) for i in range(num_slots)]
+        #slabs that are not in flight; only meaningful in the scheduler process 
+        self.free_slots=list(range(num_slots))
+        self.acks=Queue()
+
+    def total_bytes(self):
+        return self.num_slots*self.slot_bytes
+
+    def in_flight(self):
+        return self.num_slots-len(self.free_slots)
+
+    def collect_acks(self,timeout=None):
+        '''
+        (scheduler) waits up to timeout seconds for a writer acknowledgement, then collects any other pending ones.
+        returns the number of slabs that were released
+        '''
+        try:
+            self.free_slots.append(self.acks.get(timeout=timeout))
+        except queue.Empty:
+            return 0
+        num_acks=1
+        while True:
+            try:
+                self.free_slots.append(self.acks.get_nowait())
+                num_acks+=1
+            except queue.Empty:
+                return num_acks
+
+    def acquire(self,timeout=None):
+        '''
+        (scheduler) returns a free slab, waiting up to timeout seconds for a writer acknowledgement if all slabs are in flight.
+        returns None if the timeout expired
+        '''
+        if len(self.free_slots)==0:
+            self.collect_acks(timeout=timeout)
+        if len(self.free_slots)==0:
+            return None
+        return self.free_slots.pop()
+
+    def release(self,slot):
+        '''
+        (writer) acknowledges that the chunk stored in the slab has been written
+        '''
+        self.acks.put(slot)
+
+    def views(self,slot,num_entries):
+        '''
+        returns an ordered dictionary of attribute -> (num_entries x slot_columns) numpy array backed by the slab
+        '''
+        buf=self.slabs[slot].buf
+        slot_views=OrderedDict()
+        for attribute in self.attribute_offsets:
+            offset,dtype=self.attribute_offsets[attribute]
+            slot_views[attribute]=np.ndarray((num_entries,self.slot_columns),dtype=np.dtype(dtype),buffer=buf,offset=offset)
+        return slot_views
+
+    def close(self):
+        for slab in self.slabs:
+            slab.close()
+
+    def unlink(self):
+        for slab in self.slabs:
+            slab.unlink()
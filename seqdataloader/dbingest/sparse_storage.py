@@ -0,0 +1,107 @@
+## attributes configured with storage=sparse are stored in a companion sparse array, <array_name>.<attribute>, as runs of constant non-zero values.
+## Each run is a cell at (start coordinate, task) holding the value and the (exclusive) end coordinate of the run. Runs are split at the
+## coordinate tile boundaries of the array, so a run never crosses a write chunk and a read of [start, end) only needs the cells that start
+## in [start rounded down to a tile, end).
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import tiledb
+import numpy as np
+
+run_end_attribute='run_end'
+
+def create_sparse_attribute_array(array_name,tiledb_dom,attribute,dtype,filters):
+    tiledb_schema=tiledb.ArraySchema(domain=tiledb_dom,
+                                     sparse=True,
+                                     attrs=(tiledb.Attr(name=attribute,filters=filters,dtype=dtype),
+                                            tiledb.Attr(name=run_end_attribute,filters=filters,dtype='uint32')),
+                                     cell_order='row-major',
+                                     tile_order='row-major')
+    tiledb.SparseArray.create(array_name,tiledb_schema)
+
+def get_run_tile(cur_array):
+    return int(cur_array.schema.domain.dim('genome_coordinate').tile)
+
+def get_nonzero_runs(values,start_index,run_tile):
+    '''
+    values holds the attribute at global coordinates [start_index, start_index+len(values)).
+    returns the start coordinates, (exclusive) end coordinates and values of the runs of constant non-zero values, split at multiples of run_tile.
+    nan is stored as 0.
+    '''
+    start_index=int(start_index)
+    values=np.nan_to_num(values)
+    boundaries=np.ones(values.shape[0],dtype=bool)
+    boundaries[1:]=values[1:]!=values[:-1]
+    boundaries[(-start_index)%run_tile::run_tile]=True
+    run_starts=np.flatnonzero(boundaries)
+    run_ends=np.append(run_starts[1:],values.shape[0])
+    run_values=values[run_starts]
+    nonzero=run_values!=0
+    return run_starts[nonzero]+start_index,run_ends[nonzero]+start_index,run_values[nonzero]
+
+def write_sparse_runs(cur_array,attribute,block,start_index,first_task,tasks):
+    '''
+    block is a (num_entries x num_block_tasks) array whose column i holds task first_task+i; writes the runs of the listed tasks
+    '''
+    run_tile=get_run_tile(cur_array)
+    coords=[]
+    task_coords=[]
+    run_ends=[]
+    run_values=[]
+    for task_index in tasks:
+        cur_starts,cur_ends,cur_values=get_nonzero_runs(block[:,task_index-first_task],start_index,run_tile)
+        coords.append(cur_starts)
+        task_coords.append(np.full(cur_starts.shape[0],task_index))
+        run_ends.append(cur_ends)
+        run_values.append(cur_values)
+    coords=np.concatenate(coords).astype(np.uint32)
+    if coords.shape[0]==0:
+        return 0
+    cur_array[coords,np.concatenate(task_coords).astype(np.uint32)]={attribute:np.concatenate(run_values),
+                                                                    run_end_attribute:np.concatenate(run_ends).astype(np.uint32)}
+    return coords.shape[0]
+
+def delete_sparse_runs(array_name,tdb_Context,start_index,end_index,first_task,last_task,timestamp=None):
+    '''
+    deletes the runs of tasks [first_task, last_task) that start in [start_index, end_index), i.e. before they are replaced
+    '''
+    with tiledb.open(array_name,mode='d',ctx=tdb_Context,timestamp=timestamp) as cur_array:
+        cur_array.query(cond=" and ".join(["genome_coordinate >= "+str(start_index),
+                                           "genome_coordinate < "+str(end_index),
+                                           "task >= "+str(first_task),
+                                           "task < "+str(last_task)])).submit()
+
+def read_sparse_attribute(cur_array,attribute,start,end,task_start,task_end):
+    '''
+    expands the runs of tasks [task_start, task_end) that overlap [start, end) into a dense (end-start) x (task_end-task_start) array
+    '''
+    run_tile=get_run_tile(cur_array)
+    cells=cur_array.query(attrs=[attribute,run_end_attribute]).multi_index[(start//run_tile)*run_tile:end-1,task_start:task_end-1]
+    values=np.zeros((end-start,task_end-task_start),dtype=cur_array.schema.attr(attribute).dtype)
+    run_starts=np.maximum(cells['genome_coordinate'].astype(np.int64),start)
+    run_ends=np.minimum(cells[run_end_attribute].astype(np.int64),end)
+    overlapping=run_ends > run_starts
+    run_starts=run_starts[overlapping]
+    run_lengths=run_ends[overlapping]-run_starts
+    #every base covered by a run: its row is the run start plus its offset within the run
+    run_offsets=np.arange(run_lengths.sum())-np.repeat(np.cumsum(run_lengths)-run_lengths,run_lengths)
+    rows=np.repeat(run_starts-start,run_lengths)+run_offsets
+    columns=np.repeat(cells['task'][overlapping].astype(np.int64)-task_start,run_lengths)
+    values[rows,columns]=np.repeat(cells[attribute][overlapping],run_lengths)
+    return values
+
+def read_attribute(array_name,attribute,start,end,task_start,task_end,tdb_Context=None):
+    '''
+    returns the (end-start) x (task_end-task_start) values of the attribute for global coordinates [start, end),
+    whether it is stored in the main array, a separate array or a sparse array
+    '''
+    with tiledb.open(array_name,mode='r',ctx=tdb_Context) as cur_array:
+        storage=cur_array.meta.get('_'.join(['storage',attribute]),'dense')
+    if storage=='dense':
+        attribute_array_name=array_name
+    else:
+        attribute_array_name=array_name.rstrip('/')+'.'+attribute
+    with tiledb.open(attribute_array_name,mode='r',ctx=tdb_Context) as cur_array:
+        if storage=='sparse':
+            return read_sparse_attribute(cur_array,attribute,start,end,task_start,task_end)
+        return cur_array.query(attrs=[attribute])[start:end,task_start:task_end][attribute]
@@ -0,0 +1,83 @@
+## structured telemetry for dbingest: one JSON object per line, written to a sidecar file next to the array.
+## the array writer records a "block" event for every block of tasks x chunk it writes, and the parent records a "run" event
+## when the ingest starts and a "scheduler" event when it ends. summarize_telemetry aggregates the events into a table of where the time went.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import argparse
+import json
+import time
+from collections import OrderedDict
+
+def get_telemetry_path(array_name):
+    return array_name.rstrip('/')+'.ingest_telemetry.jsonl'
+
+class TelemetryLog(object):
+    def __init__(self,path,mode='a'):
+        self.path=path
+        self.outf=open(path,mode)
+
+    def record(self,event,**fields):
+        fields['event']=event
+        fields['time']=time.time()
+        self.outf.write(json.dumps(fields)+'\n')
+        self.outf.flush()
+
+    def close(self):
+        self.outf.close()
+
+def add_to_totals(totals,key,value):
+    totals[key]=totals.get(key,0)+value
+
+def summarize_telemetry(path):
+    '''
+    prints the total time spent in each stage of the last ingest recorded in the telemetry file, and its throughput.
+    Parse, serialization and queue times are summed over the workers, so they can exceed the elapsed time
+    '''
+    events=[json.loads(line) for line in open(path,'r') if line.strip()!='']
+    run_starts=[i for i in range(len(events)) if events[i]['event']=='run']
+    if len(run_starts) > 0:
+        events=events[run_starts[-1]:]
+    stage_times=OrderedDict()
+    num_blocks=0
+    num_bases=0
+    bytes_written=0
+    scheduler=None
+    run=None
+    for event in events:
+        if event['event']=='run':
+            run=event
+        elif event['event']=='scheduler':
+            scheduler=event
+        elif event['event']=='block':
+            num_blocks+=1
+            num_bases+=event['bases']*event['num_tasks']
+            bytes_written+=event['bytes_written']
+            for attribute,parse_time in event['parse_time'].items():
+                add_to_totals(stage_times,'parse:'+attribute,parse_time)
+            for key in ['fill_time','serialize_time','queue_wait','block_assembly_wait','read_back_time']:
+                add_to_totals(stage_times,key,event[key])
+            for array_name,write_time in event['write_time'].items():
+                add_to_totals(stage_times,'tiledb_write:'+array_name,write_time)
+    if scheduler is not None:
+        add_to_totals(stage_times,'scheduler_slab_wait',scheduler['slab_wait'])
+        add_to_totals(stage_times,'scheduler_memory_wait',scheduler['memory_wait'])
+    print('\t'.join(['stage','total_s','per_block_s']))
+    for stage,stage_time in stage_times.items():
+        print('\t'.join([stage,str(round(stage_time,3)),str(round(stage_time/max([1,num_blocks]),4))]))
+    elapsed=None
+    if (run is not None) and (scheduler is not None):
+        elapsed=scheduler['time']-run['time']
+    print("blocks:"+str(num_blocks)+" bases x tasks:"+str(num_bases)+" MB written:"+str(round(bytes_written/(10**6),2)))
+    if elapsed is not None:
+        print("elapsed:"+str(round(elapsed,2))+" s bases/sec:"+str(round(num_bases/elapsed,1))+" MB/sec:"+str(round(bytes_written/(10**6)/elapsed,2)))
+    return stage_times
+
+def main():
+    parser=argparse.ArgumentParser(description="summarize the telemetry of a dbingest run")
+    parser.add_argument("--telemetry_file",help="<array_name>.ingest_telemetry.jsonl")
+    args=parser.parse_args()
+    summarize_telemetry(args.telemetry_file)
+
+if __name__=="__main__":
+    main()
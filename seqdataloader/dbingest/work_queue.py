@@ -0,0 +1,97 @@
+## work queue for distributed dbingest on a shared filesystem. The planning run writes the blocks of tasks x chunk to ingest (the units)
+## to <work_dir>/work_plan.pkl; db_ingest --worker processes on any number of hosts claim units by atomically creating
+## <work_dir>/claims/<unit> (O_CREAT | O_EXCL), write them to the array, and record them in their own manifest in <work_dir>/manifests.
+## db_ingest --finalize checks that every unit is recorded in a manifest before registering and consolidating the array.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import os
+import pickle
+import socket
+import time
+from .manifest import *
+
+def get_worker_id():
+    return '.'.join([socket.gethostname(),str(os.getpid())])
+
+def get_work_plan_path(work_dir):
+    return os.path.join(work_dir,'work_plan.pkl')
+
+def get_claim_path(work_dir,unit_index):
+    return os.path.join(work_dir,'claims',str(unit_index))
+
+def get_worker_manifest_path(work_dir,worker_id):
+    return os.path.join(work_dir,'manifests',worker_id+'.tsv')
+
+def get_worker_telemetry_path(work_dir,worker_id):
+    return os.path.join(work_dir,'telemetry',worker_id+'.jsonl')
+
+def write_work_plan(work_dir,work_plan):
+    '''
+    work_plan is a dictionary with the arguments of the planning run, the attribute info, the task metadata and the block plan.
+    Claims, manifests and telemetry of a previous plan in the same directory are removed
+    '''
+    for subdir in ['claims','manifests','telemetry']:
+        subdir_path=os.path.join(work_dir,subdir)
+        if os.path.exists(subdir_path):
+            for fname in os.listdir(subdir_path):
+                os.remove(os.path.join(subdir_path,fname))
+        else:
+            os.makedirs(subdir_path)
+    #written to a temporary file and renamed, so that workers never load a partial plan
+    tmp_path=get_work_plan_path(work_dir)+'.tmp'
+    with open(tmp_path,'wb') as outf:
+        pickle.dump(work_plan,outf)
+    os.replace(tmp_path,get_work_plan_path(work_dir))
+
+def load_work_plan(work_dir):
+    with open(get_work_plan_path(work_dir),'rb') as inf:
+        return pickle.load(inf)
+
+def claim_unit(work_dir,unit_index,worker_id):
+    '''
+    returns True if this worker created the claim file of the unit, False if another worker claimed it first
+    '''
+    try:
+        fd=os.open(get_claim_path(work_dir,unit_index),os.O_CREAT|os.O_EXCL|os.O_WRONLY)
+    except FileExistsError:
+        return False
+    os.write(fd,('\t'.join([worker_id,str(time.time())])+'\n').encode())
+    os.close(fd)
+    return True
+
+def get_claim_owner(work_dir,unit_index):
+    try:
+        with open(get_claim_path(work_dir,unit_index),'r') as inf:
+            return inf.read().split('\t')[0]
+    except FileNotFoundError:
+        return None
+
+def release_claim(work_dir,unit_index):
+    if os.path.exists(get_claim_path(work_dir,unit_index)):
+        os.remove(get_claim_path(work_dir,unit_index))
+
+def claim_units(work_dir,num_units,batch_size,worker_id):
+    '''
+    yields lists of up to batch_size unit indices claimed by this worker, until every unit has been claimed
+    '''
+    unit_index=0
+    while unit_index < num_units:
+        batch=[]
+        while (unit_index < num_units) and (len(batch) < batch_size):
+            if claim_unit(work_dir,unit_index,worker_id):
+                batch.append(unit_index)
+            unit_index+=1
+        if len(batch) > 0:
+            yield batch
+
+def load_worker_manifests(work_dir,array_name):
+    '''
+    returns a manifest with the units recorded by all workers
+    '''
+    manifest=IngestManifest(array_name)
+    manifest_dir=os.path.join(work_dir,'manifests')
+    for fname in sorted(os.listdir(manifest_dir)):
+        worker_manifest=IngestManifest(array_name,path=os.path.join(manifest_dir,fname)).load()
+        manifest.completed.update(worker_manifest.completed)
+    return manifest
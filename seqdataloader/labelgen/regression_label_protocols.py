@@ -1,6 +1,7 @@
 from math import floor,ceil
 import pandas as pd
 from .utils import rolling_window 
+from ..utils import decode_bigwig_values
 import pdb
 import numpy as np 
 from pybedtools import BedTool
@@ -221,13 +222,12 @@ def all_genome_bins_regression(task_name,task_bed,task_bigwig,task_ambig,chrom,f
         task_ambig=BedTool(task_ambig) 
 
     #get the BigWig value at each position along the chromosome, (cutting off anything that extends beyond final_coord)
+    #nan values (no data) are replaced with 0 
     try:
-        values=task_bigwig.values(chrom,first_bin_start,final_bin_start+args.bin_size,numpy=True)
+        values=decode_bigwig_values(task_bigwig,chrom,first_bin_start,final_bin_start+args.bin_size,np.empty(final_bin_start+args.bin_size-first_bin_start,dtype=np.float32))
     except:
         print("Warning! Chromosome:"+str(chrom)+" appears not to be present in the bigWig file for task:"+task_name)
         return task_name,None,None
-    #replace nan values with 0 
-    values=np.nan_to_num(values) 
     #reshape the values such that number of columns is equal to the bin_stride 
     values=np.reshape(values,((final_bin_start+args.bin_size-first_bin_start)//args.bin_stride,args.bin_stride))
     #sum across the columns
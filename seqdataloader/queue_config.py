@@ -1,2 +1,4 @@
-queue_feed_chunk_size=50 #number of items to queue into pool at once for processing
-max_write_chunk=30000000
+ack_timeout=10 #seconds to wait for a writer acknowledgement before checking that the workers and writer are still alive
+worker_bytes_per_base=16 #bytes of parsing buffers per base of a chunk in each worker (i.e. the float32 values returned by pyBigWig, rounding when quantizing)
+mem_budget_fraction=0.8 #fraction of max_mem_g used to size write chunks; the rest is headroom for the interpreters, file handles and tileDB 
+mem_sample_interval=1.0 #seconds between samples of the memory of the ingest processes
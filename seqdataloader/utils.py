@@ -1,9 +1,105 @@
 import pandas as pd
 import numpy as np
 import pyBigWig
-from pybedtools import BedTool
 from itertools import islice
 from collections import OrderedDict
+import os
+import threading
+
+class ProcessLocalLRUCache(object):
+    '''
+    LRU cache of opened files keyed by path. Entries persist across chunks within a worker process or thread; the cache is
+    emptied the first time it is used in a new process (i.e. after a fork) or a new thread, so that handles are never shared
+    between workers. 
+    '''
+    def __init__(self,opener,closer=None,max_size=16):
+        self.opener=opener
+        self.closer=closer
+        self.max_size=max_size
+        self.local=threading.local()
+
+    def get_local(self):
+        local=self.local
+        if getattr(local,'pid',None)!=os.getpid():
+            #a new thread, or inherited from the parent process: don't close the parent's handles 
+            local.pid=os.getpid()
+            local.entries=OrderedDict()
+            local.hits=0
+            local.misses=0
+        return local
+
+    def get(self,path):
+        local=self.get_local()
+        if path in local.entries:
+            local.hits+=1
+            local.entries.move_to_end(path)
+            return local.entries[path]
+        local.misses+=1
+        while len(local.entries)>=max([1,self.max_size]):
+            evicted_path,evicted=local.entries.popitem(last=False)
+            if self.closer is not None:
+                self.closer(evicted)
+        local.entries[path]=self.opener(path)
+        return local.entries[path]
+
+    def stats(self):
+        local=self.get_local()
+        return {'worker':'.'.join([str(local.pid),str(threading.get_ident())]),'hits':local.hits,'misses':local.misses,'open':len(local.entries)}
+
+#worker-local cache of open pyBigWig handles 
+bigwig_handle_cache=ProcessLocalLRUCache(pyBigWig.open,lambda bigwig_object: bigwig_object.close())
+
+def sum_cache_stats(stats_by_worker):
+    '''
+    aggregates the hit/miss counters reported by each worker process or thread 
+    '''
+    hits=sum([stats_by_worker[worker]['hits'] for worker in stats_by_worker])
+    misses=sum([stats_by_worker[worker]['misses'] for worker in stats_by_worker])
+    return hits,misses
+
+
+class PeakIntervalIndex(object):
+    '''
+    peaks from a bed/narrowPeak file, parsed once and stored per chromosome as numpy arrays sorted by start coordinate.
+    summit_offsets holds the last column of the file (the summit offset from the peak start in narrowPeak format),
+    or nan if the last column is not a number. 
+    '''
+    def __init__(self,fname):
+        self.fname=fname
+        self.chroms={}
+        try:
+            peaks=pd.read_csv(fname,header=None,sep='\t',dtype={0:str},comment='#')
+        except pd.errors.EmptyDataError:
+            print("WARNING: no peaks found in:"+str(fname))
+            return
+        peaks=peaks[~peaks[0].str.startswith(('track','browser'))]
+        summit_offsets=pd.to_numeric(peaks[peaks.columns[-1]],errors='coerce').values.astype(np.float64)
+        if peaks.shape[1] < 4:
+            summit_offsets=np.full(peaks.shape[0],np.nan)
+        starts=peaks[1].values.astype(np.int64)
+        ends=peaks[2].values.astype(np.int64)
+        for chrom,chrom_rows in peaks.groupby(0,sort=False).indices.items():
+            order=chrom_rows[np.argsort(starts[chrom_rows],kind='stable')]
+            chrom_ends=ends[order]
+            #running maximum of the peak ends allows an O(log n) lookup of the first peak that can overlap a range
+            self.chroms[chrom]=(starts[order],chrom_ends,summit_offsets[order],np.maximum.accumulate(chrom_ends))
+
+    def query(self,chrom,start,end):
+        '''
+        returns the starts, ends and summit offsets of all peaks overlapping [start,end) on chrom
+        '''
+        if chrom not in self.chroms:
+            empty=np.zeros(0,dtype=np.int64)
+            return empty,empty,np.zeros(0,dtype=np.float64)
+        starts,ends,summit_offsets,max_ends=self.chroms[chrom]
+        first=np.searchsorted(max_ends,start,side='right')
+        last=np.searchsorted(starts,end,side='left')
+        overlapping=np.arange(first,max([first,last]))
+        overlapping=overlapping[ends[overlapping]>start]
+        return starts[overlapping],ends[overlapping],summit_offsets[overlapping]
+
+#worker-local cache of parsed peak files
+peak_index_cache=ProcessLocalLRUCache(PeakIntervalIndex,max_size=64)
 
 def open_bigwig_for_parsing(fname,parallel=False):
     if not parallel:
@@ -12,30 +108,115 @@ def open_bigwig_for_parsing(fname,parallel=False):
         #pybigwig objects cannot be pickled
         return fname 
 def open_csv_for_parsing(fname,parallel=False):
-    #if not parallel:
-    return BedTool(fname)
-    #else:
-        #
-    #    return fname
+    if not parallel:
+        return peak_index_cache.get(fname)
+    else:
+        #peak files are parsed once per worker process and cached, so only pass the filename 
+        return fname
+
+def get_parser_output_buffer(entry,dtype):
+    '''
+    parsers accept an optional 6th entry: a preallocated numpy array (i.e. a shared memory slab) to decode into.
+    '''
+    num_entries=entry[3]-entry[2]
+    if len(entry)>5 and entry[5] is not None:
+        out=entry[5]
+        assert out.shape[0]==num_entries, "output buffer has "+str(out.shape[0])+" entries, expected "+str(num_entries)
+        return out
+    return np.empty(num_entries,dtype=dtype)
+
+def get_fill_value(dtype):
+    '''
+    value used for attributes that are missing for a task
+    (nan for floating point attributes, 0 otherwise)
+    '''
+    if np.issubdtype(np.dtype(dtype),np.floating):
+        return np.nan
+    return 0
+
+def quantize_signal(values,scale,out):
+    '''
+    stores round(values*scale) in the integer array out, clipping to the range of its dtype
+    '''
+    dtype_info=np.iinfo(out.dtype)
+    values=np.rint(values*scale)
+    np.clip(values,dtype_info.min,dtype_info.max,out=values)
+    out[:]=values
+    return out
+
+#sparse tracks (i.e. base-resolution counts) are decoded from their intervals; regions where the track covers more than bigwig_dense_fraction
+#of the bases are read with values() instead
+bigwig_dense_fraction=0.01
+
+#float32 buffer that bigwig signal is decoded into before it is quantized, reused across chunks. Each worker thread (--executor thread)
+#has its own, like the entries of ProcessLocalLRUCache 
+decode_buffer=threading.local()
+
+def get_decode_buffer(num_entries):
+    buffer=getattr(decode_buffer,'values',None)
+    if (buffer is None) or (buffer.shape[0] < num_entries):
+        buffer=decode_buffer.values=np.empty(num_entries,dtype=np.float32)
+    return buffer[:num_entries]
+
+def get_interval_array(intervals,start,end):
+    '''
+    (start, end, value) tuples returned by pyBigWig intervals() as a (num_intervals x 3) array, clipped to [start, end)
+    '''
+    runs=np.array(intervals if intervals is not None else [],dtype=np.float64).reshape((-1,3))
+    np.clip(runs[:,0:2],start,end,out=runs[:,0:2])
+    return runs
+
+def expand_bigwig_intervals(runs,start,out):
+    '''
+    runs is a (num_runs x 3) array of sorted, non-overlapping (start, end, value) intervals within [start, start+len(out));
+    writes their values to out, and 0 between them. The cost is proportional to the number of bases covered by the runs. 
+    '''
+    out.fill(0)
+    run_starts=runs[:,0].astype(np.int64)-start
+    run_lengths=runs[:,1].astype(np.int64)-start-run_starts
+    #every base covered by a run: its row is the run start plus its offset within the run
+    run_offsets=np.arange(run_lengths.sum())-np.repeat(np.cumsum(run_lengths)-run_lengths,run_lengths)
+    out[np.repeat(run_starts,run_lengths)+run_offsets]=np.repeat(np.nan_to_num(runs[:,2]),run_lengths)
+    return out
+
+def decode_bigwig_values(bigwig_object,chrom,start,end,out):
+    '''
+    writes the values of the bigwig at [start, end) to out, with 0 where the track has no data (where values() returns nan).
+    The fraction of the region covered by the track is looked up in the zoom level summaries of the bigwig, so a region that starts 
+    in a gap (i.e. an N region) and is dense further on is still read with values() 
+    '''
+    coverage=bigwig_object.stats(chrom,start,end,type='coverage')[0]
+    if coverage is None:
+        out.fill(0)
+        return out
+    if coverage > bigwig_dense_fraction:
+        out[:]=bigwig_object.values(chrom,start,end,numpy=True)
+        np.nan_to_num(out,copy=False)
+        return out
+    return expand_bigwig_intervals(get_interval_array(bigwig_object.intervals(chrom,start,end),start,end),start,out)
 
 def parse_bigwig_chrom_vals(entry):
     bigwig_object=entry[0]
     if type(bigwig_object)==str:
-        bigwig_object=pyBigWig.open(bigwig_object)
+        bigwig_object=bigwig_handle_cache.get(bigwig_object)
     chrom=entry[1]
     start=entry[2]
     end=entry[3]
     cur_attribute_info=entry[4]
+    signal_data=get_parser_output_buffer(entry,cur_attribute_info['dtype'])
     #note: pybigwig uses NA in place of 0 where there are no reads, replace with 0.
     bw_chroms=bigwig_object.chroms().keys()
     if chrom not in bw_chroms:
+        #check to see if chromosome in bigwig, if not, return all NA's & warning that chromosome is not present in the dataset
         print("WARNING: chromosome:"+str(chrom)+ " was not found in the bigwig file:"+str(bigwig_object))
-        size=(end-start+1)
-        signal_data=np.full(size,np.nan)
+        signal_data.fill(get_fill_value(signal_data.dtype))
     else: 
-        #check to see if chromosome in bigwig, if not, return all NA's & warning that chromosome is not present in the dataset
         try:
-            signal_data=np.nan_to_num(bigwig_object.values(chrom,start,end))
+            if cur_attribute_info.get('scale') is None:
+                decode_bigwig_values(bigwig_object,chrom,start,end,signal_data)
+            else:
+                #integer attribute storing the signal quantized to 1/scale 
+                quantize_signal(decode_bigwig_values(bigwig_object,chrom,start,end,get_decode_buffer(end-start)),cur_attribute_info['scale'],signal_data)
         except Exception as e:
             print(chrom+"\t"+str(start)+"\t"+str(end)+str(cur_attribute_info))
             raise e
@@ -43,14 +224,12 @@ def parse_bigwig_chrom_vals(entry):
 
 
 def parse_narrowPeak_chrom_vals(entry):
-    task_bed=entry[0]
+    peak_index=entry[0]
+    if type(peak_index)==str:
+        peak_index=peak_index_cache.get(peak_index)
     chrom=entry[1]
     start=entry[2]
     end=entry[3]
-    num_entries=end-start
-    chrom_coords=chrom+'\t'+str(start)+'\t'+str(end)
-    chrom_bed=BedTool(chrom_coords,from_string=True)
-    cur_bed=task_bed.intersect(chrom_bed)
     cur_attribute_info=entry[4]
     store_summits=None
     summit_indicator=None
@@ -60,31 +239,32 @@ def parse_narrowPeak_chrom_vals(entry):
         if store_summits is True:
             summit_from_peak_center=cur_attribute_info['summit_from_peak_center'] 
             summit_indicator=cur_attribute_info['summit_indicator']
-    signal_data = np.zeros(num_entries, dtype=np.int)
-    warned=False
-    summits=[]
-    for entry in cur_bed:
-        #offset relative to start position of the interval
-        entry_start=int(entry[1])-start
-        entry_end=int(entry[2])-start
-        signal_data[entry_start:entry_end]=1
-        #add in summits in a separate step to avoid overwriting them with "1's" for overlaping peak coordinates;
-        #The overwriting issue is particularly relevant for pseudobulk data. 
-        if store_summits is True:
-            if summit_from_peak_center is True:
-                summit_pos=int(entry_start+(entry_end-entry_start)*0.5)
-            else:
-                try:
-                    summit_pos=entry_start+int(entry[-1])
-                except:
-                    print("WARNING: could not add summit position from last column of narrowPeak file, falling back to peak center"+str(entry))
-                    summit_pos=int(entry_start+(entry_end-entry_start)*0.5)                
-            if (summit_pos < entry_end) and (summit_pos > entry_start):
-                summits.append(summit_pos)
-            else:
-                print("WARNING: summit position outside peak region position,skipping:"+str(entry))                    
+    signal_data=get_parser_output_buffer(entry,cur_attribute_info['dtype'])
+    peak_starts,peak_ends,summit_offsets=peak_index.query(chrom,start,end)
+    #fill the peak mask with a difference array: +1 at each (clipped) peak start, -1 at each peak end 
+    coverage=np.zeros(end-start+1,dtype=np.int32)
+    np.add.at(coverage,np.maximum(peak_starts,start)-start,1)
+    np.add.at(coverage,np.minimum(peak_ends,end)-start,-1)
+    np.cumsum(coverage,out=coverage)
+    np.greater(coverage[:-1],0,out=signal_data,casting='unsafe')
+    del coverage
+    #add in summits in a separate step to avoid overwriting them with "1's" for overlaping peak coordinates;
+    #The overwriting issue is particularly relevant for pseudobulk data. 
     if store_summits is True:
-        signal_data[summits]=summit_indicator
+        peak_centers=peak_starts+((peak_ends-peak_starts)*0.5).astype(np.int64)
+        if summit_from_peak_center is True:
+            summit_pos=peak_centers
+        else:
+            #a summit offset of -1 (no summit called) places the summit outside the peak, so it is skipped below 
+            missing_offsets=np.isnan(summit_offsets)
+            if missing_offsets.any():
+                print("WARNING: could not add summit position from last column of "+str(peak_index.fname)+" for "+str(missing_offsets.sum())+" peaks, falling back to peak center")
+            summit_pos=np.where(missing_offsets,peak_centers,peak_starts+np.nan_to_num(summit_offsets).astype(np.int64))
+        in_peak=(summit_pos >= peak_starts) & (summit_pos < peak_ends)
+        if (~in_peak).any():
+            print("WARNING: summit position outside peak region position, skipping "+str((~in_peak).sum())+" peaks on "+str(chrom))
+        summit_pos=summit_pos[in_peak & (summit_pos >= start) & (summit_pos < end)]
+        signal_data[summit_pos-start]=summit_indicator
     return start, end, signal_data 
     
 def chunkify(iterable,chunk):
@@ -96,38 +276,6 @@ def chunkify(iterable,chunk):
         else:
             return
         
-def transform_indices_to_chrom_coords(start_chunk_index,end_chunk_index,chrom_indices):
-    #print("transforming:"+str(start_chunk_index)+'-'+str(end_chunk_index))
-    #print(str(chrom_indices))
-    chrom_coords=[]
-    while True:
-        found=False
-        for chrom in chrom_indices:
-            cur_chrom_start_index=chrom_indices[chrom][0]
-            cur_chrom_end_index=chrom_indices[chrom][1]
-            cur_chrom_size=chrom_indices[chrom][2]
-            if start_chunk_index >=cur_chrom_start_index:
-                if start_chunk_index < cur_chrom_end_index:
-                    found=True
-                    #start position is on this chromosome
-                    chrom_coord_start=start_chunk_index-cur_chrom_start_index
-                    #check if end coordinate falls on same chromosome
-                    if end_chunk_index < cur_chrom_end_index:
-                        #on one chrom
-                        chrom_coord_end=end_chunk_index-cur_chrom_start_index
-                        chrom_coords.append((chrom,chrom_coord_start,chrom_coord_end,start_chunk_index,end_chunk_index))
-                        return chrom_coords
-                    else:
-                        chrom_coord_end=cur_chrom_size
-                        chrom_coords.append((chrom,chrom_coord_start,chrom_coord_end,start_chunk_index,cur_chrom_end_index))
-                        #update start_chunk_index
-                        start_chunk_index=cur_chrom_end_index
-        if found is False:
-            if len(chrom_coords)==0:
-                raise Exception("failed to tranform indices:"+str(start_chunk_index)+"-"+str(end_chunk_index)+ " to chrom coords;"+str(chrom_indices))
-            else:
-                return chrom_coords
-        
 def transform_chrom_size_to_indices(chrom_sizes):
     '''
     chrom_sizes is a dataframe 
@@ -143,3 +291,80 @@ def transform_chrom_size_to_indices(chrom_sizes):
     return chrom_indices,start_coord
 
 
+
+def get_chroms_to_ingest(chrom_indices,chroms_to_keep=None,chroms_to_exclude=None):
+    '''
+    returns the chromosomes of chrom_indices to ingest, in chrom_indices order: those in chroms_to_keep (all if None), 
+    minus those in chroms_to_exclude
+    '''
+    for chrom in (chroms_to_keep if chroms_to_keep is not None else [])+(chroms_to_exclude if chroms_to_exclude is not None else []):
+        if chrom not in chrom_indices:
+            print("warning: chromosome:"+str(chrom)+" is not in the chrom sizes file")
+    return [chrom for chrom in chrom_indices if ((chroms_to_keep is None) or (chrom in chroms_to_keep)) and ((chroms_to_exclude is None) or (chrom not in chroms_to_exclude))]
+
+def merge_intervals(starts,ends):
+    '''
+    merges overlapping and adjacent [start, end) intervals. returns a list of (start, end) sorted by start 
+    '''
+    if len(starts)==0:
+        return []
+    order=np.argsort(starts,kind='stable')
+    starts=np.asarray(starts)[order]
+    ends=np.maximum.accumulate(np.asarray(ends)[order])
+    #an interval starts a new group if it starts after the end of every interval before it 
+    group_firsts=np.flatnonzero(np.append(True,starts[1:] > ends[:-1]))
+    group_lasts=np.append(group_firsts[1:]-1,len(starts)-1)
+    return list(zip(starts[group_firsts].tolist(),ends[group_lasts].tolist()))
+
+def get_ingest_intervals(chrom_indices,coord_tile_size,chroms,regions=None,padding=0):
+    '''
+    returns the merged (start_index, end_index) intervals of the global coordinate axis to ingest: the whole of each chromosome in chroms, 
+    or, if regions (a dataframe of bed chrom, start, end) is provided, the regions on those chromosomes. Each region is padded by padding 
+    bases on both sides and extended to the coordinate tiles it overlaps (clipped to its chromosome), so that writes fill whole tiles 
+    and regions that share a tile are merged 
+    '''
+    if regions is None:
+        return merge_intervals(np.array([chrom_indices[chrom][0] for chrom in chroms],dtype=np.int64),
+                               np.array([chrom_indices[chrom][1] for chrom in chroms],dtype=np.int64))
+    on_chroms=regions[0].isin(chroms)
+    if on_chroms.sum() < regions.shape[0]:
+        print("skipping "+str(regions.shape[0]-on_chroms.sum())+" regions on chromosomes that are not ingested")
+    regions=regions[on_chroms]
+    chrom_starts=regions[0].map(dict([(chrom,chrom_indices[chrom][0]) for chrom in chroms])).to_numpy(dtype=np.int64)
+    chrom_ends=regions[0].map(dict([(chrom,chrom_indices[chrom][1]) for chrom in chroms])).to_numpy(dtype=np.int64)
+    starts=chrom_starts+regions[1].to_numpy(dtype=np.int64)-padding
+    ends=chrom_starts+regions[2].to_numpy(dtype=np.int64)+padding
+    starts=np.maximum(chrom_starts,(starts//coord_tile_size)*coord_tile_size)
+    ends=np.minimum(chrom_ends,-((-ends)//coord_tile_size)*coord_tile_size)
+    keep=starts < ends
+    return merge_intervals(starts[keep],ends[keep])
+
+def plan_write_chunks(chrom_indices,num_indices,write_chunk,coord_tile_size,intervals=None):
+    '''
+    splits the global genome coordinate axis into write chunks whose boundaries are aligned to the coordinate tiles of the array.
+    chunks are not split at chromosome boundaries, so consecutive small contigs are merged into a single write. 
+    returns a list of (start_index, end_index, coord_sets), where coord_sets lists the (chrom, start_pos, end_pos, start_index, end_index)
+    piece of every chromosome covered by the chunk; each piece is parsed separately.
+    intervals restricts the chunks to the given sorted, disjoint (start_index, end_index) intervals (see get_ingest_intervals) 
+    '''
+    if intervals is None:
+        intervals=[(0,num_indices)]
+    chunk_size=max([coord_tile_size,(write_chunk//coord_tile_size)*coord_tile_size])
+    chrom_names=list(chrom_indices.keys())
+    chrom_starts=np.array([chrom_indices[chrom][0] for chrom in chrom_names],dtype=np.int64)
+    #every piece starts at either a chunk boundary, a chromosome boundary or the start of an interval 
+    boundaries=np.union1d(np.arange(0,num_indices,chunk_size,dtype=np.int64),chrom_starts)
+    chunks=[]
+    for interval_start,interval_end in intervals:
+        piece_starts=np.union1d([interval_start],boundaries[(boundaries > interval_start) & (boundaries < interval_end)]).astype(np.int64)
+        piece_ends=np.append(piece_starts[1:],interval_end)
+        #side='right' skips over any zero-length chromosomes that share a start index with the next chromosome 
+        piece_chroms=np.searchsorted(chrom_starts,piece_starts,side='right')-1
+        piece_offsets=piece_starts-chrom_starts[piece_chroms]
+        piece_chunks=piece_starts//chunk_size
+        first_chunk=len(chunks)
+        for piece_start,piece_end,piece_chrom,piece_offset,piece_chunk in zip(piece_starts.tolist(),piece_ends.tolist(),piece_chroms.tolist(),piece_offsets.tolist(),piece_chunks.tolist()):
+            if (len(chunks)==first_chunk) or (chunks[-1][0]//chunk_size != piece_chunk):
+                chunks.append((max([piece_chunk*chunk_size,interval_start]),min([(piece_chunk+1)*chunk_size,interval_end]),[]))
+            chunks[-1][2].append((chrom_names[piece_chrom],piece_offset,piece_offset+piece_end-piece_start,piece_start,piece_end))
+    return chunks
@@ -7,11 +7,15 @@ config = {
     'description': 'Generate genome-wide classification and regression labels for DNA accessibility data.',
     'version': '1.2',
     'packages': ['seqdataloader'],
+    'python_requires': '>=3.9',
     'setup_requires': [],
-    'install_requires': ['numpy>=1.15','pandas>=0.23.4','cython>=0.27.3','deeptools>=3.0.1','pybedtools>=0.7','pyBigWig>=0.3.7', 'pyfaidx','tiledb>=0.4.4'],
+    'install_requires': ['numpy>=1.15','pandas>=0.23.4','cython>=0.27.3','deeptools>=3.0.1','pybedtools>=0.7','pyBigWig>=0.3.7', 'pyfaidx','tiledb>=0.19.0'],
     'scripts': [],
     'entry_points': {'console_scripts': ['genomewide_labels=seqdataloader.labelgen.__init__:main',
                                          'db_ingest=seqdataloader.dbingest.__init__:main',
+                                         'db_benchmark_filters=seqdataloader.dbingest.benchmark_filters:main',
+                                         'db_consolidate=seqdataloader.dbingest.consolidate:main',
+                                         'db_plan_ingest=seqdataloader.dbingest.plan_ingest:main',
                                          'db_ingest_single_threaded=seqdataloader.dbingest_single_threaded.__init__:main',
                                          'seqdataloader_get_outliers=seqdataloader.helpers.get_outliers:main']},
     'name': 'seqdataloader'
@@ -0,0 +1,28 @@
+#unit tests for seqdataloader.dbingest.get_adaptive_write_chunk 
+import argparse
+import numpy as np
+from collections import OrderedDict
+from seqdataloader.dbingest import get_adaptive_write_chunk
+
+def test_write_chunk_fits_memory_budget():
+    attribute_dtypes=OrderedDict([('fc_bigwig',np.float32),('idr_peak',np.uint8)])
+    args=argparse.Namespace(write_chunk=30000000,max_queue_size=30,threads=10,max_mem_g=1,num_writers=1)
+    write_chunk=get_adaptive_write_chunk(args,attribute_dtypes,2,10000)
+    assert write_chunk % 10000 == 0
+    assert write_chunk < 30000000
+    assert (31*2*5+10*16)*write_chunk <= 0.8*(10**9)
+    #the budget is not binding 
+    args.max_mem_g=1000
+    assert get_adaptive_write_chunk(args,attribute_dtypes,2,10000)==30000000
+    #at least one coordinate tile 
+    args.max_mem_g=0
+    assert get_adaptive_write_chunk(args,attribute_dtypes,2,10000)==10000
+
+def test_each_writer_holds_a_block():
+    attribute_dtypes=OrderedDict([('fc_bigwig',np.float32)])
+    args=argparse.Namespace(write_chunk=30000000,max_queue_size=4,threads=2,max_mem_g=1,num_writers=1)
+    one_writer=get_adaptive_write_chunk(args,attribute_dtypes,1,1000)
+    args.num_writers=4
+    four_writers=get_adaptive_write_chunk(args,attribute_dtypes,1,1000)
+    assert four_writers < one_writer
+    assert (8*4+2*16)*four_writers <= 0.8*(10**9)
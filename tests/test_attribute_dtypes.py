@@ -0,0 +1,31 @@
+#unit tests for the dtype= and scale= options of the attribute config file 
+import numpy as np
+import pytest
+from seqdataloader.attrib_config import *
+
+def write_attribute_config(tmp_path,lines):
+    fname=str(tmp_path/"attribs.txt")
+    with open(fname,'w') as outf:
+        outf.write('\n'.join(lines)+'\n')
+    return fname
+
+def test_dtype_and_scale_options(tmp_path):
+    attribute_info=get_attribute_info_from_file(write_attribute_config(tmp_path,["fc_bigwig\tbigwig\tdtype=int16\tscale=100",
+                                                                                 "idr_peak\tbed_summit_from_last_col"]))
+    assert attribute_info['fc_bigwig']['dtype']=='int16'
+    assert get_attribute_scale(attribute_info,'fc_bigwig')==100
+    assert np.dtype(attribute_info['idr_peak']['dtype'])==np.uint8
+    assert get_attribute_scale(attribute_info,'idr_peak') is None
+
+@pytest.mark.parametrize("line",["fc_bigwig\tbigwig\tdtype=int16",
+                                 "fc_bigwig\tbigwig\tscale=100",
+                                 "idr_peak\tbed_summit_from_last_col\tdtype=float32",
+                                 "fc_bigwig\tbigwig\tdtype=float16"])
+def test_invalid_dtype_options(tmp_path,line):
+    with pytest.raises(AssertionError):
+        get_attribute_info_from_file(write_attribute_config(tmp_path,[line]))
+
+def test_quantize_signal_rounds_and_clips():
+    out=np.empty(4,dtype=np.uint8)
+    quantize_signal(np.array([0.014,0.016,-1.0,3.0],dtype=np.float32),100,out)
+    assert list(out)==[1,2,0,255]
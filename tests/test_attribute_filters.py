@@ -0,0 +1,70 @@
+#unit tests for the filters= option of the attribute config file 
+import os
+import tempfile
+import pytest
+import pyBigWig
+import tiledb
+from seqdataloader.attrib_config import *
+from seqdataloader.dbingest.benchmark_filters import benchmark_filters
+
+def test_parse_filters():
+    assert parse_filters('bitshuffle,zstd:3')==[('bitshuffle',None),('zstd',3)]
+    with pytest.raises(Exception):
+        parse_filters('snappy')
+    with pytest.raises(AssertionError):
+        parse_filters('bitshuffle:3')
+
+def test_attribute_config_file_filters(tmp_path):
+    fname=str(tmp_path/"attribs.txt")
+    with open(fname,'w') as outf:
+        outf.write("fc_bigwig\tbigwig\tfilters=byteshuffle,lz4:5\nidr_peak\tbed_summit_from_last_col\n")
+    attribute_info=get_attribute_info_from_file(fname)
+    filter_list=get_filter_list(get_attribute_filters(attribute_info,'fc_bigwig'))
+    assert [type(f) for f in filter_list]==[tiledb.ByteShuffleFilter,tiledb.LZ4Filter]
+    assert filter_list[1].level==5
+    assert get_attribute_filters(attribute_info,'idr_peak')==default_filters
+
+def test_benchmark_filters_without_test_reads(tmp_path):
+    bw=pyBigWig.open(str(tmp_path/"track.bw"),'w')
+    bw.addHeader([('chr1',5000)])
+    bw.addEntries('chr1',list(range(0,5000,10)),values=[float(i%5) for i in range(500)],span=10)
+    bw.close()
+    with open(tmp_path/"attribs.txt",'w') as outf:
+        outf.write("fc_bigwig\tbigwig\n")
+    with open(tmp_path/"metadata.tsv",'w') as outf:
+        outf.write("dataset\tfc_bigwig\ntask0\t"+str(tmp_path/"track.bw")+"\n")
+    results=benchmark_filters({'tiledb_metadata':str(tmp_path/"metadata.tsv"),
+                               'attribute_config_file':str(tmp_path/"attribs.txt"),
+                               'chrom':'chr1',
+                               'end':5000,
+                               'pipelines':['zstd:3','bitshuffle,lz4','none'],
+                               'coord_tile_size':1000,
+                               'num_test_reads':0,
+                               'out_dir':str(tmp_path/"benchmark")})
+    assert results.shape[0]==3
+    assert results['read_latency_ms'].isna().all()
+    assert (results['compression_ratio'][0:2] > 1).all()
+    #only the attribute data is measured, so without compression the ratio is 1 (less the headers of the tiles) 
+    assert 0.99 < results['compression_ratio'][2] <= 1
+
+def test_benchmark_filters_in_temporary_dir(tmp_path,monkeypatch):
+    #without --out_dir, the arrays are created in a temporary directory that is removed afterwards 
+    bw=pyBigWig.open(str(tmp_path/"track.bw"),'w')
+    bw.addHeader([('chr1',5000)])
+    bw.addEntries('chr1',list(range(0,5000,10)),values=[float(i%5) for i in range(500)],span=10)
+    bw.close()
+    with open(tmp_path/"metadata.tsv",'w') as outf:
+        outf.write("dataset\tfc_bigwig\ntask0\t"+str(tmp_path/"track.bw")+"\n")
+    with open(tmp_path/"attribs.txt",'w') as outf:
+        outf.write("fc_bigwig\tbigwig\n")
+    (tmp_path/"tmp").mkdir()
+    monkeypatch.setattr(tempfile,'tempdir',str(tmp_path/"tmp"))
+    results=benchmark_filters({'tiledb_metadata':str(tmp_path/"metadata.tsv"),
+                               'attribute_config_file':str(tmp_path/"attribs.txt"),
+                               'chrom':'chr1',
+                               'end':5000,
+                               'pipelines':['zstd:3'],
+                               'coord_tile_size':1000,
+                               'num_test_reads':2})
+    assert results.shape[0]==1
+    assert os.listdir(tmp_path/"tmp")==[]
@@ -0,0 +1,48 @@
+#unit tests for seqdataloader.utils.decode_bigwig_values 
+import numpy as np
+import pyBigWig
+import pytest
+import seqdataloader.utils
+from seqdataloader.utils import decode_bigwig_values
+
+def write_bigwig(tmp_path,starts,ends,values,chrom_size=20000):
+    fname=str(tmp_path/"track.bw")
+    bw=pyBigWig.open(fname,'w')
+    bw.addHeader([('chr1',chrom_size)])
+    bw.addEntries(['chr1']*len(starts),starts,ends=ends,values=values)
+    bw.close()
+    return pyBigWig.open(fname)
+
+@pytest.mark.parametrize("dense_fraction",[0.01,10])
+@pytest.mark.parametrize("start,end",[(0,20000),(1001,17999),(5000,5003)])
+def test_decode_matches_values(tmp_path,monkeypatch,dense_fraction,start,end):
+    #a sparse count track, decoded from its intervals or read with values() 
+    monkeypatch.setattr(seqdataloader.utils,'bigwig_dense_fraction',dense_fraction)
+    bw=write_bigwig(tmp_path,[10,995,1999,5001,19990],[12,1010,2000,5002,20000],[1.0,2.0,3.0,4.0,5.0])
+    #the output buffer is a column of a (bases x tasks) slab 
+    out=np.full((end-start,2),np.nan,dtype=np.float32)[:,1]
+    decode_bigwig_values(bw,'chr1',start,end,out)
+    assert np.array_equal(out,np.nan_to_num(bw.values('chr1',start,end,numpy=True)))
+
+def test_decode_empty_region(tmp_path):
+    bw=write_bigwig(tmp_path,[10],[12],[1.0])
+    out=np.full(100,np.nan,dtype=np.float32)
+    assert not decode_bigwig_values(bw,'chr1',500,600,out).any()
+
+class RecordingBigWig(object):
+    #records which pyBigWig methods decode_bigwig_values calls 
+    def __init__(self,bw):
+        self.bw=bw
+        self.calls=[]
+    def __getattr__(self,name):
+        self.calls.append(name)
+        return getattr(self.bw,name)
+
+def test_density_of_whole_region(tmp_path):
+    #the first half of the region is a gap without data (i.e. an N region), the second half is dense 
+    starts=list(range(10000,20000,10))
+    bw=RecordingBigWig(write_bigwig(tmp_path,starts,[start+10 for start in starts],[float(i%7) for i in range(len(starts))]))
+    out=np.empty(20000,dtype=np.float32)
+    decode_bigwig_values(bw,'chr1',0,20000,out)
+    assert np.array_equal(out,np.nan_to_num(bw.bw.values('chr1',0,20000,numpy=True)))
+    assert ('values' in bw.calls) and ('intervals' not in bw.calls)
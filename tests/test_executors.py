@@ -0,0 +1,37 @@
+#unit tests for the executors of seqdataloader.bounded_process_pool_executor and the per-thread bigwig handle cache
+import threading
+from seqdataloader.bounded_process_pool_executor import *
+from seqdataloader.utils import ProcessLocalLRUCache, sum_cache_stats
+
+def test_serial_executor():
+    executor=SerialExecutor()
+    future=executor.submit(pow,2,10)
+    assert future.done() and future.result()==1024
+    future=executor.submit(int,'not a number')
+    assert isinstance(future.exception(),ValueError)
+
+def test_bounded_thread_pool_executor():
+    executor=BoundedThreadPoolExecutor(max_workers=2)
+    futures=[executor.submit(pow,i,2) for i in range(10)]
+    executor.shutdown(wait=True)
+    assert [future.result() for future in futures]==[i**2 for i in range(10)]
+
+def test_cache_is_per_thread():
+    cache=ProcessLocalLRUCache(lambda path: [path,threading.get_ident()],max_size=2)
+    stats={}
+    #the threads must overlap, as the ident of a thread that has exited can be reused 
+    barrier=threading.Barrier(3)
+    def use_cache():
+        for path in ['a','b','a','c','a']:
+            assert cache.get(path)==[path,threading.get_ident()]
+        barrier.wait()
+        cur_stats=cache.stats()
+        stats[cur_stats['worker']]=cur_stats
+    threads=[threading.Thread(target=use_cache) for i in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(stats)==3
+    #a hit on the second 'a' and on the last 'a' in each thread
+    assert sum_cache_stats(stats)==(6,9)
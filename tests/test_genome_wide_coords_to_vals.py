@@ -0,0 +1,150 @@
+#unit tests for seqdataloader.batchproducers.coordbased.coordstovals.tiledb.GenomeWideTiledbCoordsToVals on an array written by dbingest
+import os
+import numpy as np
+import pyBigWig
+import pytest
+pytest.importorskip("keras")
+pytest.importorskip("pyfaidx")
+from seqdataloader.dbingest import ingest
+from seqdataloader.batchproducers.coordbased.core import Coordinates
+from seqdataloader.batchproducers.coordbased.coordstovals.tiledb import *
+
+chrom_sizes=[('chr1',3000),('chr2',2000)]
+
+def write_bigwig(fname,rng):
+    bw=pyBigWig.open(fname,'w')
+    bw.addHeader(chrom_sizes)
+    for chrom,size in chrom_sizes:
+        starts=np.sort(rng.choice(size,size//10,replace=False))
+        bw.addEntries(chrom,starts.tolist(),values=rng.randint(1,5,size=len(starts)).astype(float).tolist(),span=1)
+    bw.close()
+    return fname
+
+def ingest_tasks(tmp_path,rng,tasks,fname="metadata.tsv",**extra_args):
+    with open(tmp_path/"chrom.sizes",'w') as outf:
+        outf.write(''.join([chrom+'\t'+str(size)+'\n' for chrom,size in chrom_sizes]))
+    with open(tmp_path/"attribs.txt",'w') as outf:
+        outf.write("sig\tbigwig\ncnt\tbigwig\tstorage=sparse\n")
+    with open(tmp_path/fname,'w') as outf:
+        outf.write("dataset\tsig\tcnt\n")
+        for task in tasks:
+            bigwigs=[str(tmp_path/(attribute+str(task)+".bw")) for attribute in ['sig','cnt']]
+            outf.write('\t'.join(['task'+str(task)]+[bigwig if os.path.exists(bigwig) else write_bigwig(bigwig,rng) for bigwig in bigwigs])+'\n')
+    ingest(dict({'tiledb_metadata':str(tmp_path/fname),
+                 'array_name':str(tmp_path/"db"),
+                 'chrom_sizes':str(tmp_path/"chrom.sizes"),
+                 'attribute_config_file':str(tmp_path/"attribs.txt"),
+                 'coord_tile_size':500,
+                 'task_tile_size':2,
+                 'write_chunk':1000,
+                 'executor':'serial'},**extra_args))
+    return str(tmp_path/"db")
+
+@pytest.fixture(scope="module")
+def array_name(tmp_path_factory):
+    return ingest_tasks(tmp_path_factory.mktemp("genome_wide"),np.random.RandomState(0),range(3))
+
+def get_expected(array_name,attribute,coord,tasks):
+    vals=[]
+    for task in tasks:
+        bw=pyBigWig.open(array_name.replace("db",attribute+task[-1]+".bw"))
+        vals.append(np.nan_to_num(bw.values(coord.chrom,coord.start,coord.end,numpy=True)))
+    vals=np.stack(vals,axis=1)
+    return vals if coord.isplusstrand else vals[::-1]
+
+@pytest.mark.parametrize("attribute",["sig","cnt"])
+@pytest.mark.parametrize("tasks",[None,["task2","task0"],[1]])
+def test_reads_match_bigwigs(array_name,attribute,tasks):
+    coords=[Coordinates('chr1',100,400,True),Coordinates('chr2',1700,2000,False),Coordinates('chr1',2700,3000,False),Coordinates('chr1',100,400,True)]
+    vals=GenomeWideTiledbCoordsToVals(array_name,attribute,tasks=tasks)(coords)
+    task_names=[get_genome_wide_array_index(array_name).tasks[i] for i in get_genome_wide_array_index(array_name).get_task_indices(tasks)]
+    assert vals.shape==(len(coords),300,len(task_names))
+    for i,coord in enumerate(coords):
+        assert np.array_equal(vals[i],get_expected(array_name,attribute,coord,task_names))
+
+def read_in_child(array_pool,tiledb_path,parent_array_id,result_queue):
+    cur_array=array_pool.get(tiledb_path)
+    result_queue.put((id(cur_array)!=parent_array_id,float(cur_array[0:2]['a'].sum())))
+
+def test_array_pool(tmp_path):
+    import multiprocessing
+    tiledb_path=str(tmp_path/"pooled")
+    tiledb.DenseArray.create(tiledb_path,tiledb.ArraySchema(domain=tiledb.Domain(tiledb.Dim('x',domain=(0,9),tile=10,dtype='uint32')),
+                                                            attrs=[tiledb.Attr('a',dtype='float32')]))
+    with tiledb.DenseArray(tiledb_path,mode='w') as cur_array:
+        cur_array[:]={'a':np.ones(10,dtype=np.float32)}
+    array_pool=TiledbArrayPool()
+    refreshing_array_pool=TiledbArrayPool(reopen_interval=0)
+    cur_array=array_pool.get(tiledb_path)
+    assert array_pool.get(tiledb_path) is cur_array
+    refreshing_array_pool.get(tiledb_path)
+    #a forked process opens its own handle 
+    result_queue=multiprocessing.get_context('fork').Queue()
+    child=multiprocessing.get_context('fork').Process(target=read_in_child,args=(array_pool,tiledb_path,id(cur_array),result_queue))
+    child.start()
+    child.join()
+    assert result_queue.get()==(True,2.0)
+    #only the pool that reopens its arrays sees the new fragment 
+    with tiledb.DenseArray(tiledb_path,mode='w') as cur_array:
+        cur_array[0:2]={'a':np.full(2,5,dtype=np.float32)}
+    assert array_pool.get(tiledb_path)[0:2]['a'].sum()==2
+    assert refreshing_array_pool.get(tiledb_path)[0:2]['a'].sum()==10
+
+def test_basic_reader_batches_match_single_reads(tmp_path):
+    #arrays with one coordinate axis per chromosome, <path>.<chrom>; the negative strand attribute is quantized 
+    tiledb_path=str(tmp_path/"per_chrom")
+    rng=np.random.RandomState(1)
+    expected={}
+    for chrom,size in chrom_sizes:
+        tiledb.DenseArray.create('.'.join([tiledb_path,chrom]),tiledb.ArraySchema(domain=tiledb.Domain(tiledb.Dim('x',domain=(0,size-1),tile=100,dtype='uint32')),
+                                                                                   attrs=[tiledb.Attr('pos',dtype='float32'),tiledb.Attr('neg',dtype='int16')]))
+        expected[chrom]={'pos':rng.rand(size).astype(np.float32),'neg':rng.randint(0,100,size=size).astype(np.int16)}
+        with tiledb.DenseArray('.'.join([tiledb_path,chrom]),mode='w') as cur_array:
+            cur_array[:]=expected[chrom]
+            cur_array.meta['scale_neg']=10
+    #unsorted, overlapping and repeated windows on both strands 
+    coords=[Coordinates('chr2',1500,1800,False),Coordinates('chr1',100,400,True),Coordinates('chr1',250,550,False),
+            Coordinates('chr1',2700,3000,True),Coordinates('chr1',100,400,True),Coordinates('chr2',0,300,True)]
+    vals=BasicTiledbProfileCoordsToVals(tiledb_paths=tiledb_path,pos_label_source_attribute='pos',neg_label_source_attribute='neg')(coords)
+    assert vals.shape==(len(coords),300)
+    for i,coord in enumerate(coords):
+        if coord.isplusstrand:
+            assert np.allclose(vals[i],expected[coord.chrom]['pos'][coord.start:coord.end])
+        else:
+            assert np.allclose(vals[i],expected[coord.chrom]['neg'][coord.start:coord.end][::-1]/10)
+    #only the center of each coordinate is read 
+    vals=BasicTiledbProfileCoordsToVals(tiledb_paths={'mode0':tiledb_path},pos_label_source_attribute='pos',center_size_to_use=100)(coords)
+    assert vals['mode0'].shape==(len(coords),100)
+    for i,coord in enumerate(coords):
+        center_vals=expected[coord.chrom]['pos'][coord.start+100:coord.end-100]
+        assert np.allclose(vals['mode0'][i],center_vals if coord.isplusstrand else center_vals[::-1])
+
+def test_multi_attribute_reads_with_center_cropping(array_name):
+    coords=[Coordinates('chr1',100,500,True),Coordinates('chr2',1500,1900,False),Coordinates('chr1',300,700,False)]
+    #plus strand coordinates read sig and minus strand coordinates read cnt as 'stranded' 
+    ctov=GenomeWideTiledbCoordsToVals(array_name,{'signal':'sig','stranded':'sig','counts':'cnt'},tasks=['task2','task0'],
+                                      center_size_to_use=200,neg_strand_attributes={'stranded':'cnt'})
+    vals=ctov(coords)
+    assert sorted(vals.keys())==['counts','signal','stranded']
+    for i,coord in enumerate(coords):
+        center_coord=Coordinates(coord.chrom,coord.start+100,coord.end-100,coord.isplusstrand)
+        assert vals['signal'].shape==(len(coords),200,2)
+        assert np.array_equal(vals['signal'][i],get_expected(array_name,'sig',center_coord,['task2','task0']))
+        assert np.array_equal(vals['counts'][i],get_expected(array_name,'cnt',center_coord,['task2','task0']))
+        assert np.array_equal(vals['stranded'][i],get_expected(array_name,'sig' if coord.isplusstrand else 'cnt',center_coord,['task2','task0']))
+
+def test_coordinates_outside_of_chromosome(array_name):
+    ctov=GenomeWideTiledbCoordsToVals(array_name,'sig')
+    for coord in [Coordinates('chr1',2800,3100,True),Coordinates('chr2',-100,200,True),Coordinates('chr3',0,300,True)]:
+        with pytest.raises(Exception):
+            ctov([Coordinates('chr1',100,400,True),coord])
+
+def test_index_is_reloaded_after_append(tmp_path):
+    rng=np.random.RandomState(2)
+    array_name=ingest_tasks(tmp_path,rng,range(2),max_tasks=3)
+    ctov=GenomeWideTiledbCoordsToVals(array_name,'cnt',tasks=['task1'],array_pool=TiledbArrayPool(reopen_interval=0))
+    coords=[Coordinates('chr1',100,400,True)]
+    assert np.array_equal(ctov(coords)[0],get_expected(array_name,'cnt',coords[0],['task1']))
+    ingest_tasks(tmp_path,rng,range(3),fname="append.tsv",append=True)
+    ctov.tasks=['task2','task1']
+    assert np.array_equal(ctov(coords)[0],get_expected(array_name,'cnt',coords[0],['task2','task1']))
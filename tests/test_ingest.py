@@ -0,0 +1,247 @@
+#end-to-end tests of seqdataloader.dbingest.ingest: the values in the array are checked against the source bigwigs
+import multiprocessing
+import os
+import numpy as np
+import pyBigWig
+import pytest
+import tiledb
+import seqdataloader.dbingest
+from seqdataloader.dbingest import ingest, ingest_worker, finalize_ingest, get_write_timestamp
+from seqdataloader.dbingest.consolidate import consolidate
+from seqdataloader.dbingest.manifest import IngestManifest
+from seqdataloader.dbingest.work_queue import get_claim_owner, get_worker_manifest_path, load_work_plan
+from seqdataloader.dbingest.sparse_storage import read_attribute
+
+chrom_sizes=[('chr1',20000),('chr2',12000),('chrS',700)]
+
+def write_bigwig(fname,rng):
+    '''
+    a dense signal track with 3 decimals (so it is stored exactly with scale=1000) and gaps without data
+    '''
+    bw=pyBigWig.open(fname,'w')
+    bw.addHeader(chrom_sizes)
+    for chrom,size in chrom_sizes:
+        starts=np.arange(0,size,10)
+        starts=starts[rng.rand(len(starts)) > 0.2]
+        bw.addEntries(chrom,starts.tolist(),values=(rng.randint(0,20000,size=len(starts))/1000).tolist(),span=10)
+    bw.close()
+    return fname
+
+def write_inputs(tmp_path,tasks,attribute_config,seed=0,columns=['sig']):
+    '''
+    writes the chrom sizes, the attribute config and a metadata file with a bigwig for each task, which is used for each of the columns
+    '''
+    rng=np.random.RandomState(seed)
+    with open(tmp_path/"chrom.sizes",'w') as outf:
+        outf.write(''.join([chrom+'\t'+str(size)+'\n' for chrom,size in chrom_sizes]))
+    with open(tmp_path/"attribs.txt",'w') as outf:
+        outf.write(attribute_config)
+    write_metadata(tmp_path,"metadata.tsv",tasks,rng,columns=columns)
+    return {'tiledb_metadata':str(tmp_path/"metadata.tsv"),
+            'array_name':str(tmp_path/"db"),
+            'chrom_sizes':str(tmp_path/"chrom.sizes"),
+            'attribute_config_file':str(tmp_path/"attribs.txt"),
+            'coord_tile_size':1000,
+            'write_chunk':5000,
+            'max_queue_size':4,
+            'max_mem_g':1}
+
+def write_metadata(tmp_path,fname,tasks,rng,version='',columns=['sig']):
+    with open(tmp_path/fname,'w') as outf:
+        outf.write('\t'.join(['dataset']+columns)+'\n')
+        for task in tasks:
+            bigwig=tmp_path/(task+version+".bw")
+            if not bigwig.exists():
+                write_bigwig(str(bigwig),rng)
+            outf.write('\t'.join([task]+[str(bigwig)]*len(columns))+'\n')
+    return str(tmp_path/fname)
+
+def get_task_indices(array_name):
+    with tiledb.open(array_name,mode='r') as cur_array:
+        return dict([(cur_array.meta['_'.join(['task',str(i)])],i) for i in range(cur_array.meta['num_tasks'])])
+
+def check_array(array_name,tmp_path,tasks,attribute='sig',scale=None,versions={}):
+    task_indices=get_task_indices(array_name)
+    offset=0
+    for chrom,size in chrom_sizes:
+        for task in tasks:
+            stored=read_attribute(array_name,attribute,offset,offset+size,task_indices[task],task_indices[task]+1)[:,0]
+            if scale is not None:
+                stored=stored/scale
+            expected=np.nan_to_num(pyBigWig.open(str(tmp_path/(task+versions.get(task,'')+".bw"))).values(chrom,0,size,numpy=True))
+            assert np.allclose(stored,expected,atol=1e-6), (task,chrom,np.abs(stored-expected).max())
+        offset+=size
+
+def test_thread_executor_quantized(tmp_path):
+    tasks=['task'+str(i) for i in range(4)]
+    args=write_inputs(tmp_path,tasks,"sig\tbigwig\tdtype=int32\tscale=1000\n")
+    ingest(dict(args,executor='thread',threads=4,task_tile_size=1))
+    check_array(args['array_name'],tmp_path,tasks,scale=1000)
+
+def test_partial_update_attributes(tmp_path):
+    #the update sheet only lists task3 and task0; they are written to their own task indices in the array 
+    tasks=['task'+str(i) for i in range(4)]
+    args=write_inputs(tmp_path,tasks,"sig\tbigwig\n")
+    ingest(dict(args,executor='serial'))
+    rng=np.random.RandomState(1)
+    update_metadata=write_metadata(tmp_path,"update.tsv",['task3','task0'],rng,version='.v2')
+    ingest(dict(args,tiledb_metadata=update_metadata,update_attributes=['sig'],executor='serial'))
+    check_array(args['array_name'],tmp_path,tasks,versions={'task3':'.v2','task0':'.v2'})
+    unknown_metadata=write_metadata(tmp_path,"unknown.tsv",['task0','task9'],rng)
+    with pytest.raises(Exception,match="task9"):
+        ingest(dict(args,tiledb_metadata=unknown_metadata,update_attributes=['sig'],executor='serial'))
+
+def test_consolidate(tmp_path):
+    tasks=['task'+str(i) for i in range(4)]
+    args=write_inputs(tmp_path,tasks,"sig\tbigwig\n")
+    ingest(dict(args,executor='serial',task_tile_size=2))
+    report=consolidate({'array_name':args['array_name'],'num_test_reads':0})[0]
+    #one fragment per chunk x task block 
+    assert report['fragments_before']==7*2
+    assert report['fragments_after']==1
+    assert len(tiledb.array_fragments(args['array_name']))==1
+    check_array(args['array_name'],tmp_path,tasks)
+
+def get_covered_intervals(array_name):
+    with tiledb.open(array_name,mode='r') as cur_array:
+        if 'covered_start' not in cur_array.meta:
+            return None
+        return list(zip(cur_array.meta['covered_start'],cur_array.meta['covered_end']))
+
+def test_update_keeps_covered_intervals(tmp_path):
+    tasks=['task'+str(i) for i in range(2)]
+    args=write_inputs(tmp_path,tasks,"sig\tbigwig\ncnt\tbigwig\tstorage=separate\n",columns=['sig','cnt'])
+    ingest(dict(args,executor='serial',chroms_to_keep=['chr2']))
+    assert get_covered_intervals(args['array_name'])==[(20000,32000)]
+    #the whole genome of one attribute of one task is rewritten; the other tasks and attributes still only hold chr2 
+    update_metadata=write_metadata(tmp_path,"update.tsv",['task1'],np.random.RandomState(1),version='.v2',columns=['cnt'])
+    ingest(dict(args,tiledb_metadata=update_metadata,update_attributes=['cnt'],executor='serial'))
+    assert get_covered_intervals(args['array_name'])==[(20000,32000)]
+    ingest(dict(args,tiledb_metadata=update_metadata,update_attributes=['cnt'],executor='serial',chroms_to_keep=['chrS']))
+    assert get_covered_intervals(args['array_name'])==[(20000,32000)]
+    #an ingest of every task and attribute over the whole genome covers everything 
+    ingest(dict(args,executor='serial',overwrite=True))
+    assert get_covered_intervals(args['array_name']) is None
+
+def get_manifest_units(array_name):
+    #dataset -> attribute -> number of chunks recorded 
+    units={}
+    for dataset,start_index,end_index,attribute in IngestManifest(array_name).load().completed:
+        units.setdefault(dataset,{}).setdefault(attribute,0)
+        units[dataset][attribute]+=1
+    return units
+
+def test_manifest_is_kept(tmp_path):
+    tasks=['task'+str(i) for i in range(4)]
+    args=write_inputs(tmp_path,tasks[0:2],"sig\tbigwig\ncnt\tbigwig\tstorage=separate\n",columns=['sig','cnt'])
+    ingest(dict(args,executor='serial',max_tasks=4))
+    units=get_manifest_units(args['array_name'])
+    num_chunks=units['task0']['sig']
+    assert units=={'task0':{'sig':num_chunks,'cnt':num_chunks},'task1':{'sig':num_chunks,'cnt':num_chunks}}
+    #a different write chunk is ignored, the chunks of the manifest are reused 
+    append_metadata=write_metadata(tmp_path,"append.tsv",tasks,np.random.RandomState(1),columns=['sig','cnt'])
+    ingest(dict(args,tiledb_metadata=append_metadata,append=True,write_chunk=2000,executor='serial'))
+    assert get_manifest_units(args['array_name'])==dict([(task,{'sig':num_chunks,'cnt':num_chunks}) for task in tasks])
+    update_metadata=write_metadata(tmp_path,"update.tsv",['task1'],np.random.RandomState(2),version='.v2',columns=['sig','cnt'])
+    ingest(dict(args,tiledb_metadata=update_metadata,update_attributes=['cnt'],executor='serial'))
+    assert get_manifest_units(args['array_name'])==dict([(task,{'sig':num_chunks,'cnt':num_chunks}) for task in tasks])
+    check_array(args['array_name'],tmp_path,tasks)
+    check_array(args['array_name'],tmp_path,tasks,attribute='cnt',versions={'task1':'.v2'})
+
+def test_process_executor_with_several_writers(tmp_path):
+    tasks=['task'+str(i) for i in range(5)]
+    args=write_inputs(tmp_path,tasks,"sig\tbigwig\tdtype=int32\tscale=1000\ncnt\tbigwig\tstorage=sparse\n",columns=['sig','cnt'])
+    ingest(dict(args,executor='process',threads=2,num_writers=2,task_tile_size=2))
+    check_array(args['array_name'],tmp_path,tasks,scale=1000)
+    check_array(args['array_name'],tmp_path,tasks,attribute='cnt')
+
+def test_write_timestamps_are_distinct():
+    #forked writers name their fragments with the same uuids, so they must never write at the same timestamp 
+    timestamps=[[0],[0],[0]]
+    for i in range(50):
+        for writer_index in range(3):
+            timestamps[writer_index].append(get_write_timestamp(timestamps[writer_index][-1],writer_index,3))
+    for writer_index in range(3):
+        assert all([timestamp%3==writer_index for timestamp in timestamps[writer_index][1:]])
+        assert all(np.diff(timestamps[writer_index]) > 0)
+
+def test_resume_after_truncated_manifest(tmp_path):
+    tasks=['task'+str(i) for i in range(3)]
+    args=write_inputs(tmp_path,tasks,"sig\tbigwig\n")
+    ingest(dict(args,executor='serial'))
+    manifest_path=IngestManifest(args['array_name']).path
+    lines=open(manifest_path).readlines()
+    num_kept=len(lines)//2
+    #the ingest died while recording a unit: the last line is cut short, and the units after it were never written 
+    with open(manifest_path,'w') as outf:
+        outf.write(''.join(lines[0:num_kept])+lines[num_kept][0:10])
+    task_indices=get_task_indices(args['array_name'])
+    with tiledb.open(args['array_name'],mode='w') as cur_array:
+        for line in lines[num_kept:]:
+            dataset,start_index,end_index,attribute=line.rstrip('\n').split('\t')
+            cur_array[int(start_index):int(end_index),task_indices[dataset]:task_indices[dataset]+1]={attribute:np.zeros((int(end_index)-int(start_index),1),dtype=np.float32)}
+    ingest(dict(args,executor='serial',resume=True))
+    check_array(args['array_name'],tmp_path,tasks)
+    assert len(IngestManifest(args['array_name']).load().completed)==len(lines)-1
+
+def test_append(tmp_path):
+    tasks=['task'+str(i) for i in range(5)]
+    args=write_inputs(tmp_path,tasks[0:2],"sig\tbigwig\tdtype=int32\tscale=1000\n")
+    ingest(dict(args,executor='serial',max_tasks=6,task_tile_size=2))
+    #the sheet lists the existing tasks too, in a different order; only the new ones are written 
+    append_metadata=write_metadata(tmp_path,"append.tsv",['task3','task1','task2','task0','task4'],np.random.RandomState(1))
+    ingest(dict(args,tiledb_metadata=append_metadata,append=True,executor='serial'))
+    assert get_task_indices(args['array_name'])=={'task0':0,'task1':1,'task3':2,'task2':3,'task4':4}
+    check_array(args['array_name'],tmp_path,tasks,scale=1000)
+    #there is no room for a 7th task 
+    more_metadata=write_metadata(tmp_path,"more.tsv",['task5','task6'],np.random.RandomState(2))
+    with pytest.raises(Exception,match="max_tasks"):
+        ingest(dict(args,tiledb_metadata=more_metadata,append=True,executor='serial'))
+    check_array(args['array_name'],tmp_path,tasks,scale=1000)
+
+def test_distributed_worker(tmp_path,monkeypatch):
+    tasks=['task'+str(i) for i in range(3)]
+    args=write_inputs(tmp_path,tasks,"sig\tbigwig\tdtype=int32\tscale=1000\n")
+    work_dir=str(tmp_path/"work")
+    ingest(dict(args,executor='serial',work_dir=work_dir))
+    #the slabs, workers and writers are set up once for all the units claimed by the worker 
+    slab_rings=[]
+    shared_memory_ring=seqdataloader.dbingest.SharedMemoryRing
+    def record_slab_ring(*ring_args,**ring_kwargs):
+        slab_rings.append(shared_memory_ring(*ring_args,**ring_kwargs))
+        return slab_rings[-1]
+    monkeypatch.setattr(seqdataloader.dbingest,'SharedMemoryRing',record_slab_ring)
+    ingest_worker({'work_dir':work_dir,'claim_batch':2,'executor':'thread','threads':2,'num_writers':2,'max_queue_size':4,'max_mem_g':1})
+    assert len(slab_rings)==1
+    finalize_ingest({'work_dir':work_dir})
+    check_array(args['array_name'],tmp_path,tasks,scale=1000)
+
+def test_concurrent_workers(tmp_path):
+    tasks=['task'+str(i) for i in range(3)]
+    args=write_inputs(tmp_path,tasks,"sig\tbigwig\tdtype=int32\tscale=1000\n")
+    work_dir=str(tmp_path/"work")
+    ingest(dict(args,executor='serial',task_tile_size=1,work_dir=work_dir))
+    work_plan=load_work_plan(work_dir)
+    num_units=len(work_plan['block_plan'])
+    #the workers are started at once and race for the claims; they are spawned, like workers started on other hosts 
+    context=multiprocessing.get_context('spawn')
+    workers=[context.Process(target=ingest_worker,args=({'work_dir':work_dir,'claim_batch':1,'executor':'serial','threads':1,'num_writers':1,'max_queue_size':2,'max_mem_g':1},)) for i in range(3)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    assert [worker.exitcode for worker in workers]==[0,0,0]
+    worker_ids=[fname[:-len('.tsv')] for fname in os.listdir(os.path.join(work_dir,'manifests'))]
+    #every unit is claimed by one of the workers, and recorded in the manifest of that worker only 
+    claimed_units={}
+    for worker_id in worker_ids:
+        for dataset,start_index,end_index,attribute in IngestManifest(args['array_name'],path=get_worker_manifest_path(work_dir,worker_id)).load().completed:
+            assert (start_index,end_index,dataset) not in claimed_units
+            claimed_units[(start_index,end_index,dataset)]=worker_id
+    assert len(claimed_units)==num_units
+    assert sorted(os.listdir(os.path.join(work_dir,'claims')),key=int)==[str(unit_index) for unit_index in range(num_units)]
+    for unit_index,(block_tasks,chunk) in enumerate(work_plan['block_plan']):
+        assert claimed_units[(chunk[0],chunk[1],work_plan['tiledb_metadata']['dataset'].loc[block_tasks[0]])]==get_claim_owner(work_dir,unit_index)
+    finalize_ingest({'work_dir':work_dir})
+    assert len(IngestManifest(args['array_name']).load().completed)==num_units
+    check_array(args['array_name'],tmp_path,tasks,scale=1000)
@@ -0,0 +1,65 @@
+#unit tests for seqdataloader.utils.PeakIntervalIndex and seqdataloader.utils.parse_narrowPeak_chrom_vals
+import numpy as np
+from seqdataloader.attrib_config import allowed_attributes
+from seqdataloader.utils import *
+
+def write_peaks(tmp_path,peaks):
+    fname=str(tmp_path/"peaks.narrowPeak")
+    with open(fname,'w') as outf:
+        for chrom,start,end,summit in peaks:
+            outf.write('\t'.join([chrom,str(start),str(end),'.','0','.','1','1','1',str(summit)])+'\n')
+    return fname
+
+def naive_mask(peaks,chrom,start,end,attribute_info):
+    #reference implementation: fill the mask peak by peak
+    signal_data=np.zeros(end-start,dtype=np.int64)
+    summits=[]
+    for peak_chrom,peak_start,peak_end,summit in peaks:
+        if peak_chrom!=chrom or peak_end<=start or peak_start>=end:
+            continue
+        signal_data[max([peak_start,start])-start:min([peak_end,end])-start]=1
+        if attribute_info['store_summits'] is True:
+            if attribute_info['summit_from_peak_center'] is True:
+                summit=int((peak_end-peak_start)*0.5)
+            summits.append(peak_start+summit)
+    for summit_pos in summits:
+        if start <= summit_pos < end:
+            signal_data[summit_pos-start]=attribute_info['summit_indicator']
+    return signal_data
+
+def test_parse_narrowPeak_matches_naive_fill(tmp_path):
+    rng=np.random.RandomState(0)
+    peaks=[]
+    for chrom in ['chr1','chr2']:
+        for peak_start in rng.randint(0,100000,300):
+            width=rng.randint(50,3000)
+            peaks.append((chrom,int(peak_start),int(peak_start+width),int(rng.randint(0,width))))
+    fname=write_peaks(tmp_path,peaks)
+    peak_index=PeakIntervalIndex(fname)
+    for attribute_type in ['bed_no_summit','bed_summit_from_peak_center','bed_summit_from_last_col']:
+        attribute_info=allowed_attributes[attribute_type]
+        for chrom,start,end in [('chr1',0,100000),('chr1',2500,7500),('chr2',99000,104000),('chr3',0,1000)]:
+            observed=parse_narrowPeak_chrom_vals([peak_index,chrom,start,end,attribute_info])[-1]
+            expected=naive_mask(peaks,chrom,start,end,attribute_info)
+            assert np.array_equal(observed,expected),(attribute_type,chrom,start,end)
+
+def test_parse_narrowPeak_into_output_buffer(tmp_path):
+    fname=write_peaks(tmp_path,[('chr1',10,20,5)])
+    out=np.full(30,7,dtype=np.int64)
+    parse_narrowPeak_chrom_vals([fname,'chr1',0,30,allowed_attributes['bed_summit_from_last_col'],out])
+    expected=np.zeros(30,dtype=np.int64)
+    expected[10:20]=1
+    expected[15]=2
+    assert np.array_equal(out,expected)
+
+def test_missing_summits(tmp_path):
+    #a summit offset of -1 (no summit called) is skipped, as is any summit outside its peak; a last column that is not a number 
+    #falls back to the peak center 
+    fname=write_peaks(tmp_path,[('chr1',10,20,-1),('chr1',30,40,'.'),('chr1',50,60,0),('chr1',70,80,10)])
+    observed=parse_narrowPeak_chrom_vals([fname,'chr1',0,100,allowed_attributes['bed_summit_from_last_col']])[-1]
+    expected=np.zeros(100,dtype=np.int64)
+    for peak_start in [10,30,50,70]:
+        expected[peak_start:peak_start+10]=1
+    expected[35]=2
+    expected[50]=2
+    assert np.array_equal(observed,expected)
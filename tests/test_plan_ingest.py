@@ -0,0 +1,40 @@
+#unit tests for the settings chosen by seqdataloader.dbingest.plan_ingest 
+import numpy as np
+import pandas as pd
+import pyBigWig
+from collections import OrderedDict
+from seqdataloader.dbingest.plan_ingest import tune_settings, estimate_ingest, get_sample_region
+
+def get_calibration(parse_s_per_base,write_s_per_byte):
+    return OrderedDict([('fc_bigwig',{'parse_s_per_base':parse_s_per_base,'bytes_per_base':4,'compression_ratio':2.0,'write_s_per_byte':write_s_per_byte})])
+
+def test_cores_are_split_between_workers_and_writers():
+    attribute_dtypes=OrderedDict([('fc_bigwig','float32')])
+    task_fractions={'fc_bigwig':1.0}
+    #parsing is cheap relative to writing, so cores are moved to the writers
+    settings=tune_settings(get_calibration(1e-8,1e-8),attribute_dtypes,task_fractions,3*(10**9),100,32,64,1,30000000)
+    assert settings['threads']+settings['num_writers']==31
+    assert settings['num_writers'] > 1
+    estimates=estimate_ingest(get_calibration(1e-8,1e-8),attribute_dtypes,task_fractions,3*(10**9),100,settings,0.1)
+    assert estimates['peak_mem_g'] <= 64
+    assert estimates['core_utilization'] > 0.8
+    assert np.isclose(estimates['disk_g'],3*(10**9)*100*2/(10**9))
+    #parsing dominates, so a single writer is enough 
+    settings=tune_settings(get_calibration(1e-6,1e-9),attribute_dtypes,task_fractions,3*(10**9),100,32,64,1,30000000)
+    assert (settings['threads'],settings['num_writers'])==(30,1)
+    assert settings['write_chunk'] % settings['coord_tile_size']==0
+    assert settings['task_tile_size']*settings['coord_tile_size']*4 <= 10**6
+
+def test_sample_region_has_data(tmp_path):
+    chrom_sizes=pd.DataFrame([['chr1',10000],['chr2',6000]])
+    fname=str(tmp_path/"track.bw")
+    bw=pyBigWig.open(fname,'w')
+    bw.addHeader(list(chrom_sizes.itertuples(index=False,name=None)))
+    #the middle of chr1 is a gap, like a centromere; the data is at the end of chr1 and the start of chr2 
+    bw.addEntries('chr1',list(range(8000,10000,10)),values=[1.0]*200,span=10)
+    bw.addEntries('chr2',list(range(0,1000,10)),values=[1.0]*100,span=10)
+    bw.close()
+    assert get_sample_region(chrom_sizes,None,2000,fname)==('chr1',8000,10000)
+    assert get_sample_region(chrom_sizes,'chr2',2000,fname)==('chr2',0,2000)
+    #without a bigwig, the middle of the chromosome 
+    assert get_sample_region(chrom_sizes,None,2000)==('chr1',4000,6000)
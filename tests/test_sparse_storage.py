@@ -0,0 +1,27 @@
+#unit tests for seqdataloader.dbingest.sparse_storage 
+import numpy as np
+import tiledb
+from seqdataloader.dbingest.sparse_storage import *
+
+def test_get_nonzero_runs_splits_at_tiles():
+    values=np.array([0,1,1,1,2,0,0,3,3,np.nan],dtype=np.float32)
+    starts,ends,run_values=get_nonzero_runs(values,np.uint32(8),4)
+    assert list(starts)==[9,12,15,16]
+    assert list(ends)==[12,13,16,17]
+    assert list(run_values)==[1,2,3,3]
+
+def test_sparse_round_trip(tmp_path):
+    array_name=str(tmp_path/"sparse")
+    tiledb_dom=tiledb.Domain(tiledb.Dim(name='genome_coordinate',domain=(0,9999),tile=100,dtype='uint32'),
+                             tiledb.Dim(name='task',domain=(0,3),tile=2,dtype='uint32'))
+    create_sparse_attribute_array(array_name,tiledb_dom,'count',np.float32,tiledb.FilterList([tiledb.ZstdFilter()]))
+    rng=np.random.RandomState(0)
+    block=(rng.rand(5000,4) > 0.9)*rng.randint(1,4,size=(5000,4)).astype(np.float32)
+    with tiledb.open(array_name,mode='w') as cur_array:
+        write_sparse_runs(cur_array,'count',block,2000,0,range(4))
+    with tiledb.open(array_name,mode='r') as cur_array:
+        for start,end,task_start,task_end in [(2000,7000,0,4),(2345,2467,1,3),(1500,2100,0,1),(6950,7100,3,4)]:
+            expected=np.zeros((end-start,4),dtype=np.float32)
+            expected[max([start,2000])-start:min([end,7000])-start]=block[max([start,2000])-2000:min([end,7000])-2000]
+            observed=read_sparse_attribute(cur_array,'count',start,end,task_start,task_end)
+            assert np.array_equal(observed,expected[:,task_start:task_end])
@@ -0,0 +1,23 @@
+#unit tests for seqdataloader.dbingest.telemetry 
+from seqdataloader.dbingest.telemetry import *
+
+def record_block(telemetry):
+    telemetry.record('block',tasks=[0,1],start_index=0,end_index=100,bases=100,num_tasks=2,
+                     parse_time={'fc_bigwig':1.0,'idr_peak':0.5},fill_time=0,serialize_time=0.1,queue_wait=2.0,
+                     block_assembly_wait=0.2,read_back_time=0,write_time={'db':3.0},bytes_written=800,bases_per_sec=10)
+
+def test_summarize_last_run(tmp_path):
+    path=str(tmp_path/"db.ingest_telemetry.jsonl")
+    telemetry=TelemetryLog(path,mode='w')
+    telemetry.record('run',threads=1)
+    record_block(telemetry)
+    #only the events of the last run are summarized 
+    telemetry.record('run',threads=2)
+    record_block(telemetry)
+    record_block(telemetry)
+    telemetry.record('scheduler',slab_wait=1.5,memory_wait=0)
+    telemetry.close()
+    stage_times=summarize_telemetry(path)
+    assert stage_times['parse:fc_bigwig']==2.0
+    assert stage_times['tiledb_write:db']==6.0
+    assert stage_times['scheduler_slab_wait']==1.5
@@ -0,0 +1,20 @@
+#unit tests for the claims of seqdataloader.dbingest.work_queue 
+from multiprocessing import Pool
+from seqdataloader.dbingest.work_queue import *
+
+def claim_all(work_dir):
+    return [unit_index for batch in claim_units(work_dir,50,4,get_worker_id()) for unit_index in batch]
+
+def test_units_are_claimed_once(tmp_path):
+    work_dir=str(tmp_path)
+    write_work_plan(work_dir,{'block_plan':list(range(50))})
+    assert load_work_plan(work_dir)['block_plan']==list(range(50))
+    with Pool(4) as pool:
+        claims=pool.map(claim_all,[work_dir]*4)
+    claimed=sorted([unit_index for worker_claims in claims for unit_index in worker_claims])
+    assert claimed==list(range(50))
+    #a released unit can be claimed again 
+    release_claim(work_dir,7)
+    assert get_claim_owner(work_dir,7) is None
+    assert claim_all(work_dir)==[7]
+    assert get_claim_owner(work_dir,7)==get_worker_id()
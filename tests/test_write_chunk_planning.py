@@ -0,0 +1,37 @@
+#unit tests for seqdataloader.utils.plan_write_chunks
+import pandas as pd
+from seqdataloader.utils import *
+
+def test_chunks_are_tile_aligned_and_merge_small_contigs():
+    chrom_sizes=pd.DataFrame([['chr1',25000],['scaffold1',300],['scaffold2',0],['scaffold3',700],['chr2',14000]])
+    chrom_indices,num_indices=transform_chrom_size_to_indices(chrom_sizes)
+    chunks=plan_write_chunks(chrom_indices,num_indices,write_chunk=10500,coord_tile_size=1000)
+    assert [(start,end) for start,end,coord_sets in chunks]==[(0,10000),(10000,20000),(20000,30000),(30000,40000)]
+    #the end of chr1 and the two non-empty scaffolds are merged into a single write
+    assert chunks[2][2]==[('chr1',20000,25000,20000,25000),
+                          ('scaffold1',0,300,25000,25300),
+                          ('scaffold3',0,700,25300,26000),
+                          ('chr2',0,4000,26000,30000)]
+    #the pieces tile the genome exactly
+    pieces=[coord_set for start,end,coord_sets in chunks for coord_set in coord_sets]
+    assert pieces[0][3]==0 and pieces[-1][4]==num_indices
+    for previous,current in zip(pieces[:-1],pieces[1:]):
+        assert previous[4]==current[3]
+    for chrom,start_pos,end_pos,start_index,end_index in pieces:
+        assert end_pos-start_pos==end_index-start_index
+        assert chrom_indices[chrom][0]+start_pos==start_index
+
+def test_chunks_are_restricted_to_padded_regions():
+    chrom_sizes=pd.DataFrame([['chr1',25000],['chrM',500],['chr2',14000]])
+    chrom_indices,num_indices=transform_chrom_size_to_indices(chrom_sizes)
+    chroms=get_chroms_to_ingest(chrom_indices,chroms_to_exclude=['chrM'])
+    assert chroms==['chr1','chr2']
+    regions=pd.DataFrame([['chr1',1500,1700],['chr1',2100,2300],['chr1',24800,24900],['chrM',10,20],['chr2',13950,14000],['chrX',0,10]])
+    intervals=get_ingest_intervals(chrom_indices,1000,chroms,regions,padding=400)
+    #the first two regions share tiles once padded, the last regions of chr1 and chr2 are clipped to the ends of the chromosomes 
+    #(tiles are aligned to the global coordinate axis, chr2 starts at 25500) and chrM is excluded
+    assert intervals==[(1000,3000),(24000,25000),(39000,39500)]
+    chunks=plan_write_chunks(chrom_indices,num_indices,write_chunk=10000,coord_tile_size=1000,intervals=intervals)
+    assert [(start,end) for start,end,coord_sets in chunks]==[(1000,3000),(24000,25000),(39000,39500)]
+    assert chunks[2][2]==[('chr2',13500,14000,39000,39500)]
+    assert merge_intervals([5,0,10],[8,5,12])==[(0,8),(10,12)]